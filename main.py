@@ -1,22 +1,33 @@
 # -*- coding: utf-8 -*-
+from time import monotonic
+STARTUP_STARTED = monotonic()  # точка відліку таймінгів старту: до імпорту важких модулів
+
 import re
 import asyncio
 import os
 import json
+import threading
+import functools
+import heapq
+import hashlib
+import bisect
+import contextvars
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 import pytz
-from flask import Flask, request as flask_request, abort, jsonify
 from telegram import Bot, Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from telegram.constants import ChatAction
+from telegram.error import RetryAfter, TimedOut, NetworkError
 from datetime import datetime, time, timedelta
-from asgiref.wsgi import WsgiToAsgi
-from contextlib import asynccontextmanager
-from flask_apscheduler import APScheduler
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
 
-import cohere
+import httpx
+import random
 
 load_dotenv()
 
@@ -25,6 +36,55 @@ DATABASE_URL = os.environ.get("DATABASE_URL")
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
 COHERE_API_KEY = os.environ.get("COHERE_API_KEY")
 
+# Пул з'єднань з БД
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))             # скільки чекати вільне з'єднання, сек
+DB_POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", "60"))           # після такого простою — перевірка SELECT 1
+DB_POOL_MAX_LIFETIME = float(os.environ.get("DB_POOL_MAX_LIFETIME", "1800")) # після такого віку з'єднання перевідкривається
+
+# Ліміти відправки в Telegram
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))  # повідомлень/сек на весь бот
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", "1"))       # повідомлень/сек в один чат
+TELEGRAM_CHAT_BURST = int(os.environ.get("TELEGRAM_CHAT_BURST", "3"))       # короткий сплеск в один чат
+SEND_CONCURRENCY = int(os.environ.get("SEND_CONCURRENCY", "8"))
+
+# Черга вхідних апдейтів
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", "8"))           # скільки апдейтів обробляється одночасно
+UPDATE_QUEUE_MAX = int(os.environ.get("UPDATE_QUEUE_MAX", "200"))     # понад це вебхук відповідає 503
+UPDATE_DEDUP_TTL_SECONDS = float(os.environ.get("UPDATE_DEDUP_TTL_SECONDS", "86400"))  # Telegram зберігає апдейти до доби
+UPDATE_DEDUP_MAX_ENTRIES = int(os.environ.get("UPDATE_DEDUP_MAX_ENTRIES", "10000"))
+
+# Вибір лідера серед воркерів
+LEADER_POLL_INTERVAL = float(os.environ.get("LEADER_POLL_INTERVAL", "10"))  # як часто перевіряти/перехоплювати лідерство, сек
+SCHEDULE_LISTEN_RECONNECT = float(os.environ.get("SCHEDULE_LISTEN_RECONNECT", "5"))  # пауза перед перепідключенням LISTEN, сек
+WEBHOOK_MAX_BODY = int(os.environ.get("WEBHOOK_MAX_BODY", "1048576"))  # більші тіла вебхука відхиляються (413), байт
+SEND_MAX_RETRIES = 3
+
+# Пул ІТ-фактів
+FACT_BATCH_SIZE = int(os.environ.get("FACT_BATCH_SIZE", "10"))
+FACT_POOL_LOW_WATERMARK = int(os.environ.get("FACT_POOL_LOW_WATERMARK", "3"))
+
+# Кеш розкладу в пам'яті
+SCHEDULE_CACHE_MAX_ENTRIES = int(os.environ.get("SCHEDULE_CACHE_MAX_ENTRIES", "256"))
+RENDER_CACHE_MAX_ENTRIES = int(os.environ.get("RENDER_CACHE_MAX_ENTRIES", "256"))
+
+# Кеш відповідей AI
+AI_CACHE_TTL_SECONDS = float(os.environ.get("AI_CACHE_TTL_SECONDS", "10800"))
+AI_CACHE_MAX_ENTRIES = int(os.environ.get("AI_CACHE_MAX_ENTRIES", "512"))
+
+# Потокові відповіді AI
+AI_MODEL = "command-a-03-2025"
+AI_STREAMING = os.environ.get("AI_STREAMING", "1") == "1"
+AI_STREAM_EDIT_INTERVAL = float(os.environ.get("AI_STREAM_EDIT_INTERVAL", "1.5"))  # не частіше, сек
+
+# Виклики Cohere: дедлайн, повтори, запобіжник
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "60"))                      # дедлайн одного виклику (з повторами), сек
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", "2"))                 # повтори на тимчасових помилках
+LLM_RETRY_BASE_DELAY = float(os.environ.get("LLM_RETRY_BASE_DELAY", "0.5"))  # база експоненційної паузи з jitter, сек
+LLM_BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))       # стільки невдалих викликів поспіль відкривають запобіжник
+LLM_BREAKER_RESET = float(os.environ.get("LLM_BREAKER_RESET", "30"))          # через стільки секунд — пробний виклик
+
 admin_id_raw = os.environ.get("ADMIN_ID")
 if not admin_id_raw:
     print("КРИТИЧНА ПОМИЛКА: ADMIN_ID не знайдено в .env файлі!")
@@ -54,47 +114,633 @@ PAIR_TIMES = {
     4: "13:30",
     5: "15:20"
 }
+PAIR_DURATION_MINUTES = 80
 
-flask_app = None
 application = None
-main_loop = None
-scheduler = APScheduler()
-ai_client = cohere.AsyncClient(COHERE_API_KEY) if COHERE_API_KEY else None
+ai_client = None
+_ai_client_lock = threading.Lock()
+
+def get_ai_client():
+    """
+    Клієнт Cohere створюється при першому зверненні: імпорт SDK і побудова клієнта
+    займають сотні мілісекунд, а на старті вони не потрібні.
+    """
+    global ai_client
+    if ai_client is None and COHERE_API_KEY:
+        with _ai_client_lock:
+            if ai_client is None:
+                import cohere
+                ai_client = cohere.AsyncClient(COHERE_API_KEY)
+    return ai_client
+
+def ai_available() -> bool:
+    return ai_client is not None or bool(COHERE_API_KEY)
+
+# ==========================================
+# МЕТРИКИ (PROMETHEUS)
+# ==========================================
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Лічильник з мітками; inc() — один словниковий запис під локом."""
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {value:g}" for labels, value in values]
+
+class Histogram:
+    """
+    Гістограма з фіксованими межами. observe() — bisect по межах і інкремент під локом;
+    кумулятивні суми рахуються лише під час scrape.
+    """
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name: str, help_text: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # мітки -> [лічильники по кошиках (+Inf останній), сума]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> list:
+        with self._lock:
+            series = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        lines = []
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                le_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class MetricsRegistry:
+    """
+    Реєстр метрик і формат експозиції Prometheus.
+    Крім лічильників і гістограм, на scrape опитує зареєстровані stats_snapshot()
+    і віддає їхні числові поля як gauge: <prefix>_<підсистема>_<поле>.
+    """
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, help_text: str, labelnames=()) -> Counter:
+        metric = Counter(f"{self.prefix}_{name}", help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(f"{self.prefix}_{name}", help_text, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, subsystem: str, snapshot):
+        """snapshot() -> dict; рядки й None пропускаються, bool стає 0/1."""
+        self._collectors.append((subsystem, snapshot))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for subsystem, snapshot in self._collectors:
+            try:
+                values = snapshot()
+            except Exception as e:
+                print(f"Метрики: не вдалося зібрати {subsystem}: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    continue
+                name = re.sub(r"[^a-zA-Z0-9_]", "_", f"{self.prefix}_{subsystem}_{key}")
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry("bot")
+
+# Гарячий шлях вебхука — дрібні межі (мікро- і мілісекунди)
+webhook_ack_seconds = metrics.histogram(
+    "webhook_ack_seconds", "Час від запиту вебхука до відповіді Telegram", ("status",),
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+)
+handler_seconds = metrics.histogram("handler_seconds", "Тривалість обробника за командою і шляхом", ("handler", "path"))
+db_call_seconds = metrics.histogram("db_call_seconds", "Тривалість DB-хелпера в db_executor", ("helper",))
+llm_call_seconds = metrics.histogram(
+    "llm_call_seconds", "Тривалість виклику Cohere (з повторами)", ("outcome",),
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0),
+)
+llm_tokens_total = metrics.counter("llm_tokens_total", "Токени Cohere: оцінка промпту і billed", ("kind",))
+reminder_tick_seconds = metrics.histogram("reminder_tick_seconds", "Тривалість одного проходу розсилки нагадувань")
+reminders_total = metrics.counter("reminders_total", "Нагадування за результатом", ("outcome",))
+fact_batches_total = metrics.counter("fact_batches_total", "Генерації пачок фактів за результатом", ("outcome",))
+facts_generated_total = metrics.counter("facts_generated_total", "Нові факти, додані в пул")
+schedule_actions_total = metrics.counter("schedule_actions_total", "Виконані db_actions за типом", ("action",))
+restored_pairs_total = metrics.counter("restored_pairs_total", "Пари, повернуті дією RESTORE")
+
+# Шлях усередині обробника (перехоплювач, локальна граматика, AI...) — мітка для handler_seconds
+handler_path = contextvars.ContextVar("handler_path", default="")
+
+def instrument_handler(name: str, handler):
+    """Обгортає обробник Telegram: тривалість пишеться в handler_seconds з міткою шляху."""
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        token = handler_path.set("")
+        started = monotonic()
+        try:
+            return await handler(update, context)
+        finally:
+            handler_seconds.observe(monotonic() - started, name, handler_path.get() or "default")
+            handler_path.reset(token)
+    return wrapper
 
 # ==========================================
 # БАЗА ДАНИХ ТА ІСТОРІЯ ФАКТІВ
 # ==========================================
+class PoolExhaustedError(RuntimeError):
+    """Всі з'єднання пулу зайняті довше ніж DB_POOL_TIMEOUT."""
+
+# TCP keepalive для довгоживучих окремих з'єднань (LISTEN, лок лідера): мертве з'єднання
+# дає помилку приблизно за хвилину, а не висить до таймауту ОС (години)
+DB_KEEPALIVE_OPTIONS = {"keepalives": 1, "keepalives_idle": 30, "keepalives_interval": 10, "keepalives_count": 3}
+
+def connect_db(dsn: str, **options):
+    """Нове з'єднання з Postgres з тими ж параметрами, що й у пулі; для окремих з'єднань поза пулом."""
+    return psycopg2.connect(dsn, sslmode='disable', connect_timeout=10, **options)
+
+class PostgresPool:
+    """
+    Потокобезпечний пул з'єднань з Postgres.
+    Перевіряє з'єднання перед видачею (закриті, довго простоюючі, старі),
+    викидає зламані після помилок і рахує статистику використання.
+    """
+    def __init__(self, dsn: str, min_size: int, max_size: int, timeout: float, max_idle: float, max_lifetime: float):
+        self.dsn = dsn
+        self.min_size = max(0, min(min_size, max_size))
+        self.max_size = max(1, max_size)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self._idle = []  # стек (conn, created_at, last_used) — LIFO, щоб "гарячі" з'єднання використовувались першими
+        self._created_at = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self.stats = {
+            "created": 0, "closed": 0, "checkouts": 0, "waits": 0,
+            "exhausted": 0, "broken": 0, "recycled": 0, "in_use": 0,
+        }
+
+    def _connect(self):
+        conn = connect_db(self.dsn, cursor_factory=psycopg2.extras.DictCursor)
+        with self._lock:
+            self._created_at[id(conn)] = monotonic()
+            self.stats["created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._lock:
+            self._created_at.pop(id(conn), None)
+            self.stats["closed"] += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn, created_at: float, last_used: float) -> bool:
+        if conn.closed:
+            with self._lock:
+                self.stats["broken"] += 1
+            return False
+        now = monotonic()
+        if now - created_at > self.max_lifetime:
+            with self._lock:
+                self.stats["recycled"] += 1
+            return False
+        if now - last_used > self.max_idle:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except Exception:
+                with self._lock:
+                    self.stats["broken"] += 1
+                return False
+        return True
+
+    def open(self):
+        """Відкриває мінімальну кількість з'єднань наперед."""
+        for _ in range(self.min_size - len(self._idle)):
+            conn = self._connect()
+            with self._lock:
+                self._idle.append((conn, self._created_at[id(conn)], monotonic()))
+
+    def getconn(self):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.stats["waits"] += 1
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self.stats["exhausted"] += 1
+                print(f"ПОМИЛКА пулу БД: усі {self.max_size} з'єднань зайняті понад {self.timeout} с")
+                raise PoolExhaustedError("connection pool exhausted")
+        try:
+            while True:
+                with self._lock:
+                    entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    conn = self._connect()
+                    break
+                conn, created_at, last_used = entry
+                if self._is_healthy(conn, created_at, last_used):
+                    break
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.stats["checkouts"] += 1
+            self.stats["in_use"] += 1
+        return conn
+
+    def putconn(self, conn, broken: bool = False):
+        try:
+            if not broken and not conn.closed:
+                status = conn.info.transaction_status
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    broken = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    try:
+                        conn.rollback()
+                    except Exception:
+                        broken = True
+            if broken or conn.closed:
+                with self._lock:
+                    self.stats["broken"] += 1
+                self._discard(conn)
+            else:
+                with self._lock:
+                    self._idle.append((conn, self._created_at.get(id(conn), monotonic()), monotonic()))
+        finally:
+            with self._lock:
+                self.stats["in_use"] -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Видає з'єднання на час блоку: commit при успіху, rollback при помилці."""
+        conn = self.getconn()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except Exception:
+                broken = True
+            raise
+        finally:
+            self.putconn(conn, broken=broken)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+    def stats_snapshot(self) -> dict:
+        with self._lock:
+            return {**self.stats, "idle": len(self._idle), "max_size": self.max_size}
+
+db_pool = PostgresPool(DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_MAX_IDLE, DB_POOL_MAX_LIFETIME)
+
 def get_db_conn():
-    return psycopg2.connect(DATABASE_URL, sslmode='disable', cursor_factory=psycopg2.extras.DictCursor)
+    return db_pool.connection()
+
+# Окремий обмежений пул потоків для БД: синхронні psycopg2-хелпери не блокують event loop,
+# а кількість одночасних запитів збігається з розміром пулу з'єднань
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX_SIZE, thread_name_prefix="db")
+
+def _timed_db_call(func, args, kwargs):
+    started = monotonic()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        db_call_seconds.observe(monotonic() - started, getattr(func, "__qualname__", "unknown"))
+
+async def run_db(func, *args, **kwargs):
+    """Виконує синхронну функцію роботи з БД у db_executor і повертає її результат."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, _timed_db_call, func, args, kwargs)
+
+# ==========================================
+# КЕШ РОЗКЛАДУ
+# ==========================================
+class ScheduleVersions:
+    """
+    Монотонна версія розкладу. bump() піднімає загальну версію і версію змінених днів
+    (або всіх днів, якщо days=None). Запис кешу дійсний, поки версія, з якою його порахували,
+    збігається з поточною.
+    """
+    def __init__(self):
+        self.current = 0
+        self._all_days = 0
+        self._days = {}
+        self._lock = threading.Lock()
+
+    def bump(self, days=None) -> int:
+        with self._lock:
+            self.current += 1
+            if days is None:
+                self._all_days = self.current
+                self._days.clear()
+            else:
+                for day in days:
+                    self._days[day] = self.current
+            return self.current
+
+    def for_day(self, day: str) -> int:
+        return max(self._all_days, self._days.get(day, 0))
+
+class ScheduleCache:
+    """Потокобезпечний LRU-кеш читань розкладу з інвалідацією за версією."""
+    def __init__(self, versions: ScheduleVersions, max_entries: int):
+        self.versions = versions
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (version, value)
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def lookup(self, key, day: str = None):
+        """Повертає актуальне значення без завантаження, або None."""
+        version = self.versions.for_day(day) if day else self.versions.current
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == version:
+                self._data.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+        return None
+
+    def get_or_load(self, key, loader, day: str = None):
+        """Повертає значення з кешу або викликає loader(). day=None — запис залежить від усього розкладу."""
+        # Версію беремо ДО читання з БД: якщо запис відбудеться паралельно, запис кешу одразу стане застарілим
+        version = self.versions.for_day(day) if day else self.versions.current
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] == version:
+                self._data.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            self.stats["misses"] += 1
+        value = loader()
+        with self._lock:
+            self._data[key] = (version, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.stats["evictions"] += 1
+        return value
+
+    def stats_snapshot(self) -> dict:
+        with self._lock:
+            return {**self.stats, "size": len(self._data), "version": self.versions.current}
+
+schedule_versions = ScheduleVersions()
+schedule_cache = ScheduleCache(schedule_versions, SCHEDULE_CACHE_MAX_ENTRIES)
+
+# ==========================================
+# МІГРАЦІЇ СХЕМИ БД
+# ==========================================
+class SchemaOutdatedError(RuntimeError):
+    """Схема БД старіша, ніж очікує код — обслуговувати запити не можна."""
+
+# Ключ advisory lock: кілька воркерів не застосовують міграції одночасно
+MIGRATIONS_LOCK_KEY = 0x5C4ED01E
+
+# Упорядкований список міграцій: (версія, опис, SQL-команди).
+# Кожна застосовується рівно один раз і записується в schema_version;
+# команди написані ідемпотентно, бо старі бази вже мають таблиці без schema_version.
+MIGRATIONS = [
+    (1, "базові таблиці", [
+        '''CREATE TABLE IF NOT EXISTS schedule
+           (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, day TEXT NOT NULL,
+            time TEXT NOT NULL, name TEXT NOT NULL, link TEXT,
+            week_type TEXT NOT NULL DEFAULT 'кожна', pair_order INTEGER DEFAULT 0)''',
+        '''CREATE TABLE IF NOT EXISTS users
+           (user_id BIGINT PRIMARY KEY, username TEXT, subscribed INTEGER DEFAULT 1)''',
+        '''CREATE TABLE IF NOT EXISTS sent_notifications
+           (notification_key TEXT PRIMARY KEY, sent_at TIMESTAMP WITH TIME ZONE NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS user_facts
+           (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, fact_summary TEXT NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP)''',
+        '''CREATE TABLE IF NOT EXISTS deleted_pairs
+           (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, day TEXT NOT NULL,
+            time TEXT NOT NULL, name TEXT NOT NULL, link TEXT,
+            week_type TEXT NOT NULL DEFAULT 'кожна', pair_order INTEGER DEFAULT 0,
+            deleted_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP)''',
+    ]),
+    (2, "спільний пул фактів", [
+        "ALTER TABLE user_facts ADD COLUMN IF NOT EXISTS fact_id INTEGER",
+        '''CREATE TABLE IF NOT EXISTS fact_pool
+           (id SERIAL PRIMARY KEY, fact TEXT NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP)''',
+    ]),
+    (3, "індекси під гарячі запити", [
+        # get_pairs_for_day / get_due_reminders: day=... AND week_type IN (...)
+        "CREATE INDEX IF NOT EXISTS schedule_day_week_idx ON schedule (day, week_type, pair_order)",
+        # видалення/оновлення слота в execute_db_actions: user_id, day, pair_order
+        "CREATE INDEX IF NOT EXISTS schedule_user_slot_idx ON schedule (user_id, day, pair_order)",
+        # get_last_deleted_pairs і обрізання історії: user_id ... ORDER BY deleted_at DESC, id DESC
+        "CREATE INDEX IF NOT EXISTS deleted_pairs_user_recent_idx ON deleted_pairs (user_id, deleted_at DESC, id DESC)",
+        # take_fact_from_pool: NOT EXISTS (user_id=... AND fact_id=...)
+        "CREATE INDEX IF NOT EXISTS user_facts_user_fact_idx ON user_facts (user_id, fact_id)",
+        # cleanup_old_notifications: sent_at < ...
+        "CREATE INDEX IF NOT EXISTS sent_notifications_sent_at_idx ON sent_notifications (sent_at)",
+    ]),
+    (4, "типізований час початку пари", [
+        "ALTER TABLE schedule ADD COLUMN IF NOT EXISTS start_time TIME",
+        f"ALTER TABLE schedule ADD COLUMN IF NOT EXISTS duration_minutes INTEGER NOT NULL DEFAULT {PAIR_DURATION_MINUTES}",
+        # Некоректний текстовий час (його й раніше не можна було привести до TIME) стає 00:00
+        '''UPDATE schedule SET start_time = CASE
+               WHEN time ~ '^\\s*([01]?[0-9]|2[0-3]):[0-5][0-9]\\s*$' THEN btrim(time)::TIME
+               ELSE TIME '00:00' END
+           WHERE start_time IS NULL''',
+        "ALTER TABLE schedule ALTER COLUMN start_time SET NOT NULL",
+        # Вибірка дня і нагадувань: day=... [AND start_time BETWEEN ...] ORDER BY start_time,
+        # week_type ('кожна' + поточний) відсікається фільтром по вже впорядкованому діапазону
+        "DROP INDEX IF EXISTS schedule_day_week_idx",
+        "CREATE INDEX IF NOT EXISTS schedule_day_start_idx ON schedule (day, start_time)",
+    ]),
+    (5, "кеш відповідей AI", [
+        '''CREATE TABLE IF NOT EXISTS ai_response_cache
+           (cache_key TEXT PRIMARY KEY, response JSONB NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP WITH TIME ZONE NOT NULL)''',
+        "CREATE INDEX IF NOT EXISTS ai_response_cache_expires_idx ON ai_response_cache (expires_at)",
+    ]),
+    (6, "оброблені апдейти Telegram", [
+        '''CREATE TABLE IF NOT EXISTS processed_updates
+           (update_id BIGINT PRIMARY KEY,
+            received_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP)''',
+        "CREATE INDEX IF NOT EXISTS processed_updates_received_idx ON processed_updates (received_at)",
+    ]),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def _current_schema_version(cursor) -> int:
+    cursor.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cursor.fetchone()[0]
+
+def run_migrations():
+    """Застосовує міграції, новіші за записану версію. Кожна — у своїй транзакції."""
+    # Швидкий шлях без advisory lock: схема вже актуальна (звичайний рестарт чи scale-up)
+    with get_db_conn() as conn:
+        with conn.cursor() as cursor:
+            if _current_schema_version(cursor) >= SCHEMA_VERSION:
+                return
+    conn = db_pool.getconn()
+    broken = False
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+            try:
+                cursor.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                                  (version INTEGER PRIMARY KEY, description TEXT NOT NULL,
+                                   applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP)''')
+                conn.commit()
+                current = _current_schema_version(cursor)
+                for version, description, statements in MIGRATIONS:
+                    if version <= current:
+                        continue
+                    for sql in statements:
+                        cursor.execute(sql)
+                    cursor.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s)", (version, description))
+                    conn.commit()
+                    print(f"Міграція {version} застосована: {description}")
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+                conn.commit()
+    except Exception:
+        broken = True
+        raise
+    finally:
+        db_pool.putconn(conn, broken=broken)
+
+def check_schema_version():
+    """Кидає SchemaOutdatedError, якщо міграції не дійшли до версії, потрібної цьому коду."""
+    with get_db_conn() as conn:
+        with conn.cursor() as cursor:
+            current = _current_schema_version(cursor)
+    if current < SCHEMA_VERSION:
+        raise SchemaOutdatedError(f"Схема БД версії {current}, потрібна {SCHEMA_VERSION}")
+    return current
 
 def init_db():
     if not DATABASE_URL: return
+    db_pool.open()
     try:
-        with get_db_conn() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute('''CREATE TABLE IF NOT EXISTS schedule
-                                 (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, day TEXT NOT NULL,
-                                  time TEXT NOT NULL, name TEXT NOT NULL, link TEXT,
-                                  week_type TEXT NOT NULL DEFAULT 'кожна', pair_order INTEGER DEFAULT 0)''')
-                cursor.execute('''CREATE TABLE IF NOT EXISTS users
-                                 (user_id BIGINT PRIMARY KEY, username TEXT, subscribed INTEGER DEFAULT 1)''')
-                cursor.execute('''CREATE TABLE IF NOT EXISTS sent_notifications
-                                 (notification_key TEXT PRIMARY KEY, sent_at TIMESTAMP WITH TIME ZONE NOT NULL)''')
-                cursor.execute('''CREATE TABLE IF NOT EXISTS user_facts
-                                 (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, fact_summary TEXT NOT NULL,
-                                  created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP)''')
-                cursor.execute('''CREATE TABLE IF NOT EXISTS deleted_pairs
-                                 (id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, day TEXT NOT NULL,
-                                  time TEXT NOT NULL, name TEXT NOT NULL, link TEXT,
-                                  week_type TEXT NOT NULL DEFAULT 'кожна', pair_order INTEGER DEFAULT 0,
-                                  deleted_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP)''')
-            conn.commit()
+        run_migrations()
     except Exception as e:
         print(f"ПОМИЛКА init_db: {e}")
+    # Навіть якщо міграції впали — не обслуговуємо запити на старій схемі
+    version = check_schema_version()
+    print(f"Схема БД: версія {version}")
 
 # ==========================================
 # ФУНКЦІЇ ДЛЯ ВІДНОВЛЕННЯ ВИДАЛЕНИХ ПАР
 # ==========================================
+DELETED_PAIRS_KEEP = 20
+SCHEDULE_INSERT_SQL = "INSERT INTO schedule (user_id, day, time, name, link, week_type, pair_order, start_time, duration_minutes) VALUES %s"
+
+_PAIR_TIME_RE = re.compile(r'^\s*([01]?\d|2[0-3])[:.]([0-5]\d)\s*$')
+
+def parse_pair_time(value) -> time:
+    """Розбирає час пари "ГГ:ХХ" (також "8:00", "8.00"). Кидає ValueError на некоректному значенні."""
+    m = _PAIR_TIME_RE.match(str(value)) if value is not None else None
+    if not m:
+        raise ValueError(f"Некоректний час пари: {value!r}")
+    return time(int(m.group(1)), int(m.group(2)))
+
+def schedule_row(user_id: int, day: str, time_str: str, name: str, link: str, week_type: str, pair_order: int) -> tuple:
+    """Рядок для SCHEDULE_INSERT_SQL: текстовий час нормалізується, start_time — типізований TIME."""
+    start_time = parse_pair_time(time_str)
+    return (user_id, day, start_time.strftime('%H:%M'), name, link, week_type, pair_order, start_time, PAIR_DURATION_MINUTES)
+
+def _save_deleted_pairs(cursor, user_id: int, pairs_to_save: list):
+    """Одним INSERT зберігає знімки пар у deleted_pairs і лишає тільки останні DELETED_PAIRS_KEEP."""
+    if not pairs_to_save:
+        return
+    psycopg2.extras.execute_values(
+        cursor,
+        "INSERT INTO deleted_pairs (user_id, day, time, name, link, week_type, pair_order) VALUES %s",
+        [(user_id, p['day'], p['time'], p['name'], str(p['link']), p['week_type'], p['pair_order']) for p in pairs_to_save]
+    )
+    cursor.execute(
+        "DELETE FROM deleted_pairs WHERE user_id=%s AND id NOT IN (SELECT id FROM deleted_pairs WHERE user_id=%s ORDER BY deleted_at DESC, id DESC LIMIT %s)",
+        (user_id, user_id, DELETED_PAIRS_KEEP)
+    )
+
+def _fetch_last_deleted_pairs(cursor, user_id: int) -> list:
+    # Спочатку шукаємо за останні 60 секунд
+    cursor.execute(
+        "SELECT day, time, name, link, week_type, pair_order FROM deleted_pairs WHERE user_id=%s AND deleted_at >= NOW() - INTERVAL '60 seconds' ORDER BY deleted_at DESC, id DESC LIMIT 10",
+        (user_id,)
+    )
+    rows = cursor.fetchall()
+    if not rows:
+        # Якщо нічого свіжого — беремо найостаннішу групу
+        cursor.execute(
+            "SELECT day, time, name, link, week_type, pair_order FROM deleted_pairs WHERE user_id=%s ORDER BY deleted_at DESC, id DESC LIMIT 5",
+            (user_id,)
+        )
+        rows = cursor.fetchall()
+    return [dict(r) for r in rows]
+
 def save_deleted_pairs(user_id: int, pairs_to_save: list):
     """Зберігає пари в таблицю deleted_pairs перед видаленням."""
     if not pairs_to_save:
@@ -102,17 +748,7 @@ def save_deleted_pairs(user_id: int, pairs_to_save: list):
     try:
         with get_db_conn() as conn:
             with conn.cursor() as cursor:
-                for p in pairs_to_save:
-                    cursor.execute(
-                        "INSERT INTO deleted_pairs (user_id, day, time, name, link, week_type, pair_order) VALUES (%s,%s,%s,%s,%s,%s,%s)",
-                        (user_id, p['day'], p['time'], p['name'], str(p['link']), p['week_type'], p['pair_order'])
-                    )
-                # Залишаємо тільки останні 20 видалених
-                cursor.execute(
-                    "DELETE FROM deleted_pairs WHERE id NOT IN (SELECT id FROM deleted_pairs WHERE user_id=%s ORDER BY deleted_at DESC LIMIT 20)",
-                    (user_id,)
-                )
-            conn.commit()
+                _save_deleted_pairs(cursor, user_id, pairs_to_save)
     except Exception as e:
         print(f"Помилка save_deleted_pairs: {e}")
 
@@ -121,110 +757,250 @@ def get_last_deleted_pairs(user_id: int) -> list:
     try:
         with get_db_conn() as conn:
             with conn.cursor() as cursor:
-                # Спочатку шукаємо за останні 60 секунд
-                cursor.execute(
-                    "SELECT day, time, name, link, week_type, pair_order FROM deleted_pairs WHERE user_id=%s AND deleted_at >= NOW() - INTERVAL '60 seconds' ORDER BY deleted_at DESC LIMIT 10",
-                    (user_id,)
-                )
-                rows = cursor.fetchall()
-                if not rows:
-                    # Якщо нічого свіжого — беремо найостаннішу групу
-                    cursor.execute(
-                        "SELECT day, time, name, link, week_type, pair_order FROM deleted_pairs WHERE user_id=%s ORDER BY deleted_at DESC LIMIT 5",
-                        (user_id,)
-                    )
-                    rows = cursor.fetchall()
-                return [dict(r) for r in rows]
+                return _fetch_last_deleted_pairs(cursor, user_id)
     except Exception:
         return []
 
 def format_deleted_pairs_for_prompt(pairs: list) -> str:
     if not pairs:
         return "Немає нещодавно видалених пар."
-    lines = []
-    for p in pairs:
-        lines.append(f"- {p['day'].capitalize()}, пара {p['pair_order']}, {p['time']}, {p['name']}, тиждень: {p['week_type']}, link: {p['link']}")
-    return "\n".join(lines)
+    return "\n".join(f"{prompt_slot_id(p)} {p['time']} {p['name']} | {prompt_link(p['link'])}" for p in pairs)
 
 
-# Функції для роботи з фактами
-def get_recent_facts(user_id: int):
-    try:
-        with get_db_conn() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("SELECT fact_summary FROM user_facts WHERE user_id = %s ORDER BY id DESC LIMIT 15", (user_id,))
-                return [row[0] for row in cursor.fetchall()]
-    except Exception:
-        return []
+# Функції для роботи з фактами.
+# Факти генеруються пачками у спільний пул (fact_pool), а кожному користувачу
+# видається ще не бачений факт; що саме він бачив — у user_facts.fact_id.
+def take_fact_from_pool(user_id: int):
+    """Видає користувачу найстаріший небачений факт. Повертає (текст або None, скільки небачених було)."""
+    with get_db_conn() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """SELECT f.id, f.fact, COUNT(*) OVER () AS unseen
+                   FROM fact_pool f
+                   WHERE NOT EXISTS (SELECT 1 FROM user_facts uf WHERE uf.user_id = %s AND uf.fact_id = f.id)
+                   ORDER BY f.id LIMIT 1""",
+                (user_id,)
+            )
+            row = cursor.fetchone()
+            if not row:
+                return None, 0
+            cursor.execute(
+                "INSERT INTO user_facts (user_id, fact_summary, fact_id) VALUES (%s, %s, %s)",
+                (user_id, row['fact'][:100], row['id'])
+            )
+        conn.commit()
+    return row['fact'], row['unseen']
 
-def save_fact(user_id: int, fact_summary: str):
-    try:
-        with get_db_conn() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("INSERT INTO user_facts (user_id, fact_summary) VALUES (%s, %s)", (user_id, fact_summary[:100]))
-            conn.commit()
-    except Exception as e:
-        print(f"Помилка збереження факту: {e}")
+def get_recent_pool_facts(limit: int = 40) -> list:
+    with get_db_conn() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT LEFT(fact, 100) FROM fact_pool ORDER BY id DESC LIMIT %s", (limit,))
+            return [row[0] for row in cursor.fetchall()]
 
-async def generate_unique_fact(user_id: int) -> str:
-    if not ai_client: return "Cohere API не підключено."
+def count_pool_facts() -> int:
+    with get_db_conn() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM fact_pool")
+            return cursor.fetchone()[0]
 
-    history = get_recent_facts(user_id)
+def add_facts_to_pool(facts: list) -> int:
+    if not facts:
+        return 0
+    with get_db_conn() as conn:
+        with conn.cursor() as cursor:
+            psycopg2.extras.execute_values(cursor, "INSERT INTO fact_pool (fact) VALUES %s", [(f,) for f in facts])
+        conn.commit()
+    return len(facts)
+
+async def generate_fact_batch(count: int) -> list:
+    """Одним запитом до Cohere генерує кілька нових фактів."""
+    history = await run_db(get_recent_pool_facts)
     history_str = "\n".join(f"- {f}" for f in history) if history else "Немає історії."
 
-    prompt = f"""Розкажи ОДИН дуже цікавий, маловідомий факт про архітектуру ПК, мережі, кібербезпеку або програмування.
-    Пиши суто текст, без форматування і без довгих вступів.
-    ЗАБОРОНЕНІ ФАКТИ (користувач їх вже знає):
+    prompt = f"""Розкажи {count} різних дуже цікавих, маловідомих фактів про архітектуру ПК, мережі, кібербезпеку або програмування.
+    Кожен факт — 1-3 речення, суто текст, без форматування і без довгих вступів.
+    ПОВЕРТАЙ ВИКЛЮЧНО JSON-масив рядків: ["факт 1", "факт 2", ...]
+    ЗАБОРОНЕНІ ФАКТИ (вже є в базі):
     {history_str}"""
 
-    try:
-        response = await ai_client.chat(
-            message="Сгенеруй цікавий ІТ-факт.",
-            preamble=prompt,
-            model="command-a-03-2025",
-            temperature=0.7
-        )
-        fact = response.text.strip()
-        save_fact(user_id, fact)
+    response = await llm_client.chat(
+        message=f"Згенеруй {count} цікавих ІТ-фактів.",
+        preamble=prompt,
+        model=AI_MODEL,
+        temperature=0.8
+    )
+    raw_text = response.text.strip()
+    match = re.search(r'\[.*\]', raw_text, re.DOTALL)
+    facts = json.loads(match.group(0) if match else raw_text)
+    known = {h.lower() for h in history}
+    result = []
+    for fact in facts:
+        if not isinstance(fact, str):
+            continue
+        fact = fact.strip()
+        if fact and fact[:100].lower() not in known:
+            known.add(fact[:100].lower())
+            result.append(fact)
+    return result
+
+class FactPool:
+    """
+    Пул заздалегідь згенерованих ІТ-фактів.
+    get_fact() не ходить у Cohere, поки у користувача є небачені факти;
+    коли їх лишається менше low_watermark — у фоні догенеровується нова пачка.
+    Пачки генерує лише воркер-лідер (інакше кожен воркер запускав би свою і факти дублювались);
+    решта воркерів просять його через pg_notify і чекають, поки факти з'являться в пулі.
+    """
+    REQUEST_INTERVAL = 1.0        # не частіше одного прохання до лідера з воркера, сек
+    LEADER_WAIT_SECONDS = 30.0    # скільки воркер чекає на пачку лідера для порожнього пулу
+    LEADER_POLL_SECONDS = 1.0
+
+    def __init__(self, batch_size: int, low_watermark: int):
+        self.batch_size = batch_size
+        self.low_watermark = low_watermark
+        self._refill_task = None
+        self._requested_at = None
+        self.stats = {"served": 0, "empty": 0, "batches": 0, "generated": 0, "errors": 0, "requests": 0}
+
+    @staticmethod
+    def _owns_refill() -> bool:
+        # Без виборів лідера (скрипти, один процес без lifespan) генерує сам процес
+        return leader_elector.is_leader or not leader_elector.running
+
+    def ensure_refill(self):
+        """
+        Запускає догенерацію, якщо вона ще не йде. Повертає задачу догенерації;
+        у воркері, що не є лідером, лише просить лідера і повертає None.
+        """
+        if not ai_available():
+            return None
+        if not self._owns_refill():
+            self._request_refill()
+            return None
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+        return self._refill_task
+
+    def _request_refill(self):
+        now = monotonic()
+        if self._requested_at is not None and now - self._requested_at < self.REQUEST_INTERVAL:
+            return
+        self._requested_at = now
+        self.stats["requests"] += 1
+        asyncio.create_task(self._publish_request())
+
+    async def _publish_request(self):
+        try:
+            await run_db(publish_fact_refill_request)
+        except Exception as e:
+            print(f"Не вдалося попросити лідера про факти: {e}")
+
+    def on_refill_requested(self, payload: str):
+        """Сповіщення з FACT_REFILL_CHANNEL: пачку запускає лише лідер."""
+        if leader_elector.is_leader:
+            self.ensure_refill()
+
+    async def _wait_for_refill(self, user_id: int):
+        """Чекає нову пачку для порожнього пулу: власну догенерацію або, у не-лідері, пачку лідера."""
+        deadline = monotonic() + self.LEADER_WAIT_SECONDS
+        while True:
+            # Прохання повторюється: попереднє могло піти на пачку, яку вже роздали
+            refill = self.ensure_refill()
+            if refill is not None:
+                await refill
+                return await run_db(take_fact_from_pool, user_id)
+            if monotonic() >= deadline:
+                return None, 0
+            await asyncio.sleep(self.LEADER_POLL_SECONDS)
+            fact, unseen = await run_db(take_fact_from_pool, user_id)
+            if fact is not None:
+                return fact, unseen
+
+    async def _refill(self):
+        try:
+            facts = await generate_fact_batch(self.batch_size)
+            added = await run_db(add_facts_to_pool, facts)
+            self.stats["batches"] += 1
+            self.stats["generated"] += added
+            fact_batches_total.inc("ok")
+            facts_generated_total.inc(amount=added)
+        except Exception as e:
+            self.stats["errors"] += 1
+            fact_batches_total.inc("error")
+            print(f"Помилка генерації фактів: {e}")
+
+    async def warm_up(self):
+        """На старті наповнює порожній пул, щоб перші нагадування не чекали на Cohere."""
+        try:
+            if await run_db(count_pool_facts) < self.batch_size:
+                refill = self.ensure_refill()
+                if refill:
+                    await refill
+        except Exception as e:
+            print(f"Помилка підготовки пулу фактів: {e}")
+
+    async def get_fact(self, user_id: int) -> str:
+        fact, unseen = await run_db(take_fact_from_pool, user_id)
+        if fact is None:
+            # Пул для цього користувача вичерпано — чекаємо спільну пачку, а не окремий запит на кожного
+            self.stats["empty"] += 1
+            if not ai_available():
+                return "Cohere API не підключено."
+            fact, unseen = await self._wait_for_refill(user_id)
+            if fact is None:
+                return "Не вдалося згенерувати факт."
+        if unseen - 1 < self.low_watermark:
+            self.ensure_refill()
+        self.stats["served"] += 1
+        return fact
+
+    async def take_ready_fact(self, user_id: int):
+        """Факт лише з готового пулу — без очікування на Cohere. Якщо небачених немає, повертає None і догенеровує у фоні."""
+        fact, unseen = await run_db(take_fact_from_pool, user_id)
+        if fact is None:
+            self.stats["empty"] += 1
+            self.ensure_refill()
+            return None
+        if unseen - 1 < self.low_watermark:
+            self.ensure_refill()
+        self.stats["served"] += 1
         return fact
-    except Exception as e:
-        return "Не вдалося згенерувати факт."
+
+fact_pool = FactPool(FACT_BATCH_SIZE, FACT_POOL_LOW_WATERMARK)
 
 # ==========================================
 # ФУНКЦІЇ РОБОТИ З БД
 # ==========================================
+def _delete_slot(cursor, user_id: int, day: str, pair_order: int, week_type: str) -> list:
+    """Видаляє пари слота (день + номер + тиждень) і одразу повертає їх (DELETE ... RETURNING)."""
+    if week_type == "кожна":
+        cursor.execute("DELETE FROM schedule WHERE user_id=%s AND day=%s AND pair_order=%s RETURNING *", (user_id, day, pair_order))
+    else:
+        cursor.execute("DELETE FROM schedule WHERE user_id=%s AND day=%s AND pair_order=%s AND week_type IN (%s, 'кожна') RETURNING *", (user_id, day, pair_order, week_type))
+    return [dict(r) for r in cursor.fetchall()]
+
+def _delete_by_name(cursor, user_id: int, day: str, name_keywords: list) -> list:
+    # Будуємо OR-умову для кожного ключового слова
+    conditions = " OR ".join(["LOWER(name) LIKE %s" for _ in name_keywords])
+    params = [user_id, day] + [f"%{kw.lower()}%" for kw in name_keywords]
+    cursor.execute(f"DELETE FROM schedule WHERE user_id=%s AND day=%s AND ({conditions}) RETURNING *", params)
+    return [dict(r) for r in cursor.fetchall()]
+
 def add_pair_to_db(user_id: int, day: str, time_str: str, name: str, link: str, week_type: str, pair_order: int = 0):
-    sql = "INSERT INTO schedule (user_id, day, time, name, link, week_type, pair_order) VALUES (%s, %s, %s, %s, %s, %s, %s)"
     with get_db_conn() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(sql, (user_id, day.lower(), time_str, name, link, week_type, pair_order))
-        conn.commit()
+            psycopg2.extras.execute_values(cursor, SCHEDULE_INSERT_SQL, [schedule_row(user_id, day.lower(), time_str, name, link, week_type, pair_order)])
+            publish_schedule_change(cursor, user_id, [day.lower()])
+    notify_schedule_changed([day.lower()])
 
 def delete_specific_pair(user_id: int, day: str, pair_order: int, week_type: str):
-    # Спочатку зберігаємо пари що будуть видалені
-    try:
-        with get_db_conn() as conn:
-            with conn.cursor() as cursor:
-                if week_type == "кожна":
-                    cursor.execute("SELECT * FROM schedule WHERE user_id=%s AND day=%s AND pair_order=%s", (user_id, day.lower(), pair_order))
-                else:
-                    cursor.execute("SELECT * FROM schedule WHERE user_id=%s AND day=%s AND pair_order=%s AND week_type IN (%s, 'кожна')", (user_id, day.lower(), pair_order, week_type))
-                to_save = [dict(r) for r in cursor.fetchall()]
-        save_deleted_pairs(user_id, to_save)
-    except Exception:
-        pass
-
-    if week_type == "кожна":
-        sql = "DELETE FROM schedule WHERE user_id=%s AND day=%s AND pair_order=%s"
-        params = (user_id, day.lower(), pair_order)
-    else:
-        sql = "DELETE FROM schedule WHERE user_id=%s AND day=%s AND pair_order=%s AND week_type IN (%s, 'кожна')"
-        params = (user_id, day.lower(), pair_order, week_type)
-
+    # Видалені пари зберігаються для відновлення в тій самій транзакції
     with get_db_conn() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(sql, params)
-        conn.commit()
+            deleted = _delete_slot(cursor, user_id, day.lower(), pair_order, week_type)
+            _save_deleted_pairs(cursor, user_id, deleted)
+            publish_schedule_change(cursor, user_id, [day.lower()])
+    notify_schedule_changed([day.lower()])
 
 # ==========================================
 # НОВА ФУНКЦІЯ: видалення за ключовими словами у назві (підтримує список)
@@ -237,32 +1013,13 @@ def delete_pair_by_name(user_id: int, day: str, name_keywords) -> int:
     """
     if isinstance(name_keywords, str):
         name_keywords = [name_keywords]
-
-    # Будуємо OR-умову для кожного ключового слова
-    conditions = " OR ".join(["LOWER(name) LIKE %s" for _ in name_keywords])
-    params = [user_id, day.lower()] + [f"%{kw.lower()}%" for kw in name_keywords]
-
-    # Спочатку зберігаємо пари що будуть видалені
-    try:
-        save_params = [user_id, day.lower()] + [f"%{kw.lower()}%" for kw in name_keywords]
-        save_conditions = " OR ".join(["LOWER(name) LIKE %s" for _ in name_keywords])
-        with get_db_conn() as conn:
-            with conn.cursor() as cursor:
-                cursor.execute(f"SELECT * FROM schedule WHERE user_id=%s AND day=%s AND ({save_conditions})", save_params)
-                to_save = [dict(r) for r in cursor.fetchall()]
-        save_deleted_pairs(user_id, to_save)
-    except Exception:
-        pass
-
     with get_db_conn() as conn:
         with conn.cursor() as cursor:
-            cursor.execute(
-                f"DELETE FROM schedule WHERE user_id=%s AND day=%s AND ({conditions})",
-                params
-            )
-            deleted = cursor.rowcount
-        conn.commit()
-    return deleted
+            deleted = _delete_by_name(cursor, user_id, day.lower(), name_keywords)
+            _save_deleted_pairs(cursor, user_id, deleted)
+            publish_schedule_change(cursor, user_id, [day.lower()])
+    notify_schedule_changed([day.lower()])
+    return len(deleted)
 
 # ==========================================
 # ЛОКАЛЬНИЙ ПАРСЕР РОЗКЛАДУ (без AI)
@@ -282,66 +1039,81 @@ def is_full_schedule_text(text: str) -> bool:
     count = sum(1 for header in FULL_SCHEDULE_DAY_HEADERS if header in upper)
     return count >= 3
 
+DB_TO_AI_DAYS = {v: k for k, v in AI_TO_DB_DAYS.items()}
+
+# Усі регулярки парсера компілюються один раз при імпорті
+_PAIR_LINE_RE = re.compile(r'^\s*(\d+)\s*пара\s*[:\-]?\s*(.*)', re.IGNORECASE)
+# Голова умовної пари "Якщо X-Y тип, то "; тіло — до наступного "\nЯкщо" або кінця тексту
+_COND_HEAD_RE = re.compile(r'Якщо\s+(\d+)-(\d+)\s+(\S+)\s*,?\s*то\s+', re.IGNORECASE)
+_COND_NEXT_RE = re.compile(r'\nЯкщо', re.IGNORECASE)
+_URL_RE = re.compile(r'(https?://\S+)')
+_ZOOM_CODE_RE = re.compile(r'(№\s*:\s*[\d\s]+(?:Код\s*доступ[аu]\s*:\s*\S+)?)', re.IGNORECASE)
+_ZOOM_CODE_TAIL_RE = re.compile(r'№\s*:\s*[\d\s]+.*$')
+_ZOOM_NUMBER_TAIL_RE = re.compile(r'№\s*:.*$')
+_ACCESS_CODE_RE = re.compile(r'Код\s*доступ[аu]\s*:\s*(\S+)', re.IGNORECASE)
+_ACCESS_CODE_TAIL_RE = re.compile(r'Код\s*доступ[аu]\s*:.*$', re.IGNORECASE)
+_WEEK_RANGE_RE = re.compile(r'\(\d+-\d+\s+\S+\)\s*')
+
 def parse_full_schedule_locally(text: str) -> list:
     """
     Парсить повний розклад з тексту та повертає список db_actions.
     Повертає [{"action": "DELETE_ALL"}, {"action": "ADD", "data": {...}}, ...]
+
+    Один прохід по рядках: заголовок дня (окремий рядок) відкриває день,
+    рядок "N пара" — нову пару, решта рядків належить поточній парі.
     """
     actions = [{"action": "DELETE_ALL"}]
 
-    # Розбиваємо текст на блоки по днях
-    # Шукаємо заголовки днів та їх позиції
-    day_positions = []
-    upper_text = text.upper()
-    for header, day_ukr in FULL_SCHEDULE_DAY_HEADERS.items():
-        # Знаходимо всі входження заголовка (на окремому рядку або на початку)
-        for m in re.finditer(r'(?:^|\n)\s*' + re.escape(header) + r'\s*(?:\n|$)', upper_text):
-            day_positions.append((m.start(), day_ukr))
-
-    # Сортуємо за позицією в тексті
-    day_positions.sort(key=lambda x: x[0])
-
-    # Розбиваємо текст на блоки
-    day_blocks = []
-    for i, (pos, day_ukr) in enumerate(day_positions):
-        if i + 1 < len(day_positions):
-            block_text = text[pos:day_positions[i + 1][0]]
-        else:
-            block_text = text[pos:]
-        day_blocks.append((day_ukr, block_text))
-
-    for day_ukr, block in day_blocks:
-        _parse_day_block(day_ukr, block, actions)
-
-    return actions
-
-def _parse_day_block(day_ukr: str, block: str, actions: list):
-    """Парсить один день та додає ADD-дії до actions."""
-    day_eng_map = {v: k for k, v in AI_TO_DB_DAYS.items()}
-    day_eng = day_eng_map.get(day_ukr, "Monday")
-
-    lines = block.split('\n')
-
-    # Знаходимо пари
-    current_pair_order = None
-    current_lines = []
+    day_eng = None
+    pair_order = None
+    pair_lines = []
+
+    for line in text.split('\n'):
+        stripped = line.strip()
+        day_ukr = FULL_SCHEDULE_DAY_HEADERS.get(stripped.upper())
+        if day_ukr:
+            if pair_order is not None:
+                _process_pair_lines(day_eng, pair_order, pair_lines, actions)
+            day_eng = DB_TO_AI_DAYS.get(day_ukr, "Monday")
+            pair_order = None
+            pair_lines = []
+            continue
+        # Текст до першого заголовка дня ігнорується
+        if day_eng is None:
+            continue
 
-    for line in lines:
-        # Перевіряємо чи це початок нової пари
-        pair_match = re.match(r'^\s*(\d+)\s*пара\s*[:\-]?\s*(.*)', line, re.IGNORECASE)
+        pair_match = _PAIR_LINE_RE.match(line)
         if pair_match:
             # Зберігаємо попередню пару
-            if current_pair_order is not None:
-                _process_pair_lines(day_eng, current_pair_order, current_lines, actions)
-            current_pair_order = int(pair_match.group(1))
+            if pair_order is not None:
+                _process_pair_lines(day_eng, pair_order, pair_lines, actions)
+            pair_order = int(pair_match.group(1))
             rest = pair_match.group(2).strip()
-            current_lines = [rest] if rest else []
-        elif current_pair_order is not None:
-            current_lines.append(line.strip())
+            pair_lines = [rest] if rest else []
+        elif pair_order is not None:
+            pair_lines.append(stripped)
 
     # Зберігаємо останню пару
-    if current_pair_order is not None:
-        _process_pair_lines(day_eng, current_pair_order, current_lines, actions)
+    if pair_order is not None:
+        _process_pair_lines(day_eng, pair_order, pair_lines, actions)
+
+    return actions
+
+def _iter_conditionals(full_text: str):
+    """
+    Повертає (початковий тиждень, текст після "то") для кожного "Якщо X-Y тип, то ...".
+    Межі тіла шукаються прямим пошуком без lazy-DOTALL регулярки, тож прохід лінійний.
+    """
+    pos = 0
+    while True:
+        head = _COND_HEAD_RE.search(full_text, pos)
+        if not head:
+            return
+        # Тіло — щонайменше один символ, далі до наступного "\nЯкщо"
+        next_cond = _COND_NEXT_RE.search(full_text, head.end() + 1)
+        end = next_cond.start() if next_cond else len(full_text)
+        yield int(head.group(1)), full_text[head.end():end]
+        pos = end
 
 def _process_pair_lines(day_eng: str, order: int, lines: list, actions: list):
     """Обробляє рядки однієї пари та створює ADD-дії."""
@@ -352,22 +1124,14 @@ def _process_pair_lines(day_eng: str, order: int, lines: list, actions: list):
         return
 
     # Перевіряємо чи є умовні пари (Якщо X-Y тип, то назва)
-    conditional_pattern = r'Якщо\s+(\d+)-(\d+)\s+(\S+)\s*,?\s*то\s+(.+?)(?=\nЯкщо|\Z)'
-    conditionals = list(re.finditer(conditional_pattern, full_text, re.DOTALL | re.IGNORECASE))
+    conditionals = list(_iter_conditionals(full_text))
 
     if conditionals:
-        for match in conditionals:
-            start_week = int(match.group(1))
-            # type_str = match.group(3)  # лабораторна/практика/лекція
-            rest_text = match.group(4).strip()
-
+        for start_week, rest_text in conditionals:
             # Визначаємо тиждень: парне число = even, непарне = odd
-            if start_week % 2 == 0:
-                week = "even"
-            else:
-                week = "odd"
+            week = "even" if start_week % 2 == 0 else "odd"
 
-            subject, link = _extract_subject_and_link(rest_text)
+            subject, link = _extract_subject_and_link(rest_text.strip())
             if subject:
                 actions.append({
                     "action": "ADD",
@@ -380,23 +1144,15 @@ def _process_pair_lines(day_eng: str, order: int, lines: list, actions: list):
                     }
                 })
     else:
-        # Звичайна пара (без умов)
-        # Перевіряємо формат: (1-15 тип) Назва - Викладач LINK
+        # Звичайна пара (без умов): (1-15 тип) Назва - Викладач LINK — це "both" (кожна)
         subject, link = _extract_subject_and_link_from_regular(full_text)
         if subject:
-            # Визначаємо тиждень
-            week_match = re.search(r'\((\d+)-(\d+)\s+\S+\)', full_text)
-            week = "both"
-            if week_match:
-                # Якщо є (X-Y тип) без "Якщо" — це "both" (кожна)
-                week = "both"
-
             actions.append({
                 "action": "ADD",
                 "data": {
                     "day": day_eng,
                     "order": order,
-                    "week": week,
+                    "week": "both",
                     "subject": subject.strip(),
                     "link": link
                 }
@@ -410,14 +1166,14 @@ def _extract_subject_and_link(text: str) -> tuple:
 
     # Шукаємо URL у всіх рядках
     all_text = '\n'.join(lines)
-    url_match = re.search(r'(https?://\S+)', all_text)
+    url_match = _URL_RE.search(all_text)
     if url_match:
         link = url_match.group(1)
         # Видаляємо URL з subject_line якщо він там
         subject_line = subject_line.replace(link, '').strip()
 
     # Шукаємо "№: ... Код доступа: ..." у всіх рядках
-    code_match = re.search(r'(№\s*:\s*[\d\s]+(?:Код\s*доступ[аu]\s*:\s*\S+)?)', all_text, re.IGNORECASE)
+    code_match = _ZOOM_CODE_RE.search(all_text)
     if code_match:
         if link == "None":
             link = code_match.group(1).strip()
@@ -426,8 +1182,8 @@ def _extract_subject_and_link(text: str) -> tuple:
         subject_line = subject_line.replace(code_match.group(1), '').strip()
 
     # Видаляємо classroom/zoom info з subject
-    subject_line = re.sub(r'https?://\S+', '', subject_line).strip()
-    subject_line = re.sub(r'№\s*:\s*[\d\s]+.*$', '', subject_line).strip()
+    subject_line = _URL_RE.sub('', subject_line).strip()
+    subject_line = _ZOOM_CODE_TAIL_RE.sub('', subject_line).strip()
 
     # Прибираємо trailing дефіс або крапку
     subject_line = subject_line.rstrip(' -.,')
@@ -437,7 +1193,7 @@ def _extract_subject_and_link(text: str) -> tuple:
 def _extract_subject_and_link_from_regular(text: str) -> tuple:
     """Витягує назву та посилання зі звичайної пари (без умов)."""
     # Видаляємо частину (1-15 тип)
-    cleaned = re.sub(r'\(\d+-\d+\s+\S+\)\s*', '', text, count=1).strip()
+    cleaned = _WEEK_RANGE_RE.sub('', text, count=1).strip()
 
     lines = cleaned.split('\n')
     first_line = lines[0].strip()
@@ -446,12 +1202,12 @@ def _extract_subject_and_link_from_regular(text: str) -> tuple:
     link = "None"
 
     # Шукаємо URL
-    url_match = re.search(r'(https?://\S+)', all_text)
+    url_match = _URL_RE.search(all_text)
     if url_match:
         link = url_match.group(1)
 
     # Шукаємо "№: ... Код доступа: ..."
-    code_match = re.search(r'(№\s*:\s*[\d\s]+(?:Код\s*доступ[аu]\s*:\s*\S+)?)', all_text, re.IGNORECASE)
+    code_match = _ZOOM_CODE_RE.search(all_text)
     if code_match:
         code_info = code_match.group(1).strip()
         if link == "None":
@@ -460,7 +1216,7 @@ def _extract_subject_and_link_from_regular(text: str) -> tuple:
             link = link + " " + code_info
 
     # Шукаємо "Код доступа: ..." окремо (може бути без №)
-    kod_match = re.search(r'Код\s*доступ[аu]\s*:\s*(\S+)', all_text, re.IGNORECASE)
+    kod_match = _ACCESS_CODE_RE.search(all_text)
     if kod_match:
         kod_full = kod_match.group(0).strip()
         if kod_full not in (link or ""):
@@ -471,208 +1227,325 @@ def _extract_subject_and_link_from_regular(text: str) -> tuple:
 
     # Прибираємо URL і коди з назви предмета
     subject = first_line
-    subject = re.sub(r'https?://\S+', '', subject).strip()
-    subject = re.sub(r'№\s*:.*$', '', subject).strip()
-    subject = re.sub(r'Код\s*доступ[аu]\s*:.*$', '', subject, flags=re.IGNORECASE).strip()
+    subject = _URL_RE.sub('', subject).strip()
+    subject = _ZOOM_NUMBER_TAIL_RE.sub('', subject).strip()
+    subject = _ACCESS_CODE_TAIL_RE.sub('', subject).strip()
     subject = subject.rstrip(' -.,')
 
     return subject if subject else None, link
 
 
-def execute_db_actions(user_id: int, actions_list):
+class _ActionBatch:
+    """
+    Стан одного виконання execute_db_actions усередині однієї транзакції.
+    Нові пари і знімки видалених накопичуються в пам'яті й записуються пачкою (flush),
+    а після DELETE_ALL видалення слотів робляться лише в пам'яті — у БД пар користувача вже немає.
+    """
+    def __init__(self, cursor, user_id: int):
+        self.cursor = cursor
+        self.user_id = user_id
+        self.pending_rows = []     # рядки schedule_row(): (user_id, day, time, name, link, week_type, pair_order, ...)
+        self.deleted_snapshots = []
+        self.schedule_empty = False
+        self.touched_days = set()
+        self.all_days = False
+
+    def add(self, day: str, time_str: str, name: str, link: str, week_type: str, pair_order: int):
+        self.pending_rows.append(schedule_row(self.user_id, day, time_str, name, link, week_type, pair_order))
+        self.touched_days.add(day)
+
+    def delete_slot(self, day: str, pair_order: int, week_type: str) -> int:
+        """Аналог delete_specific_pair: прибирає слот і з БД, і з ще не записаних пар. Повертає кількість прибраних пар."""
+        def _matches(row):
+            return row[1] == day and row[6] == pair_order and (week_type == "кожна" or row[5] in (week_type, "кожна"))
+        kept = []
+        removed = 0
+        for row in self.pending_rows:
+            if _matches(row):
+                self.deleted_snapshots.append({"day": row[1], "time": row[2], "name": row[3], "link": row[4], "week_type": row[5], "pair_order": row[6]})
+                removed += 1
+            else:
+                kept.append(row)
+        self.pending_rows = kept
+        if not self.schedule_empty:
+            deleted = _delete_slot(self.cursor, self.user_id, day, pair_order, week_type)
+            self.deleted_snapshots.extend(deleted)
+            removed += len(deleted)
+        self.touched_days.add(day)
+        return removed
+
+    def flush(self):
+        """Записує накопичене; викликається перед діями, які читають або змінюють рядки в БД напряму."""
+        if self.pending_rows:
+            psycopg2.extras.execute_values(self.cursor, SCHEDULE_INSERT_SQL, self.pending_rows, page_size=1000)
+            self.pending_rows = []
+            self.schedule_empty = False
+        if self.deleted_snapshots:
+            _save_deleted_pairs(self.cursor, self.user_id, self.deleted_snapshots)
+            self.deleted_snapshots = []
+
+KNOWN_DB_ACTIONS = {
+    "ADD", "UPDATE", "DELETE", "DELETE_ALL", "DELETE_BY_NAME", "RESTORE", "SWAP", "UPDATE_LINK", "UPDATE_FIELD",
+}
+
+def execute_db_actions(user_id: int, actions_list, counts: list = None):
+    """
+    Виконує весь список дій в одному з'єднанні та одній транзакції:
+    при помилці відкочується все, і розклад не лишається записаним наполовину.
+    У counts (якщо передано) дописується кількість змін кожної дії.
+    """
     processed_count = 0
     if not isinstance(actions_list, list): return 0
 
-    for item in actions_list:
-        action = item.get("action")
-
-        if action == "DELETE_ALL":
-            with get_db_conn() as conn:
-                with conn.cursor() as cursor:
-                    cursor.execute("DELETE FROM schedule WHERE user_id=%s", (user_id,))
-                conn.commit()
-            processed_count += 1
-            continue
-
-        # ---- ДІЯ: видалення за назвою (підтримує список keywords) ----
-        if action == "DELETE_BY_NAME":
-            data = item.get("data", {})
-            day_eng = data.get("day")
-            # Підтримуємо і старе поле name_keyword, і нове name_keywords (список)
-            name_keywords = data.get("name_keywords") or data.get("name_keyword", "")
-            if isinstance(name_keywords, str):
-                name_keywords = [kw.strip() for kw in name_keywords.split(",") if kw.strip()]
-            if day_eng and name_keywords:
-                day_ukr = AI_TO_DB_DAYS.get(day_eng, "")
-                if day_ukr:
-                    deleted = delete_pair_by_name(user_id, day_ukr, name_keywords)
-                    processed_count += deleted
-            continue
-        # -------------------------------------------------------
-
-        # ---- ДІЯ: відновлення останніх видалених пар ----
-        if action == "RESTORE":
-            pairs_to_restore = get_last_deleted_pairs(user_id)
-            for p in pairs_to_restore:
-                try:
-                    # Спочатку видаляємо дублікат якщо вже існує (щоб не було 5 пар)
-                    delete_specific_pair(user_id, p['day'], p['pair_order'], p['week_type'])
-                    add_pair_to_db(user_id, p['day'], p['time'], p['name'], str(p['link']), p['week_type'], p['pair_order'])
-                    processed_count += 1
-                except Exception as e:
-                    print(f"Помилка відновлення пари: {e}")
-            continue
-        # -------------------------------------------------
-
-        # ---- ДІЯ: поміняти дві пари місцями ----
-        if action == "SWAP":
-            data = item.get("data", {})
-            day_eng = data.get("day")
-            order_a = data.get("order_a")
-            order_b = data.get("order_b")
-            week_eng = data.get("week", "both")
-            if day_eng and order_a and order_b:
-                day_ukr = AI_TO_DB_DAYS.get(day_eng, "")
-                week_ukr = AI_TO_DB_WEEKS.get(week_eng, "кожна")
-                if day_ukr:
-                    try:
-                        with get_db_conn() as conn:
-                            with conn.cursor() as cursor:
-                                # Читаємо обидві пари
-                                cursor.execute("SELECT * FROM schedule WHERE user_id=%s AND day=%s AND pair_order=%s AND (week_type=%s OR week_type='кожна')", (user_id, day_ukr, order_a, week_ukr))
-                                pairs_a = [dict(r) for r in cursor.fetchall()]
-                                cursor.execute("SELECT * FROM schedule WHERE user_id=%s AND day=%s AND pair_order=%s AND (week_type=%s OR week_type='кожна')", (user_id, day_ukr, order_b, week_ukr))
-                                pairs_b = [dict(r) for r in cursor.fetchall()]
-                                # Видаляємо обидві
-                                cursor.execute("DELETE FROM schedule WHERE user_id=%s AND day=%s AND pair_order IN (%s,%s)", (user_id, day_ukr, order_a, order_b))
-                            conn.commit()
-                        # Вставляємо з переставленими номерами та часом
-                        time_a = PAIR_TIMES.get(order_a, "00:00")
-                        time_b = PAIR_TIMES.get(order_b, "00:00")
-                        for p in pairs_a:
-                            add_pair_to_db(user_id, day_ukr, time_b, p['name'], str(p['link']), p['week_type'], order_b)
-                        for p in pairs_b:
-                            add_pair_to_db(user_id, day_ukr, time_a, p['name'], str(p['link']), p['week_type'], order_a)
-                        processed_count += 1
-                    except Exception as e:
-                        print(f"Помилка SWAP: {e}")
-            continue
-        # ------------------------------------------
+    with get_db_conn() as conn:
+        with conn.cursor() as cursor:
+            batch = _ActionBatch(cursor, user_id)
+            for item in actions_list:
+                changes = _apply_action(batch, item)
+                processed_count += changes
+                if counts is not None:
+                    counts.append(changes)
+                action = item.get("action") if isinstance(item, dict) else None
+                schedule_actions_total.inc(action if action in KNOWN_DB_ACTIONS else "other")
+            batch.flush()
+            changed_days = None if batch.all_days else batch.touched_days
+            # Порожній список дій (звичайна відповідь AI) не чіпає розклад — кеші лишаються дійсними
+            if batch.all_days or batch.touched_days:
+                publish_schedule_change(cursor, user_id, changed_days)
+
+    if batch.all_days or batch.touched_days:
+        notify_schedule_changed(changed_days)
+    return processed_count
 
+def _pair_order(value):
+    """Номер пари з даних AI: 2 і "2" → 2; None, "", "друга", 0, 2.5 → None."""
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        return None
+    try:
+        order = int(value)
+    except (TypeError, ValueError):
+        return None
+    return order if order > 0 else None
+
+def _apply_action(batch: _ActionBatch, item) -> int:
+    """Застосовує одну дію з db_actions. Повертає кількість змін."""
+    cursor, user_id = batch.cursor, batch.user_id
+    action = item.get("action")
+
+    if action == "DELETE_ALL":
+        batch.pending_rows = []
+        cursor.execute("DELETE FROM schedule WHERE user_id=%s", (user_id,))
+        batch.schedule_empty = True
+        batch.all_days = True
+        return 1
+
+    # ---- ДІЯ: видалення за назвою (підтримує список keywords) ----
+    if action == "DELETE_BY_NAME":
+        data = item.get("data", {})
+        day_eng = data.get("day")
+        # Підтримуємо і старе поле name_keyword, і нове name_keywords (список)
+        name_keywords = data.get("name_keywords") or data.get("name_keyword", "")
+        if isinstance(name_keywords, str):
+            name_keywords = [kw.strip() for kw in name_keywords.split(",") if kw.strip()]
+        day_ukr = AI_TO_DB_DAYS.get(day_eng, "") if day_eng else ""
+        if not day_ukr or not name_keywords:
+            return 0
+        batch.flush()
+        deleted = _delete_by_name(cursor, user_id, day_ukr, name_keywords)
+        batch.deleted_snapshots.extend(deleted)
+        batch.touched_days.add(day_ukr)
+        return len(deleted)
+    # -------------------------------------------------------
+
+    # ---- ДІЯ: відновлення останніх видалених пар ----
+    if action == "RESTORE":
+        batch.flush()
+        restored = 0
+        for p in _fetch_last_deleted_pairs(cursor, user_id):
+            try:
+                parse_pair_time(p['time'])
+            except ValueError:
+                print(f"Пропущено відновлення пари з некоректним часом: {p['time']!r}")
+                continue
+            # Спочатку видаляємо дублікат якщо вже існує (щоб не було 5 пар)
+            batch.delete_slot(p['day'], p['pair_order'], p['week_type'])
+            batch.add(p['day'], p['time'], p['name'], str(p['link']), p['week_type'], p['pair_order'])
+            restored += 1
+        restored_pairs_total.inc(amount=restored)
+        return restored
+    # -------------------------------------------------
+
+    # ---- ДІЯ: поміняти дві пари місцями ----
+    if action == "SWAP":
         data = item.get("data", {})
-        if not action or not data: continue
-
         day_eng = data.get("day")
-        week_eng = data.get("week", "both")
-        order = data.get("order")
-        subject = data.get("subject", "Без назви")
-        link = data.get("link", "None")
-        custom_time = data.get("custom_time")
+        # AI може прислати номер рядком ("2") — приводимо до int до порівнянь і PAIR_TIMES
+        order_a = _pair_order(data.get("order_a"))
+        order_b = _pair_order(data.get("order_b"))
+        week_ukr = AI_TO_DB_WEEKS.get(data.get("week", "both"), "кожна")
+        day_ukr = AI_TO_DB_DAYS.get(day_eng, "") if day_eng else ""
+        if not (day_ukr and order_a and order_b):
+            return 0
+        batch.flush()
+        # Забираємо рівно ті пари, що переставляються (для конкретного тижня — разом з "кожна")
+        if week_ukr == "кожна":
+            cursor.execute(
+                "DELETE FROM schedule WHERE user_id=%s AND day=%s AND pair_order IN (%s,%s) RETURNING *",
+                (user_id, day_ukr, order_a, order_b)
+            )
+        else:
+            cursor.execute(
+                "DELETE FROM schedule WHERE user_id=%s AND day=%s AND pair_order IN (%s,%s) AND week_type IN (%s, 'кожна') RETURNING *",
+                (user_id, day_ukr, order_a, order_b, week_ukr)
+            )
+        moved = [dict(r) for r in cursor.fetchall()]
+        # Вставляємо з переставленими номерами та часом
+        time_a = PAIR_TIMES.get(order_a, "00:00")
+        time_b = PAIR_TIMES.get(order_b, "00:00")
+        for p in moved:
+            if p['pair_order'] == order_a:
+                batch.add(day_ukr, time_b, p['name'], str(p['link']), p['week_type'], order_b)
+            else:
+                batch.add(day_ukr, time_a, p['name'], str(p['link']), p['week_type'], order_a)
+        return 1 if moved else 0
+    # ------------------------------------------
 
-        if not day_eng or not order: continue
+    data = item.get("data", {})
+    if not action or not data: return 0
 
-        day_ukr = AI_TO_DB_DAYS.get(day_eng, "понеділок")
-        week_ukr = AI_TO_DB_WEEKS.get(week_eng, "кожна")
+    day_eng = data.get("day")
+    week_eng = data.get("week", "both")
+    order = _pair_order(data.get("order"))
+    subject = data.get("subject", "Без назви")
+    link = data.get("link", "None")
+    custom_time = data.get("custom_time")
 
-        if custom_time:
-            pair_time = custom_time
-        else:
-            pair_time = PAIR_TIMES.get(order, "00:00")
+    if not day_eng or not order: return 0
 
-        if link is None: link = "None"
+    day_ukr = AI_TO_DB_DAYS.get(day_eng, "понеділок")
+    week_ukr = AI_TO_DB_WEEKS.get(week_eng, "кожна")
 
-        if action in ["UPDATE", "ADD"]:
-            if subject == "Без назви": continue
-            delete_specific_pair(user_id, day_ukr, order, week_ukr)
-            add_pair_to_db(user_id, day_ukr, pair_time, subject, link, week_ukr, order)
-            processed_count += 1
+    if custom_time:
+        try:
+            pair_time = parse_pair_time(custom_time).strftime('%H:%M')
+        except ValueError:
+            print(f"Відхилено дію {action}: некоректний custom_time {custom_time!r}")
+            return 0
+    else:
+        pair_time = PAIR_TIMES.get(order, "00:00")
+
+    if link is None: link = "None"
+
+    if action in ["UPDATE", "ADD"]:
+        if subject == "Без назви": return 0
+        batch.delete_slot(day_ukr, order, week_ukr)
+        batch.add(day_ukr, pair_time, subject, link, week_ukr, order)
+        return 1
+
+    elif action == "UPDATE_LINK":
+        name_keywords = data.get("name_keywords", [])
+        if isinstance(name_keywords, str):
+            name_keywords = [name_keywords]
+        if not name_keywords and subject and subject != "Без назви":
+            name_keywords = [subject]
+
+        # Precise matching by order (pair number) — preferred
+        link_order = order
+        link_week_ukr = AI_TO_DB_WEEKS.get(data.get("week", "both"), "кожна")
+
+        batch.flush()
+        batch.touched_days.add(day_ukr)
+        if link_order and day_ukr:
+            if link_week_ukr == "кожна":
+                cursor.execute(
+                    "UPDATE schedule SET link=%s WHERE user_id=%s AND day=%s AND pair_order=%s",
+                    (link, user_id, day_ukr, link_order)
+                )
+            else:
+                cursor.execute(
+                    "UPDATE schedule SET link=%s WHERE user_id=%s AND day=%s AND pair_order=%s AND (week_type=%s OR week_type='кожна')",
+                    (link, user_id, day_ukr, link_order, link_week_ukr)
+                )
+            return cursor.rowcount
+        elif name_keywords and day_ukr:
+            conditions = " OR ".join(["LOWER(name) LIKE %s" for _ in name_keywords])
+            params = [link, user_id, day_ukr] + [f"%{kw.lower()}%" for kw in name_keywords]
+            cursor.execute(
+                f"UPDATE schedule SET link=%s WHERE user_id=%s AND day=%s AND ({conditions})",
+                params
+            )
+            return cursor.rowcount
+        return 0
+
+    elif action == "UPDATE_FIELD":
+        field_name = data.get("field")  # "link" or "name"
+        field_value = data.get("value", "")
+        field_order = order
+        field_week_ukr = AI_TO_DB_WEEKS.get(data.get("week", "both"), "кожна")
+
+        allowed_fields = {"link", "name"}
+        if field_name in allowed_fields and field_order and day_ukr:
+            batch.flush()
+            batch.touched_days.add(day_ukr)
+            if field_week_ukr == "кожна":
+                cursor.execute(
+                    f"UPDATE schedule SET {field_name}=%s WHERE user_id=%s AND day=%s AND pair_order=%s",
+                    (field_value, user_id, day_ukr, field_order)
+                )
+            else:
+                cursor.execute(
+                    f"UPDATE schedule SET {field_name}=%s WHERE user_id=%s AND day=%s AND pair_order=%s AND (week_type=%s OR week_type='кожна')",
+                    (field_value, user_id, day_ukr, field_order, field_week_ukr)
+                )
+            return cursor.rowcount
+        return 0
 
-        elif action == "UPDATE_LINK":
-            name_keywords = data.get("name_keywords", [])
-            if isinstance(name_keywords, str):
-                name_keywords = [name_keywords]
-            if not name_keywords and subject and subject != "Без назви":
-                name_keywords = [subject]
-
-            # Precise matching by order (pair number) — preferred
-            link_order = data.get("order")
-            link_week = data.get("week", "both")
-            link_week_ukr = AI_TO_DB_WEEKS.get(link_week, "кожна")
-
-            if link_order and day_ukr:
-                with get_db_conn() as conn:
-                    with conn.cursor() as cursor:
-                        if link_week_ukr == "кожна":
-                            cursor.execute(
-                                "UPDATE schedule SET link=%s WHERE user_id=%s AND day=%s AND pair_order=%s",
-                                (link, user_id, day_ukr, link_order)
-                            )
-                        else:
-                            cursor.execute(
-                                "UPDATE schedule SET link=%s WHERE user_id=%s AND day=%s AND pair_order=%s AND (week_type=%s OR week_type='кожна')",
-                                (link, user_id, day_ukr, link_order, link_week_ukr)
-                            )
-                        processed_count += cursor.rowcount
-                    conn.commit()
-            elif name_keywords and day_ukr:
-                conditions = " OR ".join(["LOWER(name) LIKE %s" for _ in name_keywords])
-                params = [link, user_id, day_ukr] + [f"%{kw.lower()}%" for kw in name_keywords]
-                with get_db_conn() as conn:
-                    with conn.cursor() as cursor:
-                        cursor.execute(
-                            f"UPDATE schedule SET link=%s WHERE user_id=%s AND day=%s AND ({conditions})",
-                            params
-                        )
-                        processed_count += cursor.rowcount
-                    conn.commit()
+    elif action == "DELETE":
+        return batch.delete_slot(day_ukr, order, week_ukr)
 
-        elif action == "UPDATE_FIELD":
-            field_name = data.get("field")  # "link" or "name"
-            field_value = data.get("value", "")
-            field_order = data.get("order")
-            field_week = data.get("week", "both")
-            field_week_ukr = AI_TO_DB_WEEKS.get(field_week, "кожна")
-
-            allowed_fields = {"link", "name"}
-            if field_name in allowed_fields and field_order and day_ukr:
-                with get_db_conn() as conn:
-                    with conn.cursor() as cursor:
-                        if field_week_ukr == "кожна":
-                            cursor.execute(
-                                f"UPDATE schedule SET {field_name}=%s WHERE user_id=%s AND day=%s AND pair_order=%s",
-                                (field_value, user_id, day_ukr, field_order)
-                            )
-                        else:
-                            cursor.execute(
-                                f"UPDATE schedule SET {field_name}=%s WHERE user_id=%s AND day=%s AND pair_order=%s AND (week_type=%s OR week_type='кожна')",
-                                (field_value, user_id, day_ukr, field_order, field_week_ukr)
-                            )
-                        processed_count += cursor.rowcount
-                    conn.commit()
+    return 0
 
-        elif action == "DELETE":
-            delete_specific_pair(user_id, day_ukr, order, week_ukr)
-            processed_count += 1
+def get_pairs_for_day(day_to_fetch: str, week_type: str):
+    """Пари дня для типу тижня. Результат спільний для всіх викликів з кешу — не змінювати."""
+    day = day_to_fetch.lower()
 
-    return processed_count
+    def _load():
+        sql = """SELECT id, user_id, %s AS day, time, name, link, week_type, pair_order, start_time, duration_minutes
+                 FROM schedule WHERE day=%s AND week_type IN ('кожна', %s)
+                 ORDER BY start_time ASC"""
+        with get_db_conn() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, (day, day, week_type))
+                return tuple(dict(r) for r in cursor.fetchall())
 
-def get_pairs_for_day(day_to_fetch: str, week_type: str):
-    sql = """SELECT id, user_id, %s AS day, time, name, link, week_type, pair_order
-             FROM schedule WHERE day=%s AND (week_type='кожна' OR week_type=%s)
-             ORDER BY time::TIME ASC"""
-    with get_db_conn() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(sql, (day_to_fetch.lower(), day_to_fetch.lower(), week_type))
-            return cursor.fetchall()
+    return schedule_cache.get_or_load(("day", day, week_type), _load, day=day)
 
 def get_all_pairs():
-    sql_cases = [f"WHEN day = '{day.replace(chr(39), chr(39)*2)}' THEN {i}" for i, day in enumerate(DAY_ORDER_LIST)]
-    day_order_sql_case = " ".join(sql_cases)
-    sql = f"SELECT *, CASE {day_order_sql_case} ELSE 99 END as day_order FROM schedule ORDER BY week_type, day_order, time::TIME ASC"
-    with get_db_conn() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute(sql)
-            return cursor.fetchall()
+    def _load():
+        sql_cases = [f"WHEN day = '{day.replace(chr(39), chr(39)*2)}' THEN {i}" for i, day in enumerate(DAY_ORDER_LIST)]
+        day_order_sql_case = " ".join(sql_cases)
+        sql = f"SELECT *, CASE {day_order_sql_case} ELSE 99 END as day_order FROM schedule ORDER BY week_type, day_order, start_time ASC"
+        with get_db_conn() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql)
+                return tuple(dict(r) for r in cursor.fetchall())
+
+    return schedule_cache.get_or_load(("all",), _load)
+
+def get_user_pairs(user_id: int):
+    """Усі пари одного користувача (для контексту AI). Результат спільний з кешу — не змінювати."""
+    def _load():
+        sql = """SELECT day, time, name, link, week_type, pair_order, start_time
+                 FROM schedule WHERE user_id=%s ORDER BY start_time, pair_order, week_type"""
+        with get_db_conn() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql, (user_id,))
+                rows = [dict(r) for r in cursor.fetchall()]
+        day_index = {day: i for i, day in enumerate(DAY_ORDER_LIST)}
+        rows.sort(key=lambda r: day_index.get(r['day'], 99))
+        return tuple(rows)
+
+    return schedule_cache.get_or_load(("user", user_id), _load)
 
 def get_pairs_for_day_forced_week(day_name: str, forced_week: str):
     """forced_week: 'парна' | 'непарна' | None (auto from current date)"""
@@ -695,16 +1568,6 @@ def get_schedule_for_specific_week(forced_week: str):
         all_week_pairs.extend(day_pairs)
     return all_week_pairs
 
-def get_schedule_for_current_week(start_of_week_date):
-    all_week_pairs = []
-    for i in range(5):
-        current_day_date = start_of_week_date + timedelta(days=i)
-        current_day_name = DAY_OF_WEEK_UKR[i]
-        current_week_type = get_week_type_for_date(current_day_date)
-        day_pairs = get_pairs_for_day(current_day_name, current_week_type)
-        all_week_pairs.extend(day_pairs)
-    return all_week_pairs
-
 def get_week_type_for_date(date_obj):
     days_diff = (date_obj - REFERENCE_DATE).days
     weeks_diff = days_diff // 7
@@ -716,22 +1579,27 @@ def get_week_type_for_date(date_obj):
 def get_current_week_type():
     return get_week_type_for_date(datetime.now(TIMEZONE).date())
 
-def format_pairs_message(pairs, title):
+RENDER_MODE_PLAIN = "plain"    # пари згруповані по днях
+RENDER_MODE_MANAGE = "manage"  # додатково групування по типу тижня та ID пар
+
+WEEK_TYPE_HEADERS = {"парна": "ПАРНИЙ", "непарна": "НЕПАРНИЙ", "кожна": "КОЖЕН"}
+
+def format_pairs_message(pairs, title, mode: str = RENDER_MODE_PLAIN):
     if not pairs: return f"{title}\n\n🎉 Пар немає!"
-    message = f"{title}\n"
+    parts = [f"{title}\n"]
     current_week_type, current_day = "", ""
-    show_ids = 'id' in title.lower() or 'управління' in title.lower()
+    show_ids = mode == RENDER_MODE_MANAGE
 
     for pair in pairs:
         if show_ids and pair['week_type'] != current_week_type:
             current_week_type = pair['week_type']
-            display_week = {"парна": "ПАРНИЙ", "непарна": "НЕПАРНИЙ", "кожна": "КОЖЕН"}.get(current_week_type, current_week_type.upper())
-            message += f"\n--- **{display_week} ТИЖДЕНЬ** ---\n"
+            display_week = WEEK_TYPE_HEADERS.get(current_week_type, current_week_type.upper())
+            parts.append(f"\n--- **{display_week} ТИЖДЕНЬ** ---\n")
             current_day = ""
 
         if pair['day'] != current_day:
             current_day = pair['day']
-            message += f"\n**{current_day.capitalize()}**\n"
+            parts.append(f"\n**{current_day.capitalize()}**\n")
 
         link_str = str(pair['link']).strip()
         link_info = ""
@@ -744,29 +1612,281 @@ def format_pairs_message(pairs, title):
         order_display = pair.get('pair_order', '?')
         if order_display == 99: order_display = "Тест"
 
-        message += f"  Пара {order_display}) `{pair['time']}` - {pair['name']}{link_info}\n"
-        if show_ids: message += f"     *(ID: `{pair['id']}`)*\n"
-    return message
+        parts.append(f"  Пара {order_display}) `{pair['time']}` - {pair['name']}{link_info}\n")
+        if show_ids: parts.append(f"     *(ID: `{pair['id']}`)*\n")
+    return "".join(parts)
 
 # ==========================================
-# ФУНКЦІЇ ДЛЯ НАГАДУВАНЬ (CRON)
+# КЕШ ГОТОВИХ ПОВІДОМЛЕНЬ
 # ==========================================
-def get_all_subscribed_users():
-    with get_db_conn() as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT user_id FROM users WHERE subscribed = 1")
-            return [row[0] for row in cursor.fetchall()]
+# Готовий текст кожного виду (день / тиждень / управління) запам'ятовується
+# до наступної зміни розкладу, тож повторні /today, /all і відповіді перехоплювача
+# не ходять ні в БД, ні в рендеринг.
+render_cache = ScheduleCache(schedule_versions, RENDER_CACHE_MAX_ENTRIES)
+
+def week_label(week_type: str) -> str:
+    return "парний" if week_type == "парна" else "непарний"
+
+async def render_view(key, builder, day: str = None) -> str:
+    """Повертає закешоване повідомлення або будує його у db_executor (builder може читати БД)."""
+    cached = render_cache.lookup(key, day)
+    if cached is not None:
+        return cached
+    return await run_db(render_cache.get_or_load, key, builder, day)
+
+async def render_day_message(day_name: str, week_type: str, title: str) -> str:
+    return await render_view(
+        ("day", day_name, week_type, title),
+        lambda: format_pairs_message(get_pairs_for_day(day_name, week_type), title),
+        day=day_name
+    )
+
+async def render_day_like_today(target_date, label_prefix: str) -> str:
+    """День у форматі /today: тип тижня визначається за датою."""
+    weekday = target_date.weekday()
+    if weekday >= 5:
+        return f"{label_prefix}\n\n🎉 Вихідний!"
+    day_name = DAY_OF_WEEK_UKR[weekday]
+    week = get_week_type_for_date(target_date)
+    title = f"🔵 {label_prefix} ({day_name.capitalize()}, {week_label(week)} тиждень)"
+    return await render_day_message(day_name, week, title)
+
+async def render_week_message(week_type: str) -> str:
+    title = f"🗓️ Розклад на **{week_label(week_type).upper()}** тиждень"
+    return await render_view(
+        ("week", week_type, title),
+        lambda: format_pairs_message(get_schedule_for_specific_week(week_type), title)
+    )
+
+async def render_current_week_message() -> str:
+    now = datetime.now(TIMEZONE)
+    return await render_week_message(get_week_type_for_date(now.date() - timedelta(days=now.weekday())))
 
-def check_if_notified(notification_key: str):
+async def render_all_pairs_message(title: str, mode: str = RENDER_MODE_PLAIN) -> str:
+    return await render_view(
+        ("all", title, mode),
+        lambda: format_pairs_message(get_all_pairs(), title, mode)
+    )
+
+# ==========================================
+# КОМПАКТНИЙ КОНТЕКСТ РОЗКЛАДУ ДЛЯ AI
+# ==========================================
+# Слот = День.пара.тиждень у тих самих кодах, що й поля db_actions: "Mon.2.o" → day=Monday, order=2, week=odd
+PROMPT_WEEK_CODES = {"кожна": "b", "непарна": "o", "парна": "e"}
+PROMPT_SCHEDULE_LEGEND = (
+    "Слот = День.пара.тиждень (Mon..Fri; b=both/кожна, o=odd/непарна, e=even/парна) — "
+    "це day/order/week у db_actions. Рядок: слот час предмет | посилання (- = немає)."
+)
+
+ai_prompt_stats = {"requests": 0, "estimated_tokens": 0, "schedule_tokens": 0, "billed_input_tokens": 0}
+
+def estimate_tokens(text: str) -> int:
+    """Груба оцінка кількості токенів (~4 байти UTF-8 на токен) — для логів і статистики."""
+    return len(text.encode("utf-8")) // 4 + 1
+
+def prompt_slot_id(pair) -> str:
+    day = DB_TO_AI_DAYS.get(pair['day'], pair['day'])[:3]
+    return f"{day}.{pair['pair_order']}.{PROMPT_WEEK_CODES.get(pair['week_type'], pair['week_type'])}"
+
+def prompt_link(link) -> str:
+    return "-" if link in (None, "", "None") else str(link)
+
+def format_schedule_context(pairs) -> str:
+    """Щільна таблиця розкладу: однакові назви предметів винесені в словник s1, s2, ..."""
+    if not pairs:
+        return "Розклад порожній."
+    subjects = {}
+    rows = []
+    for p in pairs:
+        ref = subjects.setdefault(p['name'], f"s{len(subjects) + 1}")
+        rows.append(f"{prompt_slot_id(p)} {p['time']} {ref} | {prompt_link(p['link'])}")
+    lines = ["Предмети:"]
+    lines.extend(f"{ref}={name}" for name, ref in subjects.items())
+    lines.append("Слоти:")
+    lines.extend(rows)
+    return "\n".join(lines)
+
+def format_day_slots_context(pairs, label: str, target_date) -> str:
+    """Один рядок: які слоти діють у вказаний день (з урахуванням типу тижня)."""
+    weekday = target_date.weekday()
+    if weekday >= 5:
+        return f"{label} вихідний, пар немає!"
+    day_name = DAY_OF_WEEK_UKR[weekday]
+    week = get_week_type_for_date(target_date)
+    slots = [prompt_slot_id(p) for p in pairs if p['day'] == day_name and p['week_type'] in ("кожна", week)]
+    return f"{label}: {day_name}, {week_label(week)} тиждень — " + (", ".join(slots) if slots else "пар немає")
+
+async def build_prompt_context(user_id: int, now: datetime, include_deleted: bool) -> dict:
+    """
+    Секції розкладу для системного промпту. Таблиця кешується в render_cache до зміни розкладу,
+    видалені пари читаються лише коли запит про відновлення.
+    """
+    schedule_text, pairs, last_deleted = await asyncio.gather(
+        render_view(("prompt", user_id), lambda: format_schedule_context(get_user_pairs(user_id))),
+        run_db(get_user_pairs, user_id),
+        run_db(get_last_deleted_pairs, user_id) if include_deleted else asyncio.sleep(0, result=None),
+    )
+    return {
+        "today": format_day_slots_context(pairs, "Сьогодні", now.date()),
+        "tomorrow": format_day_slots_context(pairs, "Завтра", (now + timedelta(days=1)).date()),
+        "schedule": schedule_text,
+        "deleted": format_deleted_pairs_for_prompt(last_deleted) if include_deleted else "Не потрібні для цього запиту.",
+    }
+
+# ==========================================
+# КЕШ ВІДПОВІДЕЙ AI
+# ==========================================
+def schedule_fingerprint(user_id: int) -> str:
+    """
+    Відбиток вмісту розкладу користувача. На відміну від schedule_versions (лічильник у пам'яті процесу)
+    однаковий після рестарту і в усіх воркерах, тож годиться для ключів персистентного кешу.
+    """
+    def _load():
+        digest = hashlib.sha1()
+        for p in get_user_pairs(user_id):
+            digest.update(repr((p['day'], p['time'], p['name'], p['link'], p['week_type'], p['pair_order'])).encode("utf-8"))
+        return digest.hexdigest()
+
+    return schedule_cache.get_or_load(("fingerprint", user_id), _load)
+
+_REQUEST_SPACES_RE = re.compile(r'\s+')
+
+def normalize_request_text(text: str) -> str:
+    """Нормалізує запит для ключа кешу: регістр, пробіли, кінцева пунктуація."""
+    return _REQUEST_SPACES_RE.sub(" ", text.lower()).strip().rstrip(" .!?…")
+
+class AIResponseCache:
+    """
+    Кеш розібраних відповідей AI (reply, db_actions, show_schedule, give_fact).
+    Два рівні: LRU у пам'яті процесу і таблиця ai_response_cache, що переживає рестарти.
+    Записи живуть ttl секунд; ключ уже містить відбиток розкладу і дату, тож інвалідація не потрібна.
+    """
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "stores": 0, "errors": 0}
+
+    @staticmethod
+    def make_key(text: str, fingerprint: str, date_obj) -> str:
+        raw = f"{normalize_request_text(text)}|{fingerprint}|{date_obj.isoformat()}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _remember(self, key: str, expires_at: datetime, value: dict):
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def _lookup_memory(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= datetime.now(TIMEZONE):
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def _load(self, key: str):
+        with get_db_conn() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT response, expires_at FROM ai_response_cache WHERE cache_key=%s AND expires_at > NOW()", (key,))
+                row = cursor.fetchone()
+        return (row['response'], row['expires_at']) if row else None
+
+    def _store(self, key: str, value: dict, expires_at: datetime):
+        with get_db_conn() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """INSERT INTO ai_response_cache (cache_key, response, expires_at) VALUES (%s, %s, %s)
+                       ON CONFLICT (cache_key) DO UPDATE SET response = EXCLUDED.response, expires_at = EXCLUDED.expires_at""",
+                    (key, psycopg2.extras.Json(value), expires_at)
+                )
+
+    async def get(self, key: str):
+        """Повертає закешовану відповідь (спільний dict — не змінювати) або None."""
+        value = self._lookup_memory(key)
+        if value is not None:
+            self.stats["memory_hits"] += 1
+            return value
+        try:
+            row = await run_db(self._load, key)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Помилка читання кешу AI: {e}")
+            row = None
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+        value, expires_at = row
+        self._remember(key, expires_at, value)
+        self.stats["db_hits"] += 1
+        return value
+
+    async def put(self, key: str, value: dict):
+        expires_at = datetime.now(TIMEZONE) + timedelta(seconds=self.ttl)
+        self._remember(key, expires_at, value)
+        self.stats["stores"] += 1
+        try:
+            await run_db(self._store, key, value, expires_at)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"Помилка запису кешу AI: {e}")
+
+    def cleanup_expired(self):
+        with get_db_conn() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM ai_response_cache WHERE expires_at <= NOW()")
+
+    def stats_snapshot(self) -> dict:
+        hits = self.stats["memory_hits"] + self.stats["db_hits"]
+        total = hits + self.stats["misses"]
+        with self._lock:
+            size = len(self._data)
+        return {**self.stats, "size": size, "hit_rate": hits / total if total else 0.0}
+
+ai_response_cache = AIResponseCache(AI_CACHE_TTL_SECONDS, AI_CACHE_MAX_ENTRIES)
+
+# ==========================================
+# ФУНКЦІЇ ДЛЯ НАГАДУВАНЬ (CRON)
+# ==========================================
+def get_due_reminders(day_name: str, week_type: str, date_str: str, from_time: time, to_time: time) -> list:
+    """
+    Одним запитом повертає пари (з підписниками), що починаються в [from_time, to_time].
+    Вже надіслані нагадування відкидаються anti-join'ом по sent_notifications.
+    """
+    sql = """SELECT s.id, s.time, s.start_time, s.name, s.link, u.user_id
+             FROM schedule s
+             JOIN users u ON u.subscribed = 1
+             WHERE s.day = %s AND s.week_type IN ('кожна', %s)
+               AND s.start_time BETWEEN %s AND %s
+               AND NOT EXISTS (
+                   SELECT 1 FROM sent_notifications n
+                   WHERE n.notification_key = u.user_id || '_' || s.id || '_' || %s
+               )
+             ORDER BY s.start_time ASC, s.id, u.user_id"""
     with get_db_conn() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("SELECT 1 FROM sent_notifications WHERE notification_key = %s", (notification_key,))
-            return cursor.fetchone() is not None
+            cursor.execute(sql, (day_name.lower(), week_type, from_time, to_time, date_str))
+            return [dict(r) for r in cursor.fetchall()]
 
-def mark_as_notified(notification_key: str):
+def mark_many_as_notified(notification_keys: list):
+    """Записує всі надіслані нагадування одним INSERT."""
+    if not notification_keys:
+        return
+    sent_at = datetime.now(TIMEZONE)
     with get_db_conn() as conn:
         with conn.cursor() as cursor:
-            cursor.execute("INSERT INTO sent_notifications (notification_key, sent_at) VALUES (%s, %s)", (notification_key, datetime.now(TIMEZONE)))
+            psycopg2.extras.execute_values(
+                cursor,
+                "INSERT INTO sent_notifications (notification_key, sent_at) VALUES %s ON CONFLICT (notification_key) DO NOTHING",
+                [(key, sent_at) for key in notification_keys],
+                page_size=1000
+            )
         conn.commit()
 
 def cleanup_old_notifications():
@@ -778,403 +1898,1461 @@ def cleanup_old_notifications():
     except Exception:
         pass
 
-async def check_and_send_reminders(bot: Bot):
+def format_reminder_message(pair, minutes_left: int = REMIND_BEFORE_MINUTES) -> str:
+    link_str = str(pair['link']).strip()
+    link_msg = ""
+    if link_str and link_str.lower() != 'none':
+        if link_str.startswith("http"):
+            link_msg = f"\n\n🔗 [Відкрити пару]({link_str})"
+        else:
+            link_msg = f"\n\nℹ️ Дані підключення:\n`{link_str}`"
+    return f"🔔 **Нагадування!**\n\nЧерез {minutes_left} хвилин ({pair['time']}) почнеться пара:\n**{pair['name']}**{link_msg}"
+
+async def check_and_send_reminders(bot: Bot, now: datetime = None):
+    """Надсилає нагадування для всіх пар, що ще не почались і стартують протягом REMIND_BEFORE_MINUTES."""
     try:
-        now = datetime.now(TIMEZONE)
+        now = now or datetime.now(TIMEZONE)
         weekday = now.weekday()
         if weekday >= 5: return
 
-        target_time_obj = (now + timedelta(minutes=REMIND_BEFORE_MINUTES)).time().replace(second=0, microsecond=0)
         current_day_name = DAY_OF_WEEK_UKR[weekday]
-        week_type_to_check = get_current_week_type()
-
-        subscribed_users = get_all_subscribed_users()
-        if not subscribed_users: return
+        week_type_to_check = get_week_type_for_date(now.date())
+        date_str = now.strftime('%Y-%m-%d')
+        window_end = now + timedelta(minutes=REMIND_BEFORE_MINUTES)
+        if window_end.date() != now.date():
+            window_end = now.replace(hour=23, minute=59, second=59)
+
+        due_rows = await run_db(get_due_reminders, current_day_name, week_type_to_check, date_str, now.time(), window_end.time())
+
+        # Групуємо по парі: текст нагадування рендериться один раз на пару
+        due_pairs = {}
+        for row in due_rows:
+            pair_id = row['id']
+            if pair_id not in due_pairs:
+                start_dt = TIMEZONE.localize(datetime.combine(now.date(), row['start_time']))
+                minutes_left = max(1, round((start_dt - now).total_seconds() / 60))
+                due_pairs[pair_id] = (format_reminder_message(row, minutes_left), [])
+            due_pairs[pair_id][1].append(row['user_id'])
+
+        sent_keys = []
+
+        async def _remind(pair_id, msg, user_id):
+            try:
+                # Перше повідомлення — нагадування з посиланням; ні від чого не залежить і йде першим
+                await send_dispatcher.send_message(bot, user_id, msg, parse_mode="Markdown", disable_web_page_preview=True)
+                sent_keys.append(f"{user_id}_{pair_id}_{date_str}")
+                reminders_total.inc("sent")
+            except Exception:
+                reminders_total.inc("failed")
+                return
+            try:
+                # Друге повідомлення — окремо ІТ-факт, лише якщо він уже є в пулі (на Cohere не чекаємо)
+                fact = await fact_pool.take_ready_fact(user_id)
+                if fact:
+                    await send_dispatcher.send_message(bot, user_id, f"💡 **Цікавий ІТ-факт:**\n\n_{fact}_", parse_mode="Markdown")
+            except Exception as e:
+                print(f"Помилка надсилання факту {user_id}: {e}")
 
-        pairs_today = get_pairs_for_day(current_day_name, week_type_to_check)
-
-        for user_id in subscribed_users:
-            for pair in pairs_today:
-                try:
-                    if datetime.strptime(pair['time'], '%H:%M').time() == target_time_obj:
-                        notification_key = f"{user_id}_{pair['id']}_{now.strftime('%Y-%m-%d')}"
-                        if not check_if_notified(notification_key):
-                            link_str = str(pair['link']).strip()
-                            link_msg = ""
-                            if link_str and link_str.lower() != 'none':
-                                if link_str.startswith("http"):
-                                    link_msg = f"\n\n🔗 [Відкрити пару]({link_str})"
-                                else:
-                                    link_msg = f"\n\nℹ️ Дані підключення:\n`{link_str}`"
-
-                            fact = await generate_unique_fact(user_id)
-                            # Перше повідомлення — нагадування з посиланням
-                            msg = f"🔔 **Нагадування!**\n\nЧерез {REMIND_BEFORE_MINUTES} хвилин ({pair['time']}) почнеться пара:\n**{pair['name']}**{link_msg}"
-                            await bot.send_message(user_id, msg, parse_mode="Markdown", disable_web_page_preview=True)
-                            # Друге повідомлення — окремо ІТ-факт
-                            await bot.send_message(user_id, f"💡 **Цікавий ІТ-факт:**\n\n_{fact}_", parse_mode="Markdown")
-                            mark_as_notified(notification_key)
-                except Exception:
-                    pass
-        cleanup_old_notifications()
+        try:
+            # Розсилка всім підписникам паралельно; темп тримає send_dispatcher
+            await asyncio.gather(*(
+                _remind(pair_id, msg, user_id)
+                for pair_id, (msg, user_ids) in due_pairs.items()
+                for user_id in user_ids
+            ))
+        finally:
+            await run_db(mark_many_as_notified, sent_keys)
+        await run_db(cleanup_old_notifications)
     except Exception as e:
         print(f"Помилка нагадувань: {e}")
 
-def scheduled_job_wrapper():
-    if application and application.bot and main_loop:
-        asyncio.run_coroutine_threadsafe(check_and_send_reminders(application.bot), main_loop)
+class ReminderScheduler:
+    """
+    Планувальник нагадувань всередині event loop.
+    Будує на день купу моментів спрацювання (початок пари мінус REMIND_BEFORE_MINUTES)
+    і спить до найближчого. Перебудовується при зміні розкладу та опівночі.
+    Моменти, пропущені поки процес стояв на паузі, наздоганяються, якщо пара ще не почалась.
+    """
+    # Максимальний сон між перевірками: після паузи процесу чи стрибка годинника
+    # планувальник прокинеться не пізніше ніж через цей час і надішле пропущене
+    MAX_SLEEP_SECONDS = 300
+
+    def __init__(self):
+        self._heap = []
+        self._task = None
+        self._loop = None
+        self._rebuild_event = None
+
+    def start(self, bot: Bot):
+        self._loop = asyncio.get_running_loop()
+        self._rebuild_event = asyncio.Event()
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def invalidate(self):
+        """Просить перебудувати купу. Безпечно викликати з будь-якого потоку."""
+        if self._loop and self._rebuild_event and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._rebuild_event.set)
+
+    async def _build_heap(self, now: datetime):
+        self._heap = []
+        if now.weekday() >= 5:
+            return
+        day_name = DAY_OF_WEEK_UKR[now.weekday()]
+        pairs = await run_db(get_pairs_for_day, day_name, get_week_type_for_date(now.date()))
+        fire_times = set()
+        for pair in pairs:
+            start_dt = TIMEZONE.localize(datetime.combine(now.date(), pair['start_time']))
+            if start_dt > now:
+                fire_times.add(start_dt - timedelta(minutes=REMIND_BEFORE_MINUTES))
+        self._heap = list(fire_times)
+        heapq.heapify(self._heap)
+
+    async def _run(self, bot: Bot):
+        while True:
+            try:
+                self._rebuild_event.clear()
+                now = datetime.now(TIMEZONE)
+                today = now.date()
+                await self._build_heap(now)
+                await run_db(cleanup_old_notifications)
+                await run_db(ai_response_cache.cleanup_expired)
+                await run_db(update_deduplicator.cleanup_expired)
+                next_midnight = TIMEZONE.localize(datetime.combine(today + timedelta(days=1), time(0, 0)))
+
+                while not self._rebuild_event.is_set():
+                    now = datetime.now(TIMEZONE)
+                    if now.date() != today:
+                        break
+                    due = False
+                    while self._heap and self._heap[0] <= now:
+                        heapq.heappop(self._heap)
+                        due = True
+                    if due:
+                        # Одне вікно покриває і поточні, і пропущені моменти спрацювання
+                        tick_started = monotonic()
+                        await check_and_send_reminders(bot, now)
+                        reminder_tick_seconds.observe(monotonic() - tick_started)
+                    deadline = self._heap[0] if self._heap else next_midnight
+                    sleep_for = min(max((deadline - datetime.now(TIMEZONE)).total_seconds(), 0), self.MAX_SLEEP_SECONDS)
+                    try:
+                        await asyncio.wait_for(self._rebuild_event.wait(), timeout=sleep_for)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Помилка планувальника нагадувань: {e}")
+                await asyncio.sleep(30)
+
+reminder_scheduler = ReminderScheduler()
+
+def notify_schedule_changed(days=None):
+    """Викликається після кожного запису в schedule: days — змінені дні (укр.), None — весь розклад."""
+    schedule_versions.bump(days)
+    reminder_scheduler.invalidate()
 
 # ==========================================
-# ТЕЛЕГРАМ ОБРОБНИКИ ТА ШІ
+# ЗМІНИ РОЗКЛАДУ МІЖ ВОРКЕРАМИ (LISTEN/NOTIFY)
 # ==========================================
-async def ai_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    if user_id not in ADMIN_IDS: return
-    if not ai_client: return await update.message.reply_text("❌ Ключ Cohere не підключено.")
+# Кожен воркер тримає власні кеші розкладу. Запис публікує pg_notify у тій самій транзакції
+# (Postgres доставляє його лише після commit), а решта воркерів бампають версії саме змінених днів.
+SCHEDULE_CHANGES_CHANNEL = "schedule_changes"
+# Ідентифікатор процесу: власні сповіщення вже враховані notify_schedule_changed після commit
+WORKER_ID = f"{os.getpid()}-{os.urandom(4).hex()}"
 
-    text = update.message.text
-    text_lower = text.lower()
+def publish_schedule_change(cursor, user_id: int, days):
+    """Викликається всередині транзакції запису: days — змінені дні (укр.), None — весь розклад."""
+    payload = {"origin": WORKER_ID, "user_id": user_id, "days": sorted(days) if days is not None else None}
+    cursor.execute("SELECT pg_notify(%s, %s)", (SCHEDULE_CHANGES_CHANNEL, json.dumps(payload, ensure_ascii=False)))
 
-    # ============================================================
-    # ДОПОМІЖНА ФУНКЦІЯ для форматування дня як /today
-    # ============================================================
-    def format_day_like_today(target_date, label_prefix: str):
-        weekday = target_date.weekday()
-        if weekday >= 5:
-            return f"{label_prefix}\n\n🎉 Вихідний!"
-        day_name = DAY_OF_WEEK_UKR[weekday]
-        week = get_week_type_for_date(target_date)
-        week_label = "парний" if week == "парна" else "непарний"
-        pairs = get_pairs_for_day(day_name, week)
-        title = f"🔵 {label_prefix} ({day_name.capitalize()}, {week_label} тиждень)"
-        return format_pairs_message(pairs, title)
+# Прохання до воркера-лідера догенерувати пачку фактів (див. FactPool)
+FACT_REFILL_CHANNEL = "fact_refill"
 
-    # ============================================================
-    # ШВИДКИЙ ПЕРЕХВАТ: ПОРЯДОК ВАЖЛИВИЙ — спочатку конкретні дні,
-    # потім тиждень. Інакше "розклад на завтра" потрапляє у тижневий.
-    #
-    # ВАЖЛИВО: якщо є ключові слова дії (видали/додай/змін/відновити) —
-    # пропускаємо перехват і йдемо до AI для мультизадачності.
-    # ============================================================
+def publish_fact_refill_request():
+    with get_db_conn() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", (FACT_REFILL_CHANNEL, WORKER_ID))
 
-    ACTION_KEYWORDS = [
-        "видали", "видаліть", "удали", "удалить", "прибери", "прибрати",
-        "додай", "добавь", "добавити", "додати",
-        "зміни", "змін", "измени", "виправ", "виправити",
-        "відновити", "восстанови", "восстановить", "поверни", "верни",
-        "зроби", "зробити", "создай", "создать", "сделай", "сделать",
-        "постав", "поміняй", "поменяй", "переставь", "перестав",
-        "перепиши", "перезапиши", "запиши", "переписати", "перезаписати", "записати",
-        "swap", "move",
-        "вставь", "вставити", "вставляй", "встав",
-        "обнови", "оновити", "оновлюй", "обновить",
-        "ссылк", "ссилк", "посилання", "лінк", "линк", "link",
-    ]
-    has_action = any(kw in text_lower for kw in ACTION_KEYWORDS)
+class ScheduleChangeListener:
+    """
+    Одне LISTEN-з'єднання на воркер. Сокет читається через loop.add_reader, тож сповіщення
+    обробляються в event loop одразу після commit в іншому воркері, без опитування.
+    Після (пере)підключення всі кеші скидаються: поки з'єднання не було, сповіщення могли загубитись.
+    Інші канали на тому ж з'єднанні — через subscribe(channel, callback(payload)).
+    """
+    def __init__(self, channel: str, reconnect_delay: float):
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self._subscribers = {}
+        self._conn = None
+        self._loop = None
+        self._task = None
+        self._lost = None
+        self.stats = {"received": 0, "own": 0, "resyncs": 0, "errors": 0}
+
+    def subscribe(self, channel: str, callback):
+        """Викликається до start(): callback(payload) виконується в event loop."""
+        self._subscribers[channel] = callback
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _connect(self):
+        # TCP keepalive: мертве з'єднання стане читабельним з помилкою, а не зависне назавжди
+        conn = connect_db(DATABASE_URL, **DB_KEEPALIVE_OPTIONS)
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            for channel in (self.channel, *self._subscribers):
+                cursor.execute(f"LISTEN {channel}")
+        self._conn = conn
 
-    # ===========================================================
-    # ПЕРЕХВАТ ПОВНОГО РОЗКЛАДУ — локальний парсер (без AI)
-    # ===========================================================
-    if is_full_schedule_text(text):
-        processing_msg = await update.message.reply_text("⏳ Оброблюю розклад...")
+    def _close(self):
+        if self._conn is None:
+            return
         try:
-            db_actions = parse_full_schedule_locally(text)
-            changes_count = execute_db_actions(ADMIN_ID, db_actions)
-
-            now_dt = datetime.now(TIMEZONE)
-            cw = "парний" if get_current_week_type() == "парна" else "непарний"
-            pairs = get_schedule_for_current_week(now_dt.date() - timedelta(days=now_dt.weekday()))
-
-            reply = f"✅ Розклад успішно оновлено.\n\n⚙️ _Виконано дій з базою: {changes_count}_"
-            await processing_msg.edit_text(reply, parse_mode="Markdown")
+            self._loop.remove_reader(self._conn.fileno())
+        except Exception:
+            pass
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
 
-            # Показуємо оновлений розклад
-            msg = format_pairs_message(pairs, f"🗓️ Розклад на **{cw.upper()}** тиждень")
-            await update.message.reply_text(msg, parse_mode="Markdown", disable_web_page_preview=True)
+    def _on_readable(self):
+        try:
+            self._conn.poll()
         except Exception as e:
-            print(f"Помилка локального парсера: {e}")
-            await processing_msg.edit_text(f"❌ Помилка парсингу розкладу: {e}")
-        return
-
-    # ===========================================================
-    # SMART INTERCEPTOR v3: segment-based, fixes парн/непарн bug
-    # ===========================================================
-
-    # ---- Визначення типу тижня (НЕПАРН* перед ПАРН* щоб уникнути substring-помилки) ----
-    def detect_week_type(t: str):
-        """Returns 'парна', 'непарна', or None. Checks непарн* FIRST."""
-        odd_words = [
-            "непарну", "непарний", "непарна", "непарної", "непарного",
-            "непарной", "непарному", "непарный",
-            "нечётну", "нечётний", "нечётна", "нечётной", "нечётный",
-            "нечетну", "нечетний", "нечетна", "нечетной", "нечетную", "нечетный",
-            "непарную", "odd",
-            "непарне", "нечётне", "нечетное", "непарное",
-        ]
-        even_words = [
-            "парну", "парний", "парна", "парної", "парного",
-            "парной", "парному", "парный",
-            "четну", "четний", "четна", "четной", "четную", "четный",
-            "чётну", "чётній", "чётна", "чётной", "чётную", "чётный",
-            "парную", "even",
-            "парне", "парное", "четное", "чётное",
-        ]
-        # MUST check odd first — "парну" IS a substring of "непарну"
-        for w in odd_words:
-            if w in t:
-                return "непарна"
-        for w in even_words:
-            if w in t:
-                return "парна"
-        return None
-
-    # ---- Мапи днів ----
-    DAY_DETECT_MAP = [
-        (["понеділок", "понеділку", "в понеділок", "на понеділок",
-          "понедельник", "в понедельник", "на понедельник", "понедельника"], "понеділок", 0),
-        (["вівторок", "у вівторок", "на вівторок",
-          "вторник", "во вторник", "на вторник", "вторника"], "вівторок", 1),
-        (["середу", "середа", "середи", "в середу", "на середу",
-          "среду", "в среду", "на среду", "среды"], "середа", 2),
-        (["четвер", "в четвер", "на четвер", "четвер",
-          "четверг", "в четверг", "на четверг", "четверга"], "четвер", 3),
-        (["п'ятницю", "п'ятниця", "п'ятниці", "в п'ятницю", "на п'ятницю",
-          "пятницю", "пятниця", "пятницу", "в пятницу", "на пятницу",
-          "пятницы", "пятница"], "п'ятниця", 4),
-    ]
-
-    def detect_day(seg: str):
-        """Returns (day_name, offset) or None."""
-        for kws, day_name, offset in DAY_DETECT_MAP:
-            if any(kw in seg for kw in kws):
-                return (day_name, offset)
-        return None
+            print(f"LISTEN: з'єднання втрачено ({e})")
+            self._lost.set()
+            return
+        while self._conn.notifies:
+            notify = self._conn.notifies.pop(0)
+            callback = self._subscribers.get(notify.channel)
+            if callback is None:
+                self._handle(notify.payload)
+                continue
+            try:
+                callback(notify.payload)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"LISTEN {notify.channel}: помилка обробки ({e})")
+
+    def _handle(self, raw_payload: str):
+        try:
+            payload = json.loads(raw_payload)
+        except ValueError:
+            self.stats["errors"] += 1
+            return
+        if payload.get("origin") == WORKER_ID:
+            self.stats["own"] += 1
+            return
+        self.stats["received"] += 1
+        days = payload.get("days")
+        notify_schedule_changed(days if isinstance(days, list) else None)
+
+    async def _run(self):
+        while True:
+            try:
+                await run_db(self._connect)
+                self._lost = asyncio.Event()
+                self._loop.add_reader(self._conn.fileno(), self._on_readable)
+                self.stats["resyncs"] += 1
+                notify_schedule_changed(None)
+                await self._lost.wait()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"LISTEN: не вдалося підключитися ({e})")
+            finally:
+                self._close()
+            await asyncio.sleep(self.reconnect_delay)
+
+    def stats_snapshot(self) -> dict:
+        return {**self.stats, "connected": self._conn is not None}
+
+schedule_change_listener = ScheduleChangeListener(SCHEDULE_CHANGES_CHANNEL, SCHEDULE_LISTEN_RECONNECT)
+schedule_change_listener.subscribe(FACT_REFILL_CHANNEL, fact_pool.on_refill_requested)
 
-    # ---- Розбивка на сегменти ----
-    CONJUNCTIONS = [" і ", " и ", " та ", " and ", " & ", ", "]
-
-    def split_segments(t: str):
-        """Split text into segments by conjunctions."""
-        result = t
-        for sep in CONJUNCTIONS:
-            result = result.replace(sep, " ||SEP|| ")
-        parts = [p.strip() for p in result.split("||SEP||") if p.strip()]
-        return parts if parts else [t]
-
-    # ---- Класифікація сегменту ----
-    SHOW_DAY_TRIGGERS = [
-        "розклад", "пари", "виведи", "покажи", "дай",
-        "расписание", "пары", "выведи",
-        "на ", "в ", "у ",
-    ]
-    WEEK_FULL_KW = [
-        "тиждень", "тижня", "тижні", "неделю", "недели",
-        "всі пари", "весь розклад", "повний розклад",
-        "полное расписание", "все пары",
-        "парне розклад", "непарне розклад",
-        "парное расписание", "непарное расписание",
-    ]
-    TOMORROW_KW = [
-        "завтра", "завтрашн",
-    ]
-    TODAY_KW = [
-        "сьогодні", "сегодня",
-    ]
-    FACT_KW = [
-        "факт", "факти", "fact",
-    ]
-
-    def classify_segment(seg: str):
-        """
-        Returns one of: 'today', 'tomorrow', 'week', 'day', 'fact', 'ai'
-        """
-        s = seg.lower()
-        if any(kw in s for kw in FACT_KW):
-            return "fact"
-        if any(kw in s for kw in TOMORROW_KW):
-            return "tomorrow"
-        if any(kw in s for kw in TODAY_KW):
-            return "today"
-        if any(kw in s for kw in WEEK_FULL_KW):
-            return "week"
-        # Check for day name
-        if detect_day(s) is not None:
-            # Require a show trigger OR short segment
-            if any(t in s for t in SHOW_DAY_TRIGGERS) or len(s.split()) <= 4:
-                return "day"
-        return "ai"
-
-    # ---- Функція формування повідомлення для дня ----
-    def make_day_msg(day_name: str, offset: int, wtype):
-        now_dt = datetime.now(TIMEZONE)
-        current_monday = now_dt.date() - timedelta(days=now_dt.weekday())
-        target_date = current_monday + timedelta(days=offset)
-        if wtype:
-            pairs = get_pairs_for_day(day_name, wtype)
-            wlabel = "парний" if wtype == "парна" else "непарний"
-            title = f"🗓️ {day_name.capitalize()} ({wlabel} тиждень)"
-            return format_pairs_message(pairs, title)
+# ==========================================
+# ВІДПРАВКА ПОВІДОМЛЕНЬ (ЛІМІТИ TELEGRAM)
+# ==========================================
+class TokenBucket:
+    """Відро токенів: delay() каже, скільки чекати до наступного токена, take() його забирає."""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    def is_full(self) -> bool:
+        return self.tokens + (monotonic() - self.updated) * self.rate >= self.capacity
+
+class SendDispatcher:
+    """
+    Черга відправки в Telegram з обмеженою паралельністю.
+    Тримає глобальний ліміт (~30 повідомлень/с) і ліміт на чат, зберігає порядок
+    повідомлень в межах чату і при 429 чекає retry_after перед повтором.
+    Як і UpdateDispatcher, воркер бере з черги готових не повідомлення, а чат. Чат, якому
+    треба чекати (ліміт, 429, повтор), відкладається таймером і слот не займає.
+    """
+    MAX_TRACKED_CHATS = 5000
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, concurrency: int, max_retries: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._ready = None       # черга чатів, у яких є що слати і ніхто зараз не шле
+        self._pending = {}       # chat_id -> deque[[call, future, enqueued_at, attempt]]
+        self._active = set()     # чати в _ready, у відправці або відкладені таймером
+        self._timers = {}        # chat_id -> TimerHandle відкладеного чату
+        self._buckets = {}       # chat_id -> TokenBucket
+        self._size = 0
+        self._idle = None
+        self._workers = []
+        self._paused_until = 0.0
+        self.stats = {
+            "sent": 0, "failed": 0, "retried": 0, "rate_limited": 0, "in_flight": 0,
+            "latency_sum": 0.0, "latency_max": 0.0,
+        }
+
+    def start(self):
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self, drain_timeout: float = 5.0):
+        if not self._ready:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"Відправка: {self._size} повідомлень не встигли піти до зупинки")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        for timer in self._timers.values():
+            timer.cancel()
+        for queue in self._pending.values():
+            for _, future, _, _ in queue:
+                if not future.done():
+                    future.cancel()
+        self._workers = []
+        self._ready = None
+        self._pending.clear()
+        self._active.clear()
+        self._timers.clear()
+        self._size = 0
+
+    async def call(self, chat_id: int, func, *args, **kwargs):
+        """Ставить виклик Bot API в чергу чату і чекає його результат."""
+        if self._ready is None:
+            # Диспетчер не запущено (наприклад, до старту застосунку) — шлемо напряму
+            return await func(*args, **kwargs)
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault(chat_id, deque()).append([functools.partial(func, *args, **kwargs), future, monotonic(), 0])
+        self._size += 1
+        self._idle.clear()
+        if chat_id not in self._active:
+            self._active.add(chat_id)
+            self._ready.put_nowait(chat_id)
+        return await future
+
+    async def send_message(self, bot: Bot, chat_id: int, text: str, **kwargs):
+        return await self.call(chat_id, bot.send_message, chat_id, text, **kwargs)
+
+    async def reply(self, message, text: str, **kwargs):
+        return await self.call(message.chat_id, message.reply_text, text, **kwargs)
+
+    async def edit(self, message, text: str, **kwargs):
+        return await self.call(message.chat_id, message.edit_text, text, **kwargs)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_TRACKED_CHATS:
+                self._buckets = {cid: b for cid, b in self._buckets.items() if cid in self._active or not b.is_full()}
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    @staticmethod
+    def _retry_delay(error: RetryAfter) -> float:
+        retry_after = error.retry_after
+        return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+    def _defer(self, chat_id: int, delay: float):
+        """Відкладає чат на delay секунд: він лишається в _active, тож порядок у чаті не ламається."""
+        self._timers[chat_id] = asyncio.get_running_loop().call_later(delay, self._wake, chat_id)
+
+    def _wake(self, chat_id: int):
+        self._timers.pop(chat_id, None)
+        if self._ready is not None:
+            self._ready.put_nowait(chat_id)
+
+    def _finish(self, item, result=None, error: Exception = None):
+        _, future, enqueued_at, _ = item
+        if error is None:
+            self.stats["sent"] += 1
+            if not future.done():
+                future.set_result(result)
         else:
-            return format_day_like_today(target_date, day_name.capitalize())
-
-    # ---- Основний розбір ----
-    if not has_action:
-        segments = split_segments(text_lower)
-        ai_segments = []
-        schedule_tasks = []  # list of async callables
-        has_fact_request = False
+            self.stats["failed"] += 1
+            if not future.done():
+                future.set_exception(error)
+        latency = monotonic() - enqueued_at
+        self.stats["latency_sum"] += latency
+        self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+        self._size -= 1
+        if self._size == 0:
+            self._idle.set()
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            queue = self._pending[chat_id]
+            item = queue[0]
+            # Чекати (пауза після 429 або ліміти) — не в слоті, а таймером
+            bucket = self._chat_bucket(chat_id)
+            delay = max(self._paused_until - monotonic(), bucket.delay(), self.global_bucket.delay())
+            if delay > 0:
+                self._defer(chat_id, delay)
+                continue
+            bucket.take()
+            self.global_bucket.take()
+            retry_in, retry_error = None, None
+            self.stats["in_flight"] += 1
+            try:
+                result = await item[0]()
+                queue.popleft()
+                self._finish(item, result)
+            except asyncio.CancelledError:
+                queue.popleft()
+                item[1].cancel()
+                self._size -= 1
+                raise
+            except RetryAfter as e:
+                # 429: Telegram просить почекати — пауза для всіх чатів
+                wait = self._retry_delay(e)
+                self.stats["rate_limited"] += 1
+                self._paused_until = max(self._paused_until, monotonic() + wait)
+                retry_in, retry_error = wait, e
+            except (TimedOut, NetworkError) as e:
+                retry_in, retry_error = 0.5 * (2 ** item[3]), e
+            except Exception as e:
+                queue.popleft()
+                self._finish(item, error=e)
+            finally:
+                self.stats["in_flight"] -= 1
+            if retry_in is not None:
+                if item[3] >= self.max_retries:
+                    queue.popleft()
+                    self._finish(item, error=retry_error)
+                else:
+                    item[3] += 1
+                    self.stats["retried"] += 1
+                    self._defer(chat_id, retry_in)
+                    continue
+            if queue:
+                # Наступне повідомлення цього чату — в кінець черги готових, щоб інші не чекали
+                self._ready.put_nowait(chat_id)
+            else:
+                del self._pending[chat_id]
+                self._active.discard(chat_id)
 
-        for seg in segments:
-            kind = classify_segment(seg)
+    def stats_snapshot(self) -> dict:
+        done = self.stats["sent"] + self.stats["failed"]
+        return {
+            **self.stats,
+            "queue_depth": self._size - self.stats["in_flight"],
+            "deferred_chats": len(self._timers),
+            "latency_avg": self.stats["latency_sum"] / done if done else 0.0,
+        }
 
-            if kind == "fact":
-                has_fact_request = True
+send_dispatcher = SendDispatcher(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, SEND_CONCURRENCY, SEND_MAX_RETRIES)
 
-            elif kind == "tomorrow":
-                wtype = detect_week_type(seg)
-                async def _send_tomorrow(wt=wtype):
-                    now_dt = datetime.now(TIMEZONE)
-                    tomorrow_dt = (now_dt + timedelta(days=1)).date()
-                    if wt:
-                        dn = DAY_OF_WEEK_UKR.get(tomorrow_dt.weekday(), "п'ятниця")
-                        pairs = get_pairs_for_day(dn, wt)
-                        wlabel = "парний" if wt == "парна" else "непарний"
-                        msg = format_pairs_message(pairs, f"🔵 Завтра ({dn.capitalize()}, {wlabel} тиждень)")
-                    else:
-                        msg = format_day_like_today(tomorrow_dt, "Завтра")
-                    await update.message.reply_text(msg, parse_mode="Markdown", disable_web_page_preview=True)
-                schedule_tasks.append(_send_tomorrow)
+# ==========================================
+# ЧЕРГА ВХІДНИХ АПДЕЙТІВ
+# ==========================================
+class UpdateDispatcher:
+    """
+    Обмежена черга апдейтів з вебхука.
+    Апдейти одного користувача обробляються строго по черзі (FIFO), різних — паралельно
+    до workers штук. Воркер бере не апдейт, а користувача з черги готових, тож повільний
+    запит одного користувача не займає слот, поки чекають інші. Коли в черзі max_queue
+    апдейтів — submit() повертає False і вебхук відповідає 503 (Telegram повторить пізніше).
+    """
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._process = None
+        self._ready = None       # черга користувачів, у яких є апдейти і ніхто їх зараз не обробляє
+        self._pending = {}       # ключ користувача -> deque[(update, enqueued_at)]
+        self._active = set()     # користувачі в _ready або в обробці
+        self._size = 0
+        self._idle = None
+        self._workers = []
+        self.stats = {
+            "submitted": 0, "processed": 0, "failed": 0, "rejected": 0, "in_flight": 0,
+            "wait_sum": 0.0, "wait_max": 0.0,
+        }
+
+    def start(self, process):
+        """process(update) — корутина обробки одного апдейту."""
+        self._process = process
+        self._ready = asyncio.Queue()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout: float = 10.0):
+        if not self._ready:
+            return
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=drain_timeout)
+        except asyncio.TimeoutError:
+            print(f"Апдейти: {self._size} не встигли обробитися до зупинки")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._ready = None
+
+    @staticmethod
+    def _user_key(update: Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return ("update", update.update_id)  # без користувача — без упорядкування
+
+    def submit(self, update: Update) -> bool:
+        if self._ready is None:
+            # Диспетчер не запущено — обробляємо напряму
+            asyncio.create_task(self._process(update))
+            return True
+        if self._size >= self.max_queue:
+            self.stats["rejected"] += 1
+            return False
+        key = self._user_key(update)
+        self._pending.setdefault(key, deque()).append((update, monotonic()))
+        self._size += 1
+        self._idle.clear()
+        self.stats["submitted"] += 1
+        if key not in self._active:
+            self._active.add(key)
+            self._ready.put_nowait(key)
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._pending[key]
+            update, enqueued_at = queue.popleft()
+            wait = monotonic() - enqueued_at
+            self.stats["wait_sum"] += wait
+            self.stats["wait_max"] = max(self.stats["wait_max"], wait)
+            self.stats["in_flight"] += 1
+            try:
+                await self._process(update)
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                print(f"Помилка обробки апдейту {update.update_id}: {e}")
+            finally:
+                self.stats["in_flight"] -= 1
+                self._size -= 1
+                if queue:
+                    # Наступний апдейт цього користувача — в кінець черги готових, щоб інші не чекали
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+                    self._active.discard(key)
+                if self._size == 0:
+                    self._idle.set()
+
+    def stats_snapshot(self) -> dict:
+        started = self.stats["processed"] + self.stats["failed"] + self.stats["in_flight"]
+        return {
+            **self.stats,
+            "queue_depth": self._size - self.stats["in_flight"],
+            "active_users": len(self._active),
+            "wait_avg": self.stats["wait_sum"] / started if started else 0.0,
+        }
+
+update_dispatcher = UpdateDispatcher(UPDATE_WORKERS, UPDATE_QUEUE_MAX)
 
-            elif kind == "today":
-                wtype = detect_week_type(seg)
-                async def _send_today(wt=wtype):
-                    now_dt = datetime.now(TIMEZONE)
-                    today_dt = now_dt.date()
-                    if wt:
-                        dn = DAY_OF_WEEK_UKR.get(today_dt.weekday(), "понеділок")
-                        pairs = get_pairs_for_day(dn, wt)
-                        wlabel = "парний" if wt == "парна" else "непарний"
-                        msg = format_pairs_message(pairs, f"🔵 Сьогодні ({dn.capitalize()}, {wlabel} тиждень)")
-                    else:
-                        msg = format_day_like_today(today_dt, "Сьогодні")
-                    await update.message.reply_text(msg, parse_mode="Markdown", disable_web_page_preview=True)
-                schedule_tasks.append(_send_today)
+# ==========================================
+# ДЕДУПЛІКАЦІЯ АПДЕЙТІВ
+# ==========================================
+class UpdateDeduplicator:
+    """
+    Ідемпотентність вебхука: кожен update_id обробляється один раз,
+    навіть якщо Telegram повторив його після обробки, після рестарту чи на іншому воркері.
+    Перед таблицею processed_updates стоїть обмежений LRU з TTL, тож повтор, що вже є
+    в пам'яті, відкидається без запиту до БД. Захоплення в БД — INSERT ... ON CONFLICT DO NOTHING.
+    """
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._seen = OrderedDict()  # update_id -> expires_at (monotonic)
+        self.stats = {"claimed": 0, "memory_duplicates": 0, "db_duplicates": 0, "errors": 0}
+
+    def _remember(self, update_id: int):
+        self._seen[update_id] = monotonic() + self.ttl
+        self._seen.move_to_end(update_id)
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+
+    def _seen_recently(self, update_id: int) -> bool:
+        expires_at = self._seen.get(update_id)
+        if expires_at is None:
+            return False
+        if expires_at <= monotonic():
+            del self._seen[update_id]
+            return False
+        return True
+
+    @staticmethod
+    def _claim_in_db(update_id: int) -> bool:
+        with get_db_conn() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT (update_id) DO NOTHING RETURNING update_id",
+                    (update_id,)
+                )
+                return cursor.fetchone() is not None
+
+    async def claim(self, update_id: int) -> bool:
+        """True — апдейт новий і тепер закріплений за нами; False — це повтор."""
+        if self._seen_recently(update_id):
+            self.stats["memory_duplicates"] += 1
+            return False
+        # Запам'ятовуємо до запиту в БД: паралельний повтор з того ж процесу відсіється вже в пам'яті
+        self._remember(update_id)
+        try:
+            claimed = await run_db(self._claim_in_db, update_id)
+        except Exception as e:
+            # БД недоступна — краще обробити, ніж загубити апдейт; від повторів захищає пам'ять
+            self.stats["errors"] += 1
+            print(f"Помилка дедуплікації апдейту {update_id}: {e}")
+            claimed = True
+        self.stats["claimed" if claimed else "db_duplicates"] += 1
+        return claimed
+
+    def cleanup_expired(self):
+        with get_db_conn() as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "DELETE FROM processed_updates WHERE received_at < NOW() - %s * INTERVAL '1 second'",
+                    (self.ttl,)
+                )
 
-            elif kind == "week":
-                wtype = detect_week_type(seg)
-                async def _send_week(wt=wtype):
-                    now_dt = datetime.now(TIMEZONE)
-                    if wt:
-                        pairs = get_schedule_for_specific_week(wt)
-                        wlabel = "ПАРНИЙ" if wt == "парна" else "НЕПАРНИЙ"
-                        msg = format_pairs_message(pairs, f"🗓️ Розклад на **{wlabel}** тиждень")
-                    else:
-                        cw = "парний" if get_current_week_type() == "парна" else "непарний"
-                        pairs = get_schedule_for_current_week(now_dt.date() - timedelta(days=now_dt.weekday()))
-                        msg = format_pairs_message(pairs, f"🗓️ Розклад на **{cw.upper()}** тиждень")
-                    await update.message.reply_text(msg, parse_mode="Markdown", disable_web_page_preview=True)
-                schedule_tasks.append(_send_week)
+    def stats_snapshot(self) -> dict:
+        return {**self.stats, "size": len(self._seen)}
 
-            elif kind == "day":
-                day_result = detect_day(seg)
-                if day_result:
-                    day_name, offset = day_result
-                    wtype = detect_week_type(seg)
-                    async def _send_day(dn=day_name, off=offset, wt=wtype):
-                        msg = make_day_msg(dn, off, wt)
-                        await update.message.reply_text(msg, parse_mode="Markdown", disable_web_page_preview=True)
-                    schedule_tasks.append(_send_day)
+update_deduplicator = UpdateDeduplicator(UPDATE_DEDUP_TTL_SECONDS, UPDATE_DEDUP_MAX_ENTRIES)
 
-            else:
-                ai_segments.append(seg)
+# ==========================================
+# ШВИДКИЙ ПЕРЕХВАТ ЗАПИТІВ (без AI)
+# ==========================================
+# Якщо є ключові слова дії (видали/додай/змін/відновити) —
+# перехват пропускається і запит іде до AI для мультизадачності.
+INTERCEPT_ACTION_KEYWORDS = [
+    "видали", "видаліть", "удали", "удалить", "прибери", "прибрати",
+    "додай", "добавь", "добавити", "додати",
+    "зміни", "змін", "измени", "виправ", "виправити",
+    "відновити", "восстанови", "восстановить", "поверни", "верни",
+    "зроби", "зробити", "создай", "создать", "сделай", "сделать",
+    "постав", "поміняй", "поменяй", "переставь", "перестав",
+    "перепиши", "перезапиши", "запиши", "переписати", "перезаписати", "записати",
+    "swap", "move",
+    "вставь", "вставити", "вставляй", "встав",
+    "обнови", "оновити", "оновлюй", "обновить",
+    "ссылк", "ссилк", "посилання", "лінк", "линк", "link",
+]
+
+# Тип тижня: непарн* має пріоритет — "парну" є підрядком "непарну"
+INTERCEPT_ODD_WEEK_WORDS = [
+    "непарну", "непарний", "непарна", "непарної", "непарного",
+    "непарной", "непарному", "непарный",
+    "нечётну", "нечётний", "нечётна", "нечётной", "нечётный",
+    "нечетну", "нечетний", "нечетна", "нечетной", "нечетную", "нечетный",
+    "непарную", "odd",
+    "непарне", "нечётне", "нечетное", "непарное",
+]
+INTERCEPT_EVEN_WEEK_WORDS = [
+    "парну", "парний", "парна", "парної", "парного",
+    "парной", "парному", "парный",
+    "четну", "четний", "четна", "четной", "четную", "четный",
+    "чётну", "чётній", "чётна", "чётной", "чётную", "чётный",
+    "парную", "even",
+    "парне", "парное", "четное", "чётное",
+]
+
+# Дні: при кількох збігах перемагає раніший день тижня
+INTERCEPT_DAY_KEYWORDS = [
+    (["понеділок", "понеділку", "в понеділок", "на понеділок",
+      "понедельник", "в понедельник", "на понедельник", "понедельника"], "понеділок", 0),
+    (["вівторок", "у вівторок", "на вівторок",
+      "вторник", "во вторник", "на вторник", "вторника"], "вівторок", 1),
+    (["середу", "середа", "середи", "в середу", "на середу",
+      "среду", "в среду", "на среду", "среды"], "середа", 2),
+    (["четвер", "в четвер", "на четвер", "четвер",
+      "четверг", "в четверг", "на четверг", "четверга"], "четвер", 3),
+    (["п'ятницю", "п'ятниця", "п'ятниці", "в п'ятницю", "на п'ятницю",
+      "пятницю", "пятниця", "пятницу", "в пятницу", "на пятницу",
+      "пятницы", "пятница"], "п'ятниця", 4),
+]
+
+INTERCEPT_SHOW_DAY_TRIGGERS = [
+    "розклад", "пари", "виведи", "покажи", "дай",
+    "расписание", "пары", "выведи",
+    "на ", "в ", "у ",
+]
+INTERCEPT_WEEK_FULL_KW = [
+    "тиждень", "тижня", "тижні", "неделю", "недели",
+    "всі пари", "весь розклад", "повний розклад",
+    "полное расписание", "все пары",
+    "парне розклад", "непарне розклад",
+    "парное расписание", "непарное расписание",
+]
+INTERCEPT_TOMORROW_KW = ["завтра", "завтрашн"]
+INTERCEPT_TODAY_KW = ["сьогодні", "сегодня"]
+INTERCEPT_FACT_KW = ["факт", "факти", "fact"]
+INTERCEPT_RESTORE_KW = ["віднов", "восстанов", "поверн", "верни", "відміни видалення", "отмени удаление"]
+INTERCEPT_BARE_SHOW_KW = [
+    "виведи розклад", "покажи розклад", "дай розклад",
+    "выведи расписание", "покажи расписание", "дай расписание",
+]
+
+SEGMENT_CONJUNCTIONS = [" і ", " и ", " та ", " and ", " & ", ", "]
+
+class KeywordMatcher:
+    """
+    Шукає всі ключові слова за один прохід і повертає множину їхніх тегів (семантика "kw in text").
+    Слова зібрані в одну регулярку-трie у lookahead: у кожній позиції береться найдовше слово,
+    а його теги вже включають теги всіх слів-префіксів, що починаються в тій самій позиції.
+    """
+    def __init__(self, tagged_keywords):
+        tags = {}
+        for keyword, tag in tagged_keywords:
+            tags.setdefault(keyword, set()).add(tag)
+        self._tags = {
+            keyword: frozenset().union(*(own for prefix, own in tags.items() if keyword.startswith(prefix)))
+            for keyword in tags
+        }
+        self._pattern = re.compile("(?=(" + self._trie_pattern(tags) + "))")
+
+    @staticmethod
+    def _trie_pattern(words) -> str:
+        trie = {}
+        for word in words:
+            node = trie
+            for ch in word:
+                node = node.setdefault(ch, {})
+            node[""] = True
+
+        def build(node):
+            branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+            if not branches:
+                return ""
+            body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+            # Жадібний "?" — довше слово має перевагу над словом, що закінчується тут
+            return "(?:" + body + ")?" if "" in node else body
+
+        return build(trie)
+
+    def scan(self, text: str) -> frozenset:
+        found = set()
+        for keyword in set(self._pattern.findall(text)):
+            found |= self._tags[keyword]
+        return frozenset(found)
+
+INTENT_MATCHER = KeywordMatcher(
+    [(kw, "action") for kw in INTERCEPT_ACTION_KEYWORDS]
+    + [(kw, "odd") for kw in INTERCEPT_ODD_WEEK_WORDS]
+    + [(kw, "even") for kw in INTERCEPT_EVEN_WEEK_WORDS]
+    + [(kw, f"day:{offset}") for kws, _, offset in INTERCEPT_DAY_KEYWORDS for kw in kws]
+    + [(kw, "show") for kw in INTERCEPT_SHOW_DAY_TRIGGERS]
+    + [(kw, "week") for kw in INTERCEPT_WEEK_FULL_KW]
+    + [(kw, "tomorrow") for kw in INTERCEPT_TOMORROW_KW]
+    + [(kw, "today") for kw in INTERCEPT_TODAY_KW]
+    + [(kw, "fact") for kw in INTERCEPT_FACT_KW]
+    + [(kw, "bare_show") for kw in INTERCEPT_BARE_SHOW_KW]
+    + [(kw, "restore") for kw in INTERCEPT_RESTORE_KW]
+)
+
+def split_segments(t: str):
+    """Split text into segments by conjunctions."""
+    result = t
+    for sep in SEGMENT_CONJUNCTIONS:
+        result = result.replace(sep, " ||SEP|| ")
+    parts = [p.strip() for p in result.split("||SEP||") if p.strip()]
+    return parts if parts else [t]
+
+def scan_segment_intent(seg: str) -> dict:
+    """
+    Класифікує сегмент (у нижньому регістрі) за один прохід INTENT_MATCHER.
+    kind: 'fact' | 'tomorrow' | 'today' | 'week' | 'day' | 'ai';
+    day: (назва дня, зсув від понеділка) або None; week_type: 'парна' | 'непарна' | None.
+    """
+    tags = INTENT_MATCHER.scan(seg)
+    week_type = "непарна" if "odd" in tags else "парна" if "even" in tags else None
+    day = next(((day_name, offset) for _, day_name, offset in INTERCEPT_DAY_KEYWORDS if f"day:{offset}" in tags), None)
+
+    if "fact" in tags:
+        kind = "fact"
+    elif "tomorrow" in tags:
+        kind = "tomorrow"
+    elif "today" in tags:
+        kind = "today"
+    elif "week" in tags:
+        kind = "week"
+    # День — лише з тригером показу або в короткому сегменті
+    elif day is not None and ("show" in tags or len(seg.split()) <= 4):
+        kind = "day"
+    else:
+        kind = "ai"
+
+    return {
+        "kind": kind,
+        "day": day,
+        "week_type": week_type,
+        "action": "action" in tags,
+        "bare_show": "bare_show" in tags,
+        "restore": "restore" in tags,
+    }
+
+async def render_weekday_message(day_name: str, offset: int, wtype):
+    """Розклад дня поточного тижня; з явним типом тижня — саме для нього."""
+    now_dt = datetime.now(TIMEZONE)
+    current_monday = now_dt.date() - timedelta(days=now_dt.weekday())
+    target_date = current_monday + timedelta(days=offset)
+    if wtype:
+        title = f"🗓️ {day_name.capitalize()} ({week_label(wtype)} тиждень)"
+        return await render_day_message(day_name, wtype, title)
+    else:
+        return await render_day_like_today(target_date, day_name.capitalize())
 
-        # Виконуємо всі schedule tasks
-        for task in schedule_tasks:
-            await task()
+# ==========================================
+# ЛОКАЛЬНА ГРАМАТИКА КОМАНД РЕДАГУВАННЯ (без AI)
+# ==========================================
+# Типові команди з /help ("видали 1 пару у вівторок", "поміняй місцями 1 і 2 пару в понеділок",
+# "вівторок 1 пара встав посилання https://...") розбираються словник-граматикою у ті самі
+# db_actions, що генерує AI. Кожне слово має бути відоме граматиці — інакше (назви предметів,
+# вільний текст, кілька днів) команда йде до Cohere.
+EDIT_DELETE_VERBS = ["видали", "видаліть", "видалити", "удали", "удалить", "прибери", "прибрати", "убери", "убрать"]
+EDIT_SWAP_VERBS = ["поміняй", "поміняти", "поменяй", "поменять", "переставь", "перестав", "swap"]
+EDIT_LINK_VERBS = [
+    "встав", "вставь", "вставити", "вставить", "додай", "добавь", "додати", "добавить",
+    "зміни", "змінити", "измени", "изменить", "заміни", "замени", "постав", "поставь",
+    "онови", "оновити", "обнови", "обновить", "запиши",
+]
+EDIT_RESTORE_VERBS = [
+    "поверни", "повернути", "верни", "вернуть", "віднови", "відновити",
+    "восстанови", "восстановить",
+]
+EDIT_LINK_NOUNS = [
+    "посилання", "ссылку", "ссылка", "ссилку", "лінк", "линк", "link", "url",
+    "дані", "данные", "підключення", "подключения",
+]
+EDIT_PAIR_NOUNS = ["пара", "пару", "пари", "пар", "пары"]
+EDIT_ORDINALS = {
+    "перша": 1, "першу": 1, "первая": 1, "первую": 1,
+    "друга": 2, "другу": 2, "вторая": 2, "вторую": 2,
+    "третя": 3, "третю": 3, "третья": 3, "третью": 3,
+    "четверта": 4, "четверту": 4, "четвертая": 4, "четвертую": 4,
+    "п'ята": 5, "п'яту": 5, "пята": 5, "пяту": 5, "пятая": 5, "пятую": 5,
+}
+EDIT_DAYS = {
+    "Monday": ["понеділок", "понеділка", "понеділку", "понедельник", "понедельника"],
+    "Tuesday": ["вівторок", "вівторка", "вівторку", "вторник", "вторника"],
+    "Wednesday": ["середа", "середу", "середи", "среда", "среду", "среды"],
+    "Thursday": ["четвер", "четверга", "четверг"],
+    "Friday": ["п'ятниця", "п'ятницю", "п'ятниці", "пятниця", "пятницю", "пятница", "пятницу", "пятницы"],
+}
+# Службові слова і закінчення на кшталт "1-ша", "2-гу"
+EDIT_FILLER_WORDS = [
+    "у", "в", "во", "на", "і", "и", "та", "й", "а", "з", "зі", "с", "для", "ще", "номер",
+    "місцями", "местами", "тиждень", "тижня", "тижні", "неделя", "недели", "неделе",
+    "будь", "ласка", "пожалуйста", "please",
+    "ша", "шу", "га", "гу", "тя", "тю", "ту", "я", "ю",
+]
+# Допустимі лише в командах відновлення: "поверни видалену пару", "відміни видалення"
+EDIT_RESTORE_EXTRA_WORDS = [
+    "видалену", "видалені", "видалене", "видалення", "удаленную", "удалённую", "удаление",
+    "назад", "останню", "останні", "последнюю", "розклад", "расписание",
+]
+
+def _build_edit_grammar() -> dict:
+    grammar = {}
+    for verbs, kind in ((EDIT_DELETE_VERBS, "delete"), (EDIT_SWAP_VERBS, "swap"),
+                        (EDIT_LINK_VERBS, "link"), (EDIT_RESTORE_VERBS, "restore")):
+        grammar.update((w, ("verb", kind)) for w in verbs)
+    grammar.update((w, ("link_noun", None)) for w in EDIT_LINK_NOUNS)
+    grammar.update((w, ("pair_noun", None)) for w in EDIT_PAIR_NOUNS)
+    grammar.update((w, ("order", n)) for w, n in EDIT_ORDINALS.items())
+    for day_eng, words in EDIT_DAYS.items():
+        grammar.update((w, ("day", day_eng)) for w in words)
+    grammar.update((w, ("week", "odd")) for w in INTERCEPT_ODD_WEEK_WORDS)
+    grammar.update((w, ("week", "even")) for w in INTERCEPT_EVEN_WEEK_WORDS)
+    grammar.update((w, ("restore_extra", None)) for w in EDIT_RESTORE_EXTRA_WORDS)
+    grammar.update((w, ("filler", None)) for w in EDIT_FILLER_WORDS)
+    return grammar
+
+EDIT_GRAMMAR = _build_edit_grammar()
+_EDIT_WORD_RE = re.compile(r"[a-zа-яіїєґё0-9']+")
+_APOSTROPHES_RE = re.compile(r"[’ʼ`]")
+
+def parse_edit_command(text: str):
+    """
+    Розбирає структуровану команду редагування у db_actions (DELETE, SWAP, UPDATE_LINK,
+    UPDATE_FIELD з link=None, RESTORE). Повертає None, якщо команда неоднозначна
+    або містить невідомі граматиці слова — тоді її обробляє AI.
+    """
+    urls = _URL_RE.findall(text)
+    if len(urls) > 1:
+        return None
+    rest = _APOSTROPHES_RE.sub("'", _URL_RE.sub(" ", text).lower())
+
+    verbs, days, weeks, orders = set(), set(), set(), []
+    link_noun = pair_noun = restore_extra = False
+    for word in _EDIT_WORD_RE.findall(rest):
+        if word.isdigit():
+            if int(word) not in PAIR_TIMES:
+                return None
+            orders.append(int(word))
+            continue
+        kind, value = EDIT_GRAMMAR.get(word, (None, None))
+        if kind is None:
+            return None
+        if kind == "verb":
+            verbs.add(value)
+        elif kind == "day":
+            days.add(value)
+        elif kind == "week":
+            weeks.add(value)
+        elif kind == "order":
+            orders.append(value)
+        elif kind == "link_noun":
+            link_noun = True
+        elif kind == "pair_noun":
+            pair_noun = True
+        elif kind == "restore_extra":
+            restore_extra = True
+
+    if len(verbs) != 1 or len(weeks) > 1:
+        return None
+    verb = verbs.pop()
+    orders = list(dict.fromkeys(orders))
+
+    if verb == "restore":
+        if urls or link_noun:
+            return None
+        return [{"action": "RESTORE"}]
+    if restore_extra or len(days) != 1:
+        return None
 
-        # Якщо є запит на факт — генеруємо і надсилаємо
-        if has_fact_request:
-            fact = await generate_unique_fact(user_id)
-            await update.message.reply_text(
-                "🎲 **Цікавий ІТ-факт:**\n\n" + fact,
-                parse_mode="Markdown"
-            )
+    slot = {"day": days.pop(), "week": weeks.pop() if weeks else "both"}
+    if verb == "delete" and not urls:
+        if link_noun and len(orders) == 1:
+            return [{"action": "UPDATE_FIELD", "data": {**slot, "order": orders[0], "field": "link", "value": "None"}}]
+        if not link_noun and pair_noun and orders:
+            return [{"action": "DELETE", "data": {**slot, "order": order}} for order in orders]
+    elif verb == "swap" and not urls and not link_noun and len(orders) == 2:
+        return [{"action": "SWAP", "data": {**slot, "order_a": orders[0], "order_b": orders[1]}}]
+    elif verb == "link" and urls and link_noun and len(orders) == 1:
+        return [{"action": "UPDATE_LINK", "data": {**slot, "order": orders[0], "link": urls[0]}}]
+    return None
+
+def describe_edit_actions(actions: list, restored: list, counts: list) -> str:
+    """Текст відповіді для локально розібраної команди (замість "reply" від AI); counts — зміни кожної дії."""
+    lines = []
+    for item, changes in zip(actions, counts):
+        action = item["action"]
+        if action == "RESTORE":
+            names = [f"{p['name']} ({p['day']}, {p['pair_order']} пара)" for p in restored]
+            lines.append("♻️ Відновлено:\n" + "\n".join(f"• {n}" for n in names))
+            continue
+        data = item["data"]
+        where = AI_TO_DB_DAYS[data["day"]]
+        if data["week"] != "both":
+            where += f", {week_label(AI_TO_DB_WEEKS[data['week']])} тиждень"
+        if not changes:
+            slot = f"{data['order_a']} і {data['order_b']} пар" if action == "SWAP" else f"{data['order']} пари"
+            lines.append(f"⚠️ {slot} ({where}) немає в розкладі — нічого не змінено.")
+        elif action == "DELETE":
+            lines.append(f"🗑 Видалено {data['order']} пару ({where}).")
+        elif action == "SWAP":
+            lines.append(f"🔄 {data['order_a']} і {data['order_b']} пари ({where}) поміняно місцями.")
+        elif action == "UPDATE_LINK":
+            lines.append(f"🔗 Посилання для {data['order']} пари ({where}) оновлено.")
+        elif action == "UPDATE_FIELD":
+            lines.append(f"🔗 Посилання для {data['order']} пари ({where}) видалено.")
+    return "\n".join(lines)
 
-        # Якщо є завдання для AI — продовжуємо (не робимо return)
-        # Якщо немає — зупиняємось
-        if not ai_segments and (schedule_tasks or has_fact_request):
-            return
+async def apply_local_edit(update: Update, actions: list):
+    """Виконує db_actions з локальної граматики так само, як відповідь AI, і відповідає користувачу."""
+    restored = []
+    if any(item["action"] == "RESTORE" for item in actions):
+        restored = await run_db(get_last_deleted_pairs, ADMIN_ID)
+    counts = []
+    changes_count = await run_db(execute_db_actions, ADMIN_ID, actions, counts)
+    if changes_count > 0:
+        message = describe_edit_actions(actions, restored, counts) + f"\n\n⚙️ _Виконано дій з базою: {changes_count}_"
+    elif restored or actions[0]["action"] != "RESTORE":
+        message = "⚠️ Нічого не змінено: такої пари немає в розкладі."
+    else:
+        message = "⚠️ Немає видалених пар для відновлення."
+    await send_dispatcher.reply(update.message, message, parse_mode="Markdown", disable_web_page_preview=True)
 
-        # Якщо є AI-сегменти — збираємо їх і відправляємо до AI
-        if ai_segments:
-            # Replace text with only AI-relevant parts for the AI call below
-            text = " і ".join(ai_segments)
-            text_lower = text.lower()
-        elif not schedule_tasks and not has_fact_request:
-            # No segments matched anything — also check bare "виведи розклад" fallback
-            pass
-    # ============================================================
+# ==========================================
+# ВИКЛИКИ COHERE (ДЕДЛАЙН, ПОВТОРИ, ЗАПОБІЖНИК)
+# ==========================================
+class LLMUnavailableError(RuntimeError):
+    """Cohere зараз недоступний: запобіжник відкритий або вичерпано дедлайн/повтори."""
 
-    # ============================================================
+# HTTP-статуси, після яких має сенс повторити запит
+LLM_RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
 
-    # Fallback: bare "виведи розклад" / "покажи розклад" without specific day/week
-    if not has_action:
-        bare_show_kw = [
-            "виведи розклад", "покажи розклад", "дай розклад",
-            "выведи расписание", "покажи расписание", "дай расписание",
-        ]
-        if any(kw in text_lower for kw in bare_show_kw):
-            now_dt = datetime.now(TIMEZONE)
-            cw = "парний" if get_current_week_type() == "парна" else "непарний"
-            pairs = get_schedule_for_current_week(now_dt.date() - timedelta(days=now_dt.weekday()))
-            msg = format_pairs_message(pairs, f"🗓️ Розклад на **{cw.upper()}** тиждень")
-            return await update.message.reply_text(msg, parse_mode="Markdown", disable_web_page_preview=True)
+def is_transient_llm_error(error: Exception) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, httpx.TransportError)):
+        return True
+    return getattr(error, "status_code", None) in LLM_RETRY_STATUSES
 
-    now = datetime.now(TIMEZONE)
-    current_time_str = now.strftime('%Y-%m-%d %H:%M:%S')
+class LLMClient:
+    """
+    Спільна обгортка над усіма викликами Cohere.
+    Кожен виклик має дедлайн на всі спроби разом; тимчасові помилки повторюються
+    з експоненційною паузою і jitter. Після failure_threshold невдалих викликів поспіль
+    запобіжник відкривається і виклики одразу падають з LLMUnavailableError,
+    а через reset_timeout пропускається один пробний виклик.
+    """
+    def __init__(self, timeout: float, max_retries: int, base_delay: float,
+                 failure_threshold: int, reset_timeout: float):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self.stats = {
+            "calls": 0, "successes": 0, "failures": 0, "errors": 0, "timeouts": 0, "retries": 0,
+            "rejected": 0, "breaker_opens": 0, "latency_total": 0.0, "latency_max": 0.0,
+        }
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    @property
+    def available(self) -> bool:
+        """Чи пропустить запобіжник виклик просто зараз."""
+        state = self.state
+        return state == "closed" or (state == "half_open" and not self._probe_in_flight)
+
+    def _acquire(self):
+        self.stats["calls"] += 1
+        if not self.available:
+            self.stats["rejected"] += 1
+            raise LLMUnavailableError("Cohere тимчасово недоступний")
+        if self._opened_at is not None:
+            self._probe_in_flight = True
+
+    def _record(self, started: float, outcome):
+        """outcome: "success", "failure" (тимчасова — рахується запобіжником), "error" (помилка запиту) або None."""
+        latency = monotonic() - started
+        llm_call_seconds.observe(latency, outcome or "cancelled")
+        self.stats["latency_total"] += latency
+        self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+        self._probe_in_flight = False
+        if outcome is None:
+            return
+        if outcome == "error":
+            # 4xx — проблема запиту, а не доступності Cohere
+            self.stats["errors"] += 1
+            return
+        if outcome == "success":
+            self.stats["successes"] += 1
+            self._failures = 0
+            self._opened_at = None
+            return
+        self.stats["failures"] += 1
+        self._failures += 1
+        if self._opened_at is not None or self._failures >= self.failure_threshold:
+            if self._opened_at is None:
+                self.stats["breaker_opens"] += 1
+                print(f"Cohere: запобіжник відкрито після {self._failures} невдалих викликів")
+            self._opened_at = monotonic()
+
+    async def _backoff(self, attempt: int, deadline: float, error: Exception) -> bool:
+        """Чекає перед повтором. False — повторювати не можна (помилка не тимчасова, ліміт або дедлайн)."""
+        if attempt >= self.max_retries or not is_transient_llm_error(error):
+            return False
+        delay = random.uniform(0, self.base_delay * (2 ** attempt))
+        if monotonic() + delay >= deadline:
+            return False
+        self.stats["retries"] += 1
+        print(f"Cohere: тимчасова помилка ({error!r}), повтор через {delay:.2f}с")
+        await asyncio.sleep(delay)
+        return True
+
+    def _fail(self, started: float, error: Exception):
+        if is_transient_llm_error(error):
+            self._record(started, "failure")
+            raise LLMUnavailableError(f"Cohere не відповів: {error!r}") from error
+        self._record(started, "error")
+        raise error
+
+    async def chat(self, timeout: float = None, **kwargs):
+        """ai_client.chat з дедлайном, повторами і запобіжником."""
+        self._acquire()
+        started = monotonic()
+        deadline = started + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            try:
+                response = await asyncio.wait_for(get_ai_client().chat(**kwargs), max(deadline - monotonic(), 0))
+            except asyncio.CancelledError:
+                self._record(started, None)
+                raise
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self.stats["timeouts"] += 1
+                if await self._backoff(attempt, deadline, e):
+                    attempt += 1
+                    continue
+                self._fail(started, e)
+            self._record(started, "success")
+            return response
+
+    async def chat_stream(self, timeout: float = None, **kwargs):
+        """
+        ai_client.chat_stream з тим самим захистом. Повтор можливий лише до першої події:
+        те, що вже віддано споживачу, не повторюється.
+        """
+        self._acquire()
+        started = monotonic()
+        deadline = started + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            stream = get_ai_client().chat_stream(**kwargs)
+            yielded = False
+            try:
+                while True:
+                    try:
+                        event = await asyncio.wait_for(stream.__anext__(), max(deadline - monotonic(), 0))
+                    except StopAsyncIteration:
+                        break
+                    yielded = True
+                    yield event
+            except (GeneratorExit, asyncio.CancelledError):
+                # Споживач зупинив потік сам — це не збій Cohere
+                self._record(started, None)
+                raise
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    self.stats["timeouts"] += 1
+                if not yielded and await self._backoff(attempt, deadline, e):
+                    attempt += 1
+                    continue
+                self._fail(started, e)
+            finally:
+                await stream.aclose()
+            self._record(started, "success")
+            return
 
-    current_day_name = DAY_OF_WEEK_UKR.get(now.weekday(), "невідомо")
-    current_week_str = get_current_week_type()
-    if now.weekday() < 5:
-        pairs_today = get_pairs_for_day(current_day_name, current_week_str)
-        text_today = format_pairs_message(pairs_today, f"Сьогодні ({current_day_name}, {current_week_str} тиждень):")
-    else:
-        text_today = "Сьогодні вихідний, пар немає!"
-
-    tomorrow = now + timedelta(days=1)
-    tomorrow_day_name = DAY_OF_WEEK_UKR.get(tomorrow.weekday(), "невідомо")
-    tomorrow_week_str = get_week_type_for_date(tomorrow.date())
-    if tomorrow.weekday() < 5:
-        pairs_tomorrow = get_pairs_for_day(tomorrow_day_name, tomorrow_week_str)
-        text_tomorrow = format_pairs_message(pairs_tomorrow, f"Завтра ({tomorrow_day_name}, {tomorrow_week_str} тиждень):")
-    else:
-        text_tomorrow = "Завтра вихідний, пар немає!"
+    def stats_snapshot(self) -> dict:
+        snapshot = dict(self.stats)
+        finished = self.stats["successes"] + self.stats["failures"]
+        snapshot["latency_avg"] = round(self.stats["latency_total"] / finished, 3) if finished else 0.0
+        snapshot["state"] = self.state
+        return snapshot
 
-    all_pairs = get_all_pairs()
-    text_all = format_pairs_message(all_pairs, "Повний розклад (всі записи):")
+llm_client = LLMClient(LLM_TIMEOUT, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY, LLM_BREAKER_FAILURES, LLM_BREAKER_RESET)
 
-    # Останні видалені пари (для контексту відновлення)
-    last_deleted = get_last_deleted_pairs(ADMIN_ID)
-    text_deleted = format_deleted_pairs_for_prompt(last_deleted)
+# ==========================================
+# ПОТОКОВІ ВІДПОВІДІ AI
+# ==========================================
+class StreamingJSONScanner:
+    """
+    Інкрементально розбирає перший JSON-об'єкт у тексті, що надходить шматками від моделі.
+    Кожен символ обробляється один раз; значення ключів верхнього рівня доступні, щойно закриті,
+    а рядкове значення, що ще пишеться, — частково (partial_string).
+    """
+    _INCOMPLETE_ESCAPE_RE = re.compile(r'\\u[0-9a-fA-F]{0,3}$')
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0
+        self._start = None        # індекс "{" верхнього рівня
+        self._end = None          # індекс після "}" верхнього рівня
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._key_span = None     # (початок, кінець) останнього рядка-ключа
+        self._key = None          # ключ, значення якого зараз читається
+        self._value_start = None
+        self.values = {}          # ключ -> сирий JSON-текст значення
+
+    def feed(self, chunk: str):
+        self.text += chunk
+        text = self.text
+        for i in range(self._pos, len(text)):
+            if self._end is not None:
+                break
+            self._step(text, i, text[i])
+        self._pos = len(text)
+
+    def _close_value(self, end: int):
+        self.values[self._key] = self.text[self._value_start:end].strip()
+        self._key = None
+        self._value_start = None
+
+    def _step(self, text: str, i: int, c: str):
+        if self._start is None:
+            if c == "{":
+                self._start = i
+                self._depth = 1
+            return
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif c == "\\":
+                self._escape = True
+            elif c == '"':
+                self._in_string = False
+                if self._depth == 1:
+                    if self._key is None:
+                        self._key_span = (self._string_start, i + 1)
+                    elif self._value_start == self._string_start:
+                        self._close_value(i + 1)
+            return
+        if c == '"':
+            self._in_string = True
+            self._string_start = i
+            if self._depth == 1 and self._key is not None and self._value_start is None:
+                self._value_start = i
+        elif c in "{[":
+            if self._depth == 1 and self._key is not None and self._value_start is None:
+                self._value_start = i
+            self._depth += 1
+        elif c in "}]":
+            self._depth -= 1
+            if self._depth == 1 and self._key is not None and self._value_start is not None:
+                self._close_value(i + 1)
+            elif self._depth == 0:
+                # Кінець об'єкта закриває і примітивне значення (число, true, null)
+                if self._key is not None and self._value_start is not None:
+                    self._close_value(i)
+                self._end = i + 1
+        elif self._depth == 1:
+            if c == ":" and self._key_span:
+                try:
+                    self._key = json.loads(text[self._key_span[0]:self._key_span[1]])
+                except ValueError:
+                    self._key = ""
+                self._key_span = None
+            elif c == ",":
+                if self._key is not None and self._value_start is not None:
+                    self._close_value(i)
+            elif not c.isspace() and self._key is not None and self._value_start is None:
+                self._value_start = i
+
+    @property
+    def object_text(self):
+        """Текст повного об'єкта або None, якщо він ще не закритий."""
+        return self.text[self._start:self._end] if self._end is not None else None
+
+    def value(self, key: str):
+        """Розібране значення закритого ключа або None."""
+        raw = self.values.get(key)
+        if raw is None:
+            return None
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return None
+
+    def partial_string(self, key: str):
+        """Рядкове значення ключа: повне, якщо вже закрите, або те, що встигло надійти."""
+        if key in self.values:
+            value = self.value(key)
+            return value if isinstance(value, str) else None
+        if self._key != key or not self._in_string or self._value_start != self._string_start:
+            return None
+        raw = self.text[self._value_start + 1:]
+        if self._escape:
+            raw = raw[:-1]
+        raw = self._INCOMPLETE_ESCAPE_RE.sub("", raw)
+        try:
+            value = json.loads('"' + raw + '"')
+        except ValueError:
+            return None
+        # Друга половина сурогатної пари (\\udXXX) ще не надійшла
+        if value and "\ud800" <= value[-1] <= "\udbff":
+            value = value[:-1]
+        return value
+
+def parse_ai_json(raw_text: str):
+    """Витягує JSON з відповіді моделі (можливо обгорнутої текстом або ```json```)."""
+    raw_text = raw_text.strip()
+    match = re.search(r'\{.*\}', raw_text, re.DOTALL)
+    if match:
+        clean_json = match.group(0)
+    else:
+        clean_json = raw_text.replace("```json", "").replace("```", "").strip()
+    try:
+        return json.loads(clean_json)
+    except json.JSONDecodeError:
+        print(f"Raw AI response: {raw_text[:500]}")
+        raise
+
+def record_billed_tokens(response):
+    billed_units = getattr(getattr(response, "meta", None), "billed_units", None)
+    billed_input = getattr(billed_units, "input_tokens", None)
+    billed_output = getattr(billed_units, "output_tokens", None)
+    if billed_output:
+        llm_tokens_total.inc("billed_output", amount=int(billed_output))
+    if billed_input:
+        ai_prompt_stats["billed_input_tokens"] += int(billed_input)
+        llm_tokens_total.inc("billed_input", amount=int(billed_input))
+        print(f"AI промпт: Cohere порахував {int(billed_input)} вхідних токенів")
+
+def _consume_task_result(task: asyncio.Task):
+    if not task.cancelled():
+        task.exception()
+
+class AIStreamInterruptedError(RuntimeError):
+    """Потік Cohere обірвався вже після commit db_actions: зміни в розкладі є, повторювати запит не можна."""
+    def __init__(self, cause: BaseException, changes_count: int):
+        super().__init__(f"{cause!r} після застосування {changes_count} змін")
+        self.cause = cause
+        self.changes_count = changes_count
+
+async def stream_ai_chat(message: str, system_prompt: str, processing_msg, actions_user_id: int):
+    """
+    Викликає Cohere в потоковому режимі. Поки надходять токени — показує "reply" в processing_msg
+    (не частіше AI_STREAM_EDIT_INTERVAL і не більше одного редагування одночасно),
+    а db_actions запускає, щойно масив закрився. Повертає (ai_json, задача з db_actions або None).
+    Якщо потік падає після того, як дії закомічено, кидає AIStreamInterruptedError з кількістю змін.
+    """
+    scanner = StreamingJSONScanner()
+    actions_task = None
+    edit_task = None
+    shown_reply = ""
+    last_edit = 0.0
+    final_response = None
+    try:
+        async for event in llm_client.chat_stream(
+            message=message,
+            preamble=system_prompt,
+            model=AI_MODEL,
+            temperature=0.1,
+            max_tokens=8000
+        ):
+            if event.event_type == "stream-end":
+                final_response = getattr(event, "response", None)
+                continue
+            if event.event_type != "text-generation":
+                continue
+            scanner.feed(event.text)
+
+            if actions_task is None:
+                actions = scanner.value("db_actions")
+                if isinstance(actions, list):
+                    actions_task = asyncio.create_task(run_db(execute_db_actions, actions_user_id, actions))
+
+            partial = scanner.partial_string("reply")
+            if (partial and partial != shown_reply
+                    and monotonic() - last_edit >= AI_STREAM_EDIT_INTERVAL
+                    and (edit_task is None or edit_task.done())):
+                shown_reply = partial
+                last_edit = monotonic()
+                # Без Markdown: незакрита розмітка в частковому тексті ламає парсинг Telegram
+                edit_task = asyncio.create_task(send_dispatcher.edit(processing_msg, partial[:4000] + " ▌"))
+                edit_task.add_done_callback(_consume_task_result)
+
+        record_billed_tokens(final_response)
+        object_text = scanner.object_text
+        ai_json = json.loads(object_text) if object_text else parse_ai_json(scanner.text)
+    except BaseException as e:
+        if actions_task is not None:
+            (changes_count,) = await asyncio.gather(actions_task, return_exceptions=True)
+            if isinstance(e, Exception) and isinstance(changes_count, int) and changes_count > 0:
+                raise AIStreamInterruptedError(e, changes_count) from e
+        raise
+    finally:
+        # Фінальне редагування має йти після часткових
+        if edit_task is not None:
+            await asyncio.gather(edit_task, return_exceptions=True)
+    return ai_json, actions_task
 
-    system_prompt = f"""
+# ==========================================
+# ТЕЛЕГРАМ ОБРОБНИКИ ТА ШІ
+# ==========================================
+def build_system_prompt(current_time_str: str, context_sections: dict) -> str:
+    """Системний промпт для Cohere: правила + компактний контекст розкладу з build_prompt_context."""
+    return f"""
     Ти — розумний персональний асистент Олега з розкладу (Одеська політехніка).
     МОВА ВІДПОВІДІ: ВИКЛЮЧНО УКРАЇНСЬКА. Ніякої російської, англійської чи суржику.
 
     --- ПОТОЧНІ ДАНІ ---
     ЧАС: {current_time_str}
 
-    [РОЗКЛАД НА СЬОГОДНІ]:
-    {text_today}
-
-    [РОЗКЛАД НА ЗАВТРА]:
-    {text_tomorrow}
+    {context_sections['today']}
+    {context_sections['tomorrow']}
 
     [ПОВНИЙ РОЗКЛАД В БД]:
-    {text_all}
+    {PROMPT_SCHEDULE_LEGEND}
+    {context_sections['schedule']}
 
     [ОСТАННІ ВИДАЛЕНІ ПАРИ (для відновлення)]:
-    {text_deleted}
+    {context_sections['deleted']}
     ---------------------------------------------------
 
     ПОВЕРТАЙ ВИКЛЮЧНО ВАЛІДНИЙ JSON (без зайвого тексту, без markdown-блоків):
@@ -1330,87 +3508,299 @@ async def ai_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     вказав номер або назву пари. Відновлення відбувається автоматично з таблиці видалених.
     """
 
-    processing_msg = await update.message.reply_text("⏳ Оброблюю запит...")
+AI_UNAVAILABLE_TEXT = "⚠️ AI тимчасово недоступний, зміни розкладу зараз не виконати. Перегляд працює: /today, /all"
 
-    try:
-        response = await ai_client.chat(
-            message=text,
-            preamble=system_prompt,
-            model="command-a-03-2025",
-            temperature=0.1,
-            max_tokens=8000
-        )
+async def reply_ai_unavailable(update: Update, has_action: bool, handled_locally: bool):
+    """Запобіжник відкритий: без дії і без локальної відповіді показуємо поточний тиждень."""
+    await send_dispatcher.reply(update.message, AI_UNAVAILABLE_TEXT)
+    if not has_action and not handled_locally:
+        msg = await render_current_week_message()
+        await send_dispatcher.reply(update.message, msg, parse_mode="Markdown", disable_web_page_preview=True)
 
-        raw_text = response.text.strip()
-        match = re.search(r'\{.*\}', raw_text, re.DOTALL)
-        if match:
-            clean_json = match.group(0)
-        else:
-            clean_json = raw_text.replace("```json", "").replace("```", "").strip()
+async def lookup_ai_response(text: str, restore_requested: bool):
+    """
+    Кеш відповідей AI: той самий запит при тому самому розкладі й даті — без виклику Cohere.
+    Повертає (ключ, відповідь або None). Відновлення не кешується: воно залежить від таблиці видалених пар.
+    """
+    if restore_requested:
+        return None, None
+    fingerprint = await run_db(schedule_fingerprint, ADMIN_ID)
+    cache_key = ai_response_cache.make_key(text, fingerprint, datetime.now(TIMEZONE).date())
+    return cache_key, await ai_response_cache.get(cache_key)
+
+async def ai_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS: return
+    if not ai_available(): return await send_dispatcher.reply(update.message, "❌ Ключ Cohere не підключено.")
+
+    text = update.message.text
+    text_lower = text.lower()
+
+    # ===========================================================
+    # ПЕРЕХВАТ ПОВНОГО РОЗКЛАДУ — локальний парсер (без AI)
+    # ===========================================================
+    if is_full_schedule_text(text):
+        handler_path.set("full_schedule")
+        processing_msg = await send_dispatcher.reply(update.message, "⏳ Оброблюю розклад...")
+        try:
+            db_actions = parse_full_schedule_locally(text)
+            changes_count = await run_db(execute_db_actions, ADMIN_ID, db_actions)
+
+            reply = f"✅ Розклад успішно оновлено.\n\n⚙️ _Виконано дій з базою: {changes_count}_"
+            await send_dispatcher.edit(processing_msg, reply, parse_mode="Markdown")
+
+            # Показуємо оновлений розклад
+            msg = await render_current_week_message()
+            await send_dispatcher.reply(update.message, msg, parse_mode="Markdown", disable_web_page_preview=True)
+        except Exception as e:
+            print(f"Помилка локального парсера: {e}")
+            await send_dispatcher.edit(processing_msg, f"❌ Помилка парсингу розкладу: {e}")
+        return
+
+    # ===========================================================
+    # SMART INTERCEPTOR v3: segment-based, fixes парн/непарн bug
+    # Сегменти класифікуються scan_segment_intent; ключове слово дії
+    # в будь-якому сегменті вимикає перехват — запит іде до AI.
+    # ===========================================================
+
+    # ---- Основний розбір ----
+    segments = split_segments(text_lower)
+    intents = [scan_segment_intent(seg) for seg in segments]
+    has_action = any(intent["action"] for intent in intents)
+    bare_show = False
+    # Структуровані команди редагування — локальною граматикою, за мілісекунди і без Cohere
+    if has_action or any(intent["restore"] for intent in intents):
+        edit_actions = parse_edit_command(text)
+        if edit_actions:
+            handler_path.set("local_edit")
+            return await apply_local_edit(update, edit_actions)
+
+    # Запобіжник Cohere відкритий — перегляди розкладу віддаємо локально навіть поруч із дією
+    ai_down = not llm_client.available
+    restore_requested = any(i["restore"] for i in intents)
+    cached = None
+    if ai_down and has_action:
+        # Ту саму дію могли вже розібрати раніше: з кешем Cohere не потрібен і запит іде звичайним шляхом
+        cached = await lookup_ai_response(text, restore_requested)
+        ai_down = cached[1] is None
+    handled_locally = False
+
+    if not has_action or ai_down:
+        ai_segments = []
+        schedule_tasks = []  # list of async callables
+        has_fact_request = False
+
+        for seg, intent in zip(segments, intents):
+            if intent["action"]:
+                continue  # сюди потрапляємо лише з відкритим запобіжником: дію без AI не виконати
+            kind = intent["kind"]
+            wtype = intent["week_type"]
+
+            if kind == "fact":
+                has_fact_request = True
+
+            elif kind == "tomorrow":
+                async def _send_tomorrow(wt=wtype):
+                    now_dt = datetime.now(TIMEZONE)
+                    tomorrow_dt = (now_dt + timedelta(days=1)).date()
+                    if wt:
+                        dn = DAY_OF_WEEK_UKR.get(tomorrow_dt.weekday(), "п'ятниця")
+                        msg = await render_day_message(dn, wt, f"🔵 Завтра ({dn.capitalize()}, {week_label(wt)} тиждень)")
+                    else:
+                        msg = await render_day_like_today(tomorrow_dt, "Завтра")
+                    await send_dispatcher.reply(update.message, msg, parse_mode="Markdown", disable_web_page_preview=True)
+                schedule_tasks.append(_send_tomorrow)
+
+            elif kind == "today":
+                async def _send_today(wt=wtype):
+                    now_dt = datetime.now(TIMEZONE)
+                    today_dt = now_dt.date()
+                    if wt:
+                        dn = DAY_OF_WEEK_UKR.get(today_dt.weekday(), "понеділок")
+                        msg = await render_day_message(dn, wt, f"🔵 Сьогодні ({dn.capitalize()}, {week_label(wt)} тиждень)")
+                    else:
+                        msg = await render_day_like_today(today_dt, "Сьогодні")
+                    await send_dispatcher.reply(update.message, msg, parse_mode="Markdown", disable_web_page_preview=True)
+                schedule_tasks.append(_send_today)
+
+            elif kind == "week":
+                async def _send_week(wt=wtype):
+                    if wt:
+                        msg = await render_week_message(wt)
+                    else:
+                        msg = await render_current_week_message()
+                    await send_dispatcher.reply(update.message, msg, parse_mode="Markdown", disable_web_page_preview=True)
+                schedule_tasks.append(_send_week)
+
+            elif kind == "day":
+                day_name, offset = intent["day"]
+                async def _send_day(dn=day_name, off=offset, wt=wtype):
+                    msg = await render_weekday_message(dn, off, wt)
+                    await send_dispatcher.reply(update.message, msg, parse_mode="Markdown", disable_web_page_preview=True)
+                schedule_tasks.append(_send_day)
+
+            else:
+                ai_segments.append(seg)
+                bare_show = bare_show or intent["bare_show"]
+
+        # Виконуємо всі schedule tasks
+        for task in schedule_tasks:
+            await task()
+
+        # Якщо є запит на факт — генеруємо і надсилаємо
+        if has_fact_request:
+            fact = await fact_pool.get_fact(user_id)
+            await send_dispatcher.reply(
+                update.message,
+                "🎲 **Цікавий ІТ-факт:**\n\n" + fact,
+                parse_mode="Markdown"
+            )
+
+        handled_locally = bool(schedule_tasks or has_fact_request)
+        if handled_locally:
+            handler_path.set("intercept")
+
+        # Якщо є завдання для AI — продовжуємо (не робимо return)
+        # Якщо немає — зупиняємось
+        if not ai_segments and handled_locally and not has_action:
+            return
+
+        # Якщо є AI-сегменти — збираємо їх і відправляємо до AI
+        if ai_segments:
+            # Replace text with only AI-relevant parts for the AI call below
+            text = " і ".join(ai_segments)
+            text_lower = text.lower()
+        elif not schedule_tasks and not has_fact_request:
+            # No segments matched anything — also check bare "виведи розклад" fallback
+            pass
+    # ============================================================
+
+    # ============================================================
+
+    # Fallback: bare "виведи розклад" / "покажи розклад" without specific day/week
+    if not has_action:
+        if bare_show:
+            handler_path.set("intercept")
+            msg = await render_current_week_message()
+            return await send_dispatcher.reply(update.message, msg, parse_mode="Markdown", disable_web_page_preview=True)
+
+    # Кеш читається і з відкритим запобіжником: збережена відповідь Cohere не потребує
+    cache_key, ai_json = cached or await lookup_ai_response(text, restore_requested)
+    if ai_json is None and ai_down:
+        handler_path.set("ai_unavailable")
+        return await reply_ai_unavailable(update, has_action, handled_locally)
+    handler_path.set("ai_cache" if ai_json is not None else "ai")
+
+    now = datetime.now(TIMEZONE)
+    current_time_str = now.strftime('%Y-%m-%d %H:%M:%S')
 
-        ai_json = json.loads(clean_json)
+    if ai_json is None:
+        # Контекст — розклад ADMIN_ID: саме його змінюють db_actions нижче
+        context_sections = await build_prompt_context(ADMIN_ID, now, include_deleted=restore_requested)
+        system_prompt = build_system_prompt(current_time_str, context_sections)
+
+        prompt_tokens = estimate_tokens(system_prompt) + estimate_tokens(text)
+        schedule_tokens = estimate_tokens(context_sections['schedule'])
+        ai_prompt_stats["requests"] += 1
+        ai_prompt_stats["estimated_tokens"] += prompt_tokens
+        llm_tokens_total.inc("estimated_input", amount=prompt_tokens)
+        ai_prompt_stats["schedule_tokens"] += schedule_tokens
+        print(f"AI промпт: ~{prompt_tokens} токенів (з них розклад ~{schedule_tokens})")
+
+    processing_msg = await send_dispatcher.reply(update.message, "⏳ Оброблюю запит...")
+    actions_task = None
+
+    try:
+        if ai_json is None:
+            if AI_STREAMING:
+                ai_json, actions_task = await stream_ai_chat(text, system_prompt, processing_msg, ADMIN_ID)
+            else:
+                response = await llm_client.chat(
+                    message=text,
+                    preamble=system_prompt,
+                    model=AI_MODEL,
+                    temperature=0.1,
+                    max_tokens=8000
+                )
+                record_billed_tokens(response)
+                ai_json = parse_ai_json(response.text)
+            cache_fresh = cache_key is not None and isinstance(ai_json, dict)
+        else:
+            cache_fresh = False
+            print("AI: відповідь з кешу, Cohere не викликається")
 
         reply_text = ai_json.get("reply", "")
         give_fact = ai_json.get("give_fact", False)
         db_actions = ai_json.get("db_actions", [])
         show_schedule = ai_json.get("show_schedule", None)  # "today" | "tomorrow" | "week" | "day:назва_дня"
 
-        # Виконуємо всі дії з БД ПЕРШИМИ
-        changes_count = execute_db_actions(ADMIN_ID, db_actions)
+        # Виконуємо всі дії з БД ПЕРШИМИ (у потоковому режимі вони вже запущені, щойно масив закрився)
+        if actions_task is not None:
+            changes_count = await actions_task
+        else:
+            changes_count = await run_db(execute_db_actions, ADMIN_ID, db_actions)
+
+        # Кешуємо лише план, дії якого справді спрацювали: інакше той самий невдалий план віддавався б увесь TTL
+        if cache_fresh and (not db_actions or changes_count > 0):
+            await ai_response_cache.put(cache_key, ai_json)
 
         final_message = reply_text
         if changes_count > 0:
             final_message += f"\n\n⚙️ _Виконано дій з базою: {changes_count}_"
 
         if give_fact:
-            fact = await generate_unique_fact(user_id)
+            fact = await fact_pool.get_fact(user_id)
             fact_block = f"🎲 **Цікавий ІТ-факт:**\n\n{fact}"
             if final_message.strip():
                 final_message += f"\n\n{fact_block}"
             else:
                 final_message = fact_block
 
-        await processing_msg.edit_text(final_message, parse_mode="Markdown", disable_web_page_preview=True)
+        await send_dispatcher.edit(processing_msg, final_message, parse_mode="Markdown", disable_web_page_preview=True)
 
         # Мультизадачність: якщо AI вказав show_schedule — відправляємо розклад ОКРЕМИМ повідомленням
         if show_schedule:
             now_dt = datetime.now(TIMEZONE)
             sched_msg = None
             if show_schedule == "today":
-                sched_msg = format_day_like_today(now_dt.date(), "Сьогодні")
+                sched_msg = await render_day_like_today(now_dt.date(), "Сьогодні")
             elif show_schedule == "tomorrow":
-                sched_msg = format_day_like_today((now_dt + timedelta(days=1)).date(), "Завтра")
+                sched_msg = await render_day_like_today((now_dt + timedelta(days=1)).date(), "Завтра")
             elif show_schedule == "week":
-                current_week = "парний" if get_current_week_type() == "парна" else "непарний"
-                sched_msg = format_pairs_message(
-                    get_schedule_for_current_week(now_dt.date() - timedelta(days=now_dt.weekday())),
-                    f"🗓️ Розклад на **{current_week.upper()}** тиждень"
-                )
+                sched_msg = await render_current_week_message()
             elif show_schedule == "week_even":
-                sched_msg = format_pairs_message(
-                    get_schedule_for_specific_week("парна"),
-                    "🗓️ Розклад на **ПАРНИЙ** тиждень"
-                )
+                sched_msg = await render_week_message("парна")
             elif show_schedule == "week_odd":
-                sched_msg = format_pairs_message(
-                    get_schedule_for_specific_week("непарна"),
-                    "🗓️ Розклад на **НЕПАРНИЙ** тиждень"
-                )
+                sched_msg = await render_week_message("непарна")
             elif isinstance(show_schedule, str) and show_schedule.startswith("day:"):
                 day_name = show_schedule[4:]
                 DAY_NAME_TO_OFFSET = {"понеділок": 0, "вівторок": 1, "середа": 2, "четвер": 3, "п'ятниця": 4}
                 offset = DAY_NAME_TO_OFFSET.get(day_name)
                 if offset is not None:
                     current_monday = now_dt.date() - timedelta(days=now_dt.weekday())
-                    sched_msg = format_day_like_today(current_monday + timedelta(days=offset), day_name.capitalize())
+                    sched_msg = await render_day_like_today(current_monday + timedelta(days=offset), day_name.capitalize())
             if sched_msg:
-                await update.message.reply_text(sched_msg, parse_mode="Markdown", disable_web_page_preview=True)
-
+                await send_dispatcher.reply(update.message, sched_msg, parse_mode="Markdown", disable_web_page_preview=True)
+
+    except AIStreamInterruptedError as e:
+        # Розклад уже змінено — не пропонуємо повтор, бо SWAP чи DELETE_ALL + ADD застосувалися б удруге
+        print(f"Потік Cohere обірвався після змін у БД: {e}")
+        await send_dispatcher.edit(
+            processing_msg,
+            f"⚠️ Відповідь AI обірвалась, але зміни розкладу застосовано: {e.changes_count}. Перевір розклад: /all"
+        )
+    except LLMUnavailableError as e:
+        handler_path.set("ai_unavailable")
+        print(f"Cohere недоступний: {e}")
+        await send_dispatcher.edit(processing_msg, AI_UNAVAILABLE_TEXT)
+        if not has_action and not handled_locally:
+            msg = await render_current_week_message()
+            await send_dispatcher.reply(update.message, msg, parse_mode="Markdown", disable_web_page_preview=True)
     except json.JSONDecodeError as e:
-        print(f"JSON parse error: {e}\nRaw AI response: {raw_text[:500] if 'raw_text' in locals() else 'N/A'}")
-        await processing_msg.edit_text("Не вдалося обробити запит. Спробуй ще раз або переформулюй.")
+        print(f"JSON parse error: {e}")
+        await send_dispatcher.edit(processing_msg, "Не вдалося обробити запит. Спробуй ще раз або переформулюй.")
     except Exception as e:
-        await processing_msg.edit_text(f"❌ Помилка при обробці запиту: {str(e)}")
+        await send_dispatcher.edit(processing_msg, f"❌ Помилка при обробці запиту: {str(e)}")
 
 def add_user_if_not_exists(user_id: int, username: str):
     sql = "INSERT INTO users (user_id, username, subscribed) VALUES (%s, %s, 1) ON CONFLICT (user_id) DO NOTHING"
@@ -1420,39 +3810,34 @@ def add_user_if_not_exists(user_id: int, username: str):
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    add_user_if_not_exists(user.id, user.username)
+    await run_db(add_user_if_not_exists, user.id, user.username)
     text = "Привіт!\nЯ твій розумний AI-асистент з розкладу.\n\n/all - Розклад на тиждень\n/today - На сьогодні\n/randomfact - Отримати ІТ-факт"
     if user.id in ADMIN_IDS:
         text += "\n/help - Повна довідка з управління"
-    await update.message.reply_text(text, parse_mode="Markdown")
+    await send_dispatcher.reply(update.message, text, parse_mode="Markdown")
 
 async def manage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS: return
     current_week = "парний" if get_current_week_type() == "парна" else "непарний"
-    msg = format_pairs_message(get_all_pairs(), f"⚙️ Управління розкладом\n(Зараз: **{current_week}** тиждень)\n\n🗓️ Весь розклад (з ID)")
-    await update.message.reply_text(msg, parse_mode="Markdown", disable_web_page_preview=True)
+    msg = await render_all_pairs_message(f"⚙️ Управління розкладом\n(Зараз: **{current_week}** тиждень)\n\n🗓️ Весь розклад (з ID)", RENDER_MODE_MANAGE)
+    await send_dispatcher.reply(update.message, msg, parse_mode="Markdown", disable_web_page_preview=True)
 
 async def all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    now = datetime.now(TIMEZONE)
-    current_week = "парний" if get_current_week_type() == "парна" else "непарний"
-    msg = format_pairs_message(get_schedule_for_current_week(now.date() - timedelta(days=now.weekday())), f"🗓️ Розклад на **{current_week.upper()}** тиждень")
-    await update.message.reply_text(msg, parse_mode="Markdown", disable_web_page_preview=True)
+    msg = await render_current_week_message()
+    await send_dispatcher.reply(update.message, msg, parse_mode="Markdown", disable_web_page_preview=True)
 
 async def today_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     now = datetime.now(TIMEZONE)
     weekday = now.weekday()
-    if weekday >= 5: return await update.message.reply_text("🔵 На сьогодні\n\n🎉 Вихідний!", parse_mode="Markdown")
+    if weekday >= 5: return await send_dispatcher.reply(update.message, "🔵 На сьогодні\n\n🎉 Вихідний!", parse_mode="Markdown")
 
-    current_day_name = DAY_OF_WEEK_UKR[weekday]
-    current_week = get_current_week_type()
-    pairs = get_pairs_for_day(current_day_name, current_week)
-    title = f"🔵 На сьогодні ({current_day_name.capitalize()}, {'парний' if current_week == 'парна' else 'непарний'} тиждень)"
-    await update.message.reply_text(format_pairs_message(pairs, title), parse_mode="Markdown", disable_web_page_preview=True)
+    msg = await render_day_like_today(now.date(), "На сьогодні")
+    await send_dispatcher.reply(update.message, msg, parse_mode="Markdown", disable_web_page_preview=True)
 
 async def randomfact_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.chat.send_action(ChatAction.TYPING)
-    fact = await generate_unique_fact(update.effective_user.id)
-    await update.message.reply_text(f"🎲 **Цікавий ІТ-факт:**\n\n{fact}", parse_mode="Markdown")
+    fact = await fact_pool.get_fact(update.effective_user.id)
+    await send_dispatcher.reply(update.message, f"🎲 **Цікавий ІТ-факт:**\n\n{fact}", parse_mode="Markdown")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id not in ADMIN_IDS: return
@@ -1530,80 +3915,329 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 2. Для ссилок — пиши номер пари + "встав ссылку" + URL
 3. Для видалення ссилок — "видали посилання" або "удали ссылку"
 4. Можна писати українською або російською"""
-    await update.message.reply_text(help_text, parse_mode="Markdown")
+    await send_dispatcher.reply(update.message, help_text, parse_mode="Markdown")
 
 # ==========================================
-# ЗАПУСК ТА ВЕБХУК
+# ВИБІР ЛІДЕРА (ФОНОВІ ЗАДАЧІ)
 # ==========================================
-@asynccontextmanager
-async def lifespan(app: Flask):
-    global application, main_loop
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("all", all_command))
-    application.add_handler(CommandHandler("manage", manage_command))
-    application.add_handler(CommandHandler("today", today_command))
-    application.add_handler(CommandHandler("randomfact", randomfact_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, ai_text_handler))
+# Вебхуки обслуговують усі воркери gunicorn, а планувальник нагадувань, очищення
+# і прогрів пулу фактів — рівно один: той, хто тримає advisory lock.
+LEADER_LOCK_KEY = 0x5C4ED01F
 
-    await application.initialize()
-    main_loop = asyncio.get_running_loop()
-
-    if WEBHOOK_URL:
-        await application.bot.set_webhook(f"{WEBHOOK_URL}/webhook/{BOT_TOKEN}", allowed_updates=Update.ALL_TYPES)
-
-    init_db()
+class LeaderElector:
+    """
+    Лідерство через сесійний pg_try_advisory_lock на окремому з'єднанні (не з пулу).
+    Лок живе, доки живе з'єднання: якщо процес-лідер падає, Postgres звільняє лок
+    і наступний воркер, що перевіряє кожні poll_interval секунд, перехоплює задачі.
+    Пінг обмежений PING_TIMEOUT (і на сервері через statement_timeout): якщо з'єднання зависло,
+    лідер складає повноваження, не чекаючи, поки ОС помітить обрив, — інакше після того, як Postgres
+    звільнив лок, задачі (нагадування) виконували б два воркери одночасно.
+    """
+    PING_TIMEOUT = 5.0
+
+    def __init__(self, lock_key: int, poll_interval: float):
+        self.lock_key = lock_key
+        self.poll_interval = poll_interval
+        self.is_leader = False
+        self._conn = None
+        self._task = None
+        self._on_elected = None
+        self._on_demoted = None
+        self.stats = {"elections": 0, "demotions": 0, "errors": 0}
+
+    @property
+    def running(self) -> bool:
+        """Чи йдуть вибори: без них (скрипти, тести) процес вважається єдиним."""
+        return self._task is not None
+
+    def start(self, on_elected, on_demoted):
+        """on_elected / on_demoted — корутини запуску і зупинки задач лідера."""
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            await self._demote()
+        await run_db(self._close)
+
+    def _try_acquire(self) -> bool:
+        if self._conn is None or self._conn.closed:
+            self._conn = connect_db(
+                DATABASE_URL, options=f"-c statement_timeout={int(self.PING_TIMEOUT * 1000)}", **DB_KEEPALIVE_OPTIONS
+            )
+            self._conn.autocommit = True
+        with self._conn.cursor() as cursor:
+            cursor.execute("SELECT pg_try_advisory_lock(%s)", (self.lock_key,))
+            return cursor.fetchone()[0]
+
+    def _ping(self):
+        # Живе з'єднання = лок досі наш
+        with self._conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+
+    def _close(self):
+        if self._conn is not None and not self._conn.closed:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+
+    def _abandon(self):
+        """З'єднання зависло в іншому потоці: закриваємо його у фоні, щоб не блокувати вибори."""
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            asyncio.get_running_loop().run_in_executor(None, conn.close)
+
+    async def _demote(self):
+        self.is_leader = False
+        self.stats["demotions"] += 1
+        try:
+            await self._on_demoted()
+        except Exception as e:
+            print(f"Помилка зупинки задач лідера: {e}")
+
+    async def _run(self):
+        while True:
+            try:
+                if not self.is_leader:
+                    if await run_db(self._try_acquire):
+                        self.is_leader = True
+                        self.stats["elections"] += 1
+                        print(f"Лідер: процес {os.getpid()} запускає фонові задачі")
+                        await self._on_elected()
+                else:
+                    await asyncio.wait_for(run_db(self._ping), timeout=self.PING_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.stats["errors"] += 1
+                print(f"Лідер: БД не відповіла за {self.PING_TIMEOUT:.0f}с, складаємо повноваження")
+                if self.is_leader:
+                    await self._demote()
+                self._abandon()
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Лідер: втрачено з'єднання з БД ({e})")
+                if self.is_leader:
+                    await self._demote()
+                await run_db(self._close)
+            await asyncio.sleep(self.poll_interval)
+
+    def stats_snapshot(self) -> dict:
+        return {**self.stats, "is_leader": self.is_leader}
+
+leader_elector = LeaderElector(LEADER_LOCK_KEY, LEADER_POLL_INTERVAL)
+
+async def start_leader_jobs():
+    reminder_scheduler.start(application.bot)
+    asyncio.create_task(fact_pool.warm_up())
+
+async def stop_leader_jobs():
+    await reminder_scheduler.stop()
 
-    scheduler.init_app(flask_app)
-    scheduler.add_job(id='RemindersJob', func=scheduled_job_wrapper, trigger='interval', minutes=1)
-    scheduler.start()
+# ==========================================
+# ЗАПУСК ТА ВЕБХУК
+# ==========================================
+# Таймінги фаз старту (секунди) і час до першого обробленого апдейту
+startup_timings = {}
 
-    yield
+async def timed_phase(name: str, awaitable):
+    started = monotonic()
+    try:
+        return await awaitable
+    finally:
+        startup_timings[name] = monotonic() - started
 
-app = Flask(__name__)
-flask_app = app
+def format_startup_timings() -> str:
+    return ", ".join(f"{name} {seconds * 1000:.0f} мс" for name, seconds in startup_timings.items())
 
-_processing_updates: set = set()
+async def register_webhook():
+    """Реєструє вебхук, лише якщо Telegram знає інший URL чи набір апдейтів — зазвичай це один getWebhookInfo."""
+    if not WEBHOOK_URL:
+        return
+    url = f"{WEBHOOK_URL}/webhook/{BOT_TOKEN}"
+    info = await application.bot.get_webhook_info()
+    if info.url == url and set(info.allowed_updates or ()) >= set(Update.ALL_TYPES):
+        print("Вебхук уже зареєстровано, пропускаємо set_webhook")
+        return
+    await application.bot.set_webhook(url, allowed_updates=Update.ALL_TYPES)
 
-@app.route('/')
-def health_check(): return "OK", 200
+@asynccontextmanager
+async def lifespan(app):
+    global application
+    startup_timings["imports"] = monotonic() - STARTUP_STARTED
+    application = Application.builder().token(BOT_TOKEN).build()
 
-@app.route(f'/webhook/{BOT_TOKEN}', methods=['POST'])
-async def webhook():
-    data = flask_request.get_json()
-    update = Update.de_json(data, application.bot)
-    update_id = update.update_id
+    application.add_handler(CommandHandler("start", instrument_handler("start", start_command)))
+    application.add_handler(CommandHandler("all", instrument_handler("all", all_command)))
+    application.add_handler(CommandHandler("manage", instrument_handler("manage", manage_command)))
+    application.add_handler(CommandHandler("today", instrument_handler("today", today_command)))
+    application.add_handler(CommandHandler("randomfact", instrument_handler("randomfact", randomfact_command)))
+    application.add_handler(CommandHandler("help", instrument_handler("help", help_command)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrument_handler("text", ai_text_handler)))
+
+    # Ініціалізація бота і міграції йдуть паралельно; помилка одного скасовує інше.
+    # Вебхук реєструється лише після міграцій: на застарілій схемі init_db кидає
+    # SchemaOutdatedError, сервер не стартує і Telegram не шле апдейти на нього.
+    async with asyncio.TaskGroup() as startup:
+        startup.create_task(timed_phase("telegram_init", application.initialize()))
+        startup.create_task(timed_phase("db", run_db(init_db)))
+    await timed_phase("webhook", register_webhook())
+
+    schedule_change_listener.start()
+    send_dispatcher.start()
+    update_dispatcher.start(process_new_update)
+    # Нагадування, очищення і прогрів пулу фактів — лише у воркері-лідері
+    leader_elector.start(start_leader_jobs, stop_leader_jobs)
+    startup_timings["ready"] = monotonic() - STARTUP_STARTED
+    print(f"Старт: {format_startup_timings()}")
+
+    # Клієнт Cohere готуємо у фоновому потоці вже після готовності, щоб перший AI-запит не платив за імпорт
+    asyncio.get_running_loop().run_in_executor(None, get_ai_client)
 
-    # Якщо Telegram повторно надсилає той самий апдейт (бо сервер не відповів вчасно) — ігноруємо
-    if update_id in _processing_updates:
-        return "OK", 200
+    yield
 
-    _processing_updates.add(update_id)
+    await leader_elector.stop()
+    await update_dispatcher.stop()
+    await send_dispatcher.stop()
+    await schedule_change_listener.stop()
 
-    async def _process_and_cleanup():
-        try:
-            await application.process_update(update)
-        finally:
-            _processing_updates.discard(update_id)
+    db_executor.shutdown(wait=False)
+    db_pool.close()
 
-    # Повертаємо 200 одразу, щоб Telegram не робив retry при довгих AI-запитах
-    asyncio.create_task(_process_and_cleanup())
-    return "OK", 200
+async def process_new_update(update: Update):
+    # Повтори від Telegram відсіюються тут, у воркері черги, — відповідь вебхука не чекає на БД
+    if await update_deduplicator.claim(update.update_id):
+        await application.process_update(update)
+        if "first_update" not in startup_timings:
+            startup_timings["first_update"] = monotonic() - STARTUP_STARTED
+            print(f"Перший апдейт оброблено через {startup_timings['first_update']:.2f} с від старту процесу")
 
-wsgi_app = WsgiToAsgi(app)
+class WebhookApp:
+    """
+    ASGI-застосунок без фреймворку: lifespan (старт/зупинка бота), GET / (health check),
+    GET /metrics (Prometheus) і POST /webhook/<BOT_TOKEN>. Тіло вебхука одразу розбирається в Update і ставиться
+    в update_dispatcher; відповідь не чекає ні на обробку, ні на БД.
+    """
+    TEXT_CONTENT_TYPE = b"text/plain; charset=utf-8"
+    METRICS_CONTENT_TYPE = b"text/plain; version=0.0.4; charset=utf-8"
 
-class LifespanMiddleware:
-    def __init__(self, app_to_run, lifespan_context, flask_app_instance):
-        self.app_to_run = app_to_run
+    def __init__(self, lifespan_context, webhook_path: str):
         self.lifespan_context = lifespan_context
-        self.flask_app_instance = flask_app_instance
+        self.webhook_path = webhook_path
+
     async def __call__(self, scope, receive, send):
-        if scope['type'] == 'lifespan':
-            async with self.lifespan_context(self.flask_app_instance):
-                await self.app_to_run(scope, receive, send)
-        else:
-            await self.app_to_run(scope, receive, send)
-    
-app = LifespanMiddleware(wsgi_app, lifespan, app)
\ No newline at end of file
+        if scope["type"] == "http":
+            await self._http(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+
+    async def _lifespan(self, receive, send):
+        await receive()  # lifespan.startup
+        context = self.lifespan_context(self)
+        try:
+            await context.__aenter__()
+        except BaseException as e:
+            print(f"Помилка запуску: {e!r}")
+            await send({"type": "lifespan.startup.failed", "message": repr(e)})
+            return
+        await send({"type": "lifespan.startup.complete"})
+        await receive()  # lifespan.shutdown
+        try:
+            await context.__aexit__(None, None, None)
+        except BaseException as e:
+            await send({"type": "lifespan.shutdown.failed", "message": repr(e)})
+            return
+        await send({"type": "lifespan.shutdown.complete"})
+
+    @staticmethod
+    async def _respond(send, status: int, text: str, content_type: bytes = TEXT_CONTENT_TYPE):
+        body = text.encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+    @staticmethod
+    async def _read_body(receive):
+        """Тіло запиту або None, якщо воно більше WEBHOOK_MAX_BODY."""
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return b""
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > WEBHOOK_MAX_BODY:
+                return None
+            chunks.append(chunk)
+            if not message.get("more_body", False):
+                return b"".join(chunks)
+
+    async def _http(self, scope, receive, send):
+        path, method = scope["path"], scope["method"]
+        if path == self.webhook_path:
+            if method != "POST":
+                return await self._respond(send, 405, "Method Not Allowed")
+            started = monotonic()
+            status, text = await self._webhook(receive)
+            await self._respond(send, status, text)
+            webhook_ack_seconds.observe(monotonic() - started, status)
+            return
+        if path not in ("/", "/metrics"):
+            return await self._respond(send, 404, "Not Found")
+        if method not in ("GET", "HEAD"):
+            return await self._respond(send, 405, "Method Not Allowed")
+        if path == "/metrics":
+            return await self._respond(send, 200, metrics.render(), self.METRICS_CONTENT_TYPE)
+        await self._respond(send, 200, "OK")
+
+    async def _webhook(self, receive):
+        body = await self._read_body(receive)
+        if body is None:
+            return 413, "Payload Too Large"
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400, "Bad Request"
+        # Валідний JSON, але не об'єкт ([] чи 1) — це не апдейт Telegram
+        if not isinstance(data, dict):
+            return 400, "Bad Request"
+        try:
+            update = Update.de_json(data, application.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400, "Bad Request"
+        if update is None:
+            return 400, "Bad Request"
+
+        # Повертаємо 200 одразу, щоб Telegram не робив retry при довгих AI-запитах;
+        # при переповненій черзі — 503, і Telegram надішле апдейт пізніше
+        if not update_dispatcher.submit(update):
+            return 503, "Busy"
+        return 200, "OK"
+
+# Лічильники підсистем (stats_snapshot) віддаються на /metrics як gauge
+metrics.collector("db_pool", db_pool.stats_snapshot)
+metrics.collector("schedule_cache", schedule_cache.stats_snapshot)
+metrics.collector("render_cache", render_cache.stats_snapshot)
+metrics.collector("ai_cache", ai_response_cache.stats_snapshot)
+metrics.collector("ai_prompt", lambda: ai_prompt_stats)
+metrics.collector("llm", llm_client.stats_snapshot)
+metrics.collector("fact_pool", lambda: fact_pool.stats)
+metrics.collector("send", send_dispatcher.stats_snapshot)
+metrics.collector("updates", update_dispatcher.stats_snapshot)
+metrics.collector("update_dedup", update_deduplicator.stats_snapshot)
+metrics.collector("leader", leader_elector.stats_snapshot)
+metrics.collector("schedule_listener", schedule_change_listener.stats_snapshot)
+metrics.collector("startup_seconds", lambda: startup_timings)
+
+app = WebhookApp(lifespan, f"/webhook/{BOT_TOKEN}")
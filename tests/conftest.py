@@ -0,0 +1,9 @@
+import os
+import sys
+
+# main.py читає конфіг з оточення під час імпорту і без ADMIN_ID завершує процес
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost/test")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
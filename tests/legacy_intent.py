@@ -0,0 +1,142 @@
+"""
+Еталон для тестів: перехоплювач ai_text_handler до переходу на KeywordMatcher (user-013).
+Списки ключових слів і замикання перенесено без змін і, як у старому обробнику,
+вони створюються заново на кожне повідомлення — це входить у порівняння швидкодії.
+"""
+
+def legacy_route(text: str):
+    """(has_action, [(kind, day або None, week_type, bare_show) для кожного сегмента]) — як старий обробник."""
+    text_lower = text.lower()
+    ACTION_KEYWORDS = [
+        "видали", "видаліть", "удали", "удалить", "прибери", "прибрати",
+        "додай", "добавь", "добавити", "додати",
+        "зміни", "змін", "измени", "виправ", "виправити",
+        "відновити", "восстанови", "восстановить", "поверни", "верни",
+        "зроби", "зробити", "создай", "создать", "сделай", "сделать",
+        "постав", "поміняй", "поменяй", "переставь", "перестав",
+        "перепиши", "перезапиши", "запиши", "переписати", "перезаписати", "записати",
+        "swap", "move",
+        "вставь", "вставити", "вставляй", "встав",
+        "обнови", "оновити", "оновлюй", "обновить",
+        "ссылк", "ссилк", "посилання", "лінк", "линк", "link",
+    ]
+    has_action = any(kw in text_lower for kw in ACTION_KEYWORDS)
+
+    # ---- Визначення типу тижня (НЕПАРН* перед ПАРН* щоб уникнути substring-помилки) ----
+    def detect_week_type(t: str):
+        """Returns 'парна', 'непарна', or None. Checks непарн* FIRST."""
+        odd_words = [
+            "непарну", "непарний", "непарна", "непарної", "непарного",
+            "непарной", "непарному", "непарный",
+            "нечётну", "нечётний", "нечётна", "нечётной", "нечётный",
+            "нечетну", "нечетний", "нечетна", "нечетной", "нечетную", "нечетный",
+            "непарную", "odd",
+            "непарне", "нечётне", "нечетное", "непарное",
+        ]
+        even_words = [
+            "парну", "парний", "парна", "парної", "парного",
+            "парной", "парному", "парный",
+            "четну", "четний", "четна", "четной", "четную", "четный",
+            "чётну", "чётній", "чётна", "чётной", "чётную", "чётный",
+            "парную", "even",
+            "парне", "парное", "четное", "чётное",
+        ]
+        # MUST check odd first — "парну" IS a substring of "непарну"
+        for w in odd_words:
+            if w in t:
+                return "непарна"
+        for w in even_words:
+            if w in t:
+                return "парна"
+        return None
+
+    # ---- Мапи днів ----
+    DAY_DETECT_MAP = [
+        (["понеділок", "понеділку", "в понеділок", "на понеділок",
+          "понедельник", "в понедельник", "на понедельник", "понедельника"], "понеділок", 0),
+        (["вівторок", "у вівторок", "на вівторок",
+          "вторник", "во вторник", "на вторник", "вторника"], "вівторок", 1),
+        (["середу", "середа", "середи", "в середу", "на середу",
+          "среду", "в среду", "на среду", "среды"], "середа", 2),
+        (["четвер", "в четвер", "на четвер", "четвер",
+          "четверг", "в четверг", "на четверг", "четверга"], "четвер", 3),
+        (["п'ятницю", "п'ятниця", "п'ятниці", "в п'ятницю", "на п'ятницю",
+          "пятницю", "пятниця", "пятницу", "в пятницу", "на пятницу",
+          "пятницы", "пятница"], "п'ятниця", 4),
+    ]
+
+    def detect_day(seg: str):
+        """Returns (day_name, offset) or None."""
+        for kws, day_name, offset in DAY_DETECT_MAP:
+            if any(kw in seg for kw in kws):
+                return (day_name, offset)
+        return None
+
+    # ---- Розбивка на сегменти ----
+    CONJUNCTIONS = [" і ", " и ", " та ", " and ", " & ", ", "]
+
+    def split_segments(t: str):
+        """Split text into segments by conjunctions."""
+        result = t
+        for sep in CONJUNCTIONS:
+            result = result.replace(sep, " ||SEP|| ")
+        parts = [p.strip() for p in result.split("||SEP||") if p.strip()]
+        return parts if parts else [t]
+
+    # ---- Класифікація сегменту ----
+    SHOW_DAY_TRIGGERS = [
+        "розклад", "пари", "виведи", "покажи", "дай",
+        "расписание", "пары", "выведи",
+        "на ", "в ", "у ",
+    ]
+    WEEK_FULL_KW = [
+        "тиждень", "тижня", "тижні", "неделю", "недели",
+        "всі пари", "весь розклад", "повний розклад",
+        "полное расписание", "все пары",
+        "парне розклад", "непарне розклад",
+        "парное расписание", "непарное расписание",
+    ]
+    TOMORROW_KW = [
+        "завтра", "завтрашн",
+    ]
+    TODAY_KW = [
+        "сьогодні", "сегодня",
+    ]
+    FACT_KW = [
+        "факт", "факти", "fact",
+    ]
+
+    def classify_segment(seg: str):
+        """
+        Returns one of: 'today', 'tomorrow', 'week', 'day', 'fact', 'ai'
+        """
+        s = seg.lower()
+        if any(kw in s for kw in FACT_KW):
+            return "fact"
+        if any(kw in s for kw in TOMORROW_KW):
+            return "tomorrow"
+        if any(kw in s for kw in TODAY_KW):
+            return "today"
+        if any(kw in s for kw in WEEK_FULL_KW):
+            return "week"
+        # Check for day name
+        if detect_day(s) is not None:
+            # Require a show trigger OR short segment
+            if any(t in s for t in SHOW_DAY_TRIGGERS) or len(s.split()) <= 4:
+                return "day"
+        return "ai"
+
+    bare_show_kw = [
+        "виведи розклад", "покажи розклад", "дай розклад",
+        "выведи расписание", "покажи расписание", "дай расписание",
+    ]
+    routes = []
+    for seg in split_segments(text_lower):
+        kind = classify_segment(seg)
+        routes.append((
+            kind,
+            detect_day(seg) if kind == "day" else None,
+            detect_week_type(seg),
+            any(kw in seg for kw in bare_show_kw),
+        ))
+    return has_action, routes
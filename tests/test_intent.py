@@ -0,0 +1,101 @@
+"""
+Перехоплювач ai_text_handler: KeywordMatcher маршрутизує так само, як старі замикання
+(tests/legacy_intent.py), на фразах з help_command і на згенерованих повідомленнях, і не повільніше за них.
+"""
+import inspect
+import random
+import re
+import time
+
+import pytest
+
+import main
+from legacy_intent import legacy_route
+
+def route(text: str):
+    """Те саме, що legacy_route, але через scan_segment_intent."""
+    intents = [main.scan_segment_intent(seg) for seg in main.split_segments(text.lower())]
+    return (
+        any(intent["action"] for intent in intents),
+        [(i["kind"], i["day"] if i["kind"] == "day" else None, i["week_type"], i["bare_show"]) for i in intents],
+    )
+
+# Фрази з help_command і типові повідомлення -> (є дія, [(kind, day, week_type, bare_show) по сегментах])
+GOLDEN = [
+    ('розклад на сьогодні', (False, [('today', None, None, False)])),
+    ('розклад на завтра', (False, [('tomorrow', None, None, False)])),
+    ('покажи вівторок', (False, [('day', ('вівторок', 1), None, False)])),
+    ('пари в середу', (False, [('day', ('середа', 2), None, False)])),
+    ('розклад на тиждень', (False, [('week', None, None, False)])),
+    ('розклад на непарний тиждень', (False, [('week', None, 'непарна', False)])),
+    ('покажи понеділок парного тижня', (False, [('week', None, 'парна', False)])),
+    ('додай у понеділок 3 пару — Фізика', (True, [('day', ('понеділок', 0), None, False)])),
+    ('зміни 2 пару у вівторок на Математику', (True, [('day', ('вівторок', 1), None, False)])),
+    ('вівторок 1 пара встав посилання https://zoom.us/...', (True, [('day', ('вівторок', 1), None, False)])),
+    ('понеділок 2 пара встав ссылку https://meet.google.com/...', (True, [('day', ('понеділок', 0), None, False)])),
+    ('середа 1 пара зміни ссылку на https://...', (True, [('day', ('середа', 2), None, False)])),
+    ('[день] [номер] пара встав ссылку [URL]', (True, [('ai', None, None, False)])),
+    ('вівторок 1 пара видали посилання', (True, [('ai', None, None, False)])),
+    ('понеділок 2 пара удали данные подключения', (True, [('ai', None, None, False)])),
+    ('середа 1 пара прибери лінк', (True, [('ai', None, None, False)])),
+    ('[день] [номер] пара видали посилання', (True, [('ai', None, None, False)])),
+    ('видали 1 пару у вівторок', (True, [('day', ('вівторок', 1), None, False)])),
+    ('удали матан в понеділок', (True, [('day', ('понеділок', 0), None, False)])),
+    ('видали англійську в середу непарного тижня', (True, [('week', None, 'непарна', False)])),
+    ('поміняй місцями 1 і 2 пару в понеділок', (True, [('ai', None, None, False), ('day', ('понеділок', 0), None, False)])),
+    ('поверни видалену пару', (True, [('ai', None, None, False)])),
+    ('відновити', (True, [('ai', None, None, False)])),
+    ('видали матан у вівторок і покажи розклад на вівторок', (True, [('day', ('вівторок', 1), None, False), ('day', ('вівторок', 1), None, True)])),
+    ('додай 3 пару і виведи тиждень', (True, [('ai', None, None, False), ('week', None, None, False)])),
+    ('виведи розклад', (False, [('ai', None, None, True)])),
+    ('дай факт і розклад на завтра', (False, [('fact', None, None, False), ('tomorrow', None, None, False)])),
+    ("покажи четвер і п'ятницю", (False, [('day', ('четвер', 3), None, False), ('day', ("п'ятниця", 4), None, False)])),
+    ('розклад на парний тиждень, сьогодні непарний', (False, [('week', None, 'парна', False), ('today', None, 'непарна', False)])),
+    ('понеділок', (False, [('day', ('понеділок', 0), None, False)])),
+    ('покажи розклад будь ласка', (False, [('ai', None, None, True)])),
+    ('привіт', (False, [('ai', None, None, False)])),
+    ('завтра парний', (False, [('tomorrow', None, 'парна', False)])),
+]
+
+@pytest.mark.parametrize("phrase, expected", GOLDEN)
+def test_golden_routing(phrase, expected):
+    assert route(phrase) == expected
+    assert legacy_route(phrase) == expected
+
+def test_golden_covers_help_phrases():
+    help_phrases = re.findall(r"`([^`\n]+)`", inspect.getsource(main.help_command))
+    assert help_phrases
+    assert set(help_phrases) <= {phrase for phrase, _ in GOLDEN}
+
+# Словник генератора: усі ключові слова перехоплювача плюс сполучники і "шум"
+FUZZ_WORDS = (
+    main.INTERCEPT_ACTION_KEYWORDS + main.INTERCEPT_ODD_WEEK_WORDS + main.INTERCEPT_EVEN_WEEK_WORDS
+    + [kw for kws, _, _ in main.INTERCEPT_DAY_KEYWORDS for kw in kws]
+    + main.INTERCEPT_SHOW_DAY_TRIGGERS + main.INTERCEPT_WEEK_FULL_KW + main.INTERCEPT_TOMORROW_KW
+    + main.INTERCEPT_TODAY_KW + main.INTERCEPT_FACT_KW + main.INTERCEPT_BARE_SHOW_KW
+    + ["парну", "непарну", "even", "odd", " і ", " и ", ", ", " та ", "x", "пара", "3", " "]
+)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_legacy_on_generated_messages(seed):
+    rng = random.Random(seed)
+    for _ in range(2000):
+        text = "".join(rng.choice(FUZZ_WORDS) + (" " if rng.random() < 0.5 else "") for _ in range(rng.randint(1, 8)))
+        if rng.random() < 0.3:
+            text = text.upper()
+        assert route(text) == legacy_route(text), text
+
+def _best_time(func, phrases, repeat: int = 5, loops: int = 200) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(loops):
+            for phrase in phrases:
+                func(phrase)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+def test_not_slower_than_legacy():
+    phrases = [phrase for phrase, _ in GOLDEN]
+    new, old = _best_time(route, phrases), _best_time(legacy_route, phrases)
+    assert new < old, f"KeywordMatcher {new * 1000:.1f} ms vs legacy closures {old * 1000:.1f} ms"
@@ -0,0 +1,91 @@
+"""
+Локальний парсер розкладу: однопрохідна версія дає ті самі дії, що й еталон
+(tests/legacy_schedule_parser.py), і масштабується лінійно на патологічних вставках.
+"""
+import random
+import time
+
+import pytest
+
+import main
+import legacy_schedule_parser as legacy
+
+MULTI_GROUP = """ПОНЕДІЛОК
+1 пара: (1-15 лекція) Вища математика - Іваненко https://meet.google.com/abc-defg-hij
+2 пара:
+Якщо 1-15 лаб, то Фізика - Петренко https://zoom.us/j/123
+Якщо 2-16 лаб, то Хімія №: 123 456 789 Код доступа: x9Y
+ВІВТОРОК
+3 пара: пусто
+4 пара: Програмування Код доступа: 777
+СЕРЕДА
+1 пара: Англійська
+П'ЯТНИЦЯ
+2 пара - Якщо 3-9 практика то Алгоритми https://a.b/c
+"""
+
+# Токени, з яких генератор складає вставки: заголовки днів, номери пар, умови тижнів,
+# посилання й коди доступу, а також порожні та "биті" рядки
+FUZZ_TOKENS = [
+    "ПОНЕДІЛОК", "вівторок", "Середа", "ЧЕТВЕР", "П'ЯТНИЦЯ", "пятниця",
+    "1 пара:", "2 пара -", "3пара", "4 ПАРА: пусто", "5 пара",
+    "Якщо 1-15 лаб, то", "Якщо 2-16 практика то", "якщо 3-9 лекція, то", "ЯКЩО", "Якщо", "то",
+    "Math - Ivanov", "https://meet.google.com/abc", "№: 123 456 Код доступа: 9x", "Код доступу: 77",
+    "(1-15 лекція)", "пусто", "", "  ", "\r", "-", ",", "Фізика", "\t",
+]
+
+def fuzz_text(rng: random.Random) -> str:
+    lines = []
+    for _ in range(rng.randint(0, 40)):
+        words = [rng.choice(FUZZ_TOKENS) for _ in range(rng.randint(1, 4))]
+        lines.append(("" if rng.random() < 0.5 else " ").join(words))
+    return "\n".join(lines)
+
+def test_multi_group_timetable():
+    assert main.parse_full_schedule_locally(MULTI_GROUP) == [
+        {"action": "DELETE_ALL"},
+        {"action": "ADD", "data": {"day": "Monday", "order": 1, "week": "both", "subject": "Вища математика - Іваненко", "link": "https://meet.google.com/abc-defg-hij"}},
+        {"action": "ADD", "data": {"day": "Monday", "order": 2, "week": "odd", "subject": "Фізика - Петренко", "link": "https://zoom.us/j/123"}},
+        {"action": "ADD", "data": {"day": "Monday", "order": 2, "week": "even", "subject": "Хімія", "link": "№: 123 456 789 Код доступа: x9Y"}},
+        {"action": "ADD", "data": {"day": "Tuesday", "order": 4, "week": "both", "subject": "Програмування", "link": "Код доступа: 777"}},
+        {"action": "ADD", "data": {"day": "Wednesday", "order": 1, "week": "both", "subject": "Англійська", "link": "None"}},
+        {"action": "ADD", "data": {"day": "Friday", "order": 2, "week": "odd", "subject": "Алгоритми", "link": "https://a.b/c"}},
+    ]
+    assert main.parse_full_schedule_locally(MULTI_GROUP) == legacy.parse_full_schedule_locally(MULTI_GROUP)
+
+@pytest.mark.parametrize("seed", range(5))
+def test_matches_legacy_parser_on_fuzzed_input(seed):
+    rng = random.Random(seed)
+    for _ in range(1000):
+        text = fuzz_text(rng)
+        assert main.parse_full_schedule_locally(text) == legacy.parse_full_schedule_locally(text), text
+
+def _best_time(func, text: str, repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(text)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+PATHOLOGICAL = {
+    # Умова без "то" в одному довгому рядку
+    "no_then": lambda k: "ПОНЕДІЛОК\n1 пара:\n" + "Якщо 1-15 лаб, " * (20 * k),
+    "long_body": lambda k: "ПОНЕДІЛОК\n1 пара: Якщо 1-15 лаб, то x\n" + "якщо-не\n" * (20 * k),
+    "multi_group": lambda k: MULTI_GROUP * k,
+}
+
+@pytest.mark.parametrize("name", sorted(PATHOLOGICAL))
+def test_scales_linearly(name):
+    small, large = PATHOLOGICAL[name](200), PATHOLOGICAL[name](1600)
+    assert main.parse_full_schedule_locally(large) == legacy.parse_full_schedule_locally(large)
+    ratio = _best_time(main.parse_full_schedule_locally, large) / _best_time(main.parse_full_schedule_locally, small)
+    # Вхід у 8 разів довший: лінійний парсер — ~8x, квадратичний був би ~64x
+    assert ratio < 20, f"{name}: x8 input took x{ratio:.1f} time"
+
+@pytest.mark.parametrize("name", sorted(PATHOLOGICAL))
+def test_not_slower_than_legacy(name):
+    text = PATHOLOGICAL[name](800)
+    new, old = _best_time(main.parse_full_schedule_locally, text), _best_time(legacy.parse_full_schedule_locally, text)
+    # Один прохід замість шести regex-сканувань тексту: на практиці ~3x швидше
+    assert new < old, f"{name}: new {new * 1000:.1f} ms vs legacy {old * 1000:.1f} ms"